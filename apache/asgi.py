@@ -0,0 +1,22 @@
+# ASGI entry point serving the same site as django.wsgi. Needed for the
+# long-polling wait_state/ view, whose waiting requests don't tie up a thread
+# each here. The main page and get_state/ are async too: here they build an
+# uncached state with its queries running concurrently, so proxying them (or
+# the whole site) here lets one process wait for many slow queries at once.
+# Each such request can use up to three database connections at a time. Run
+# e.g. with
+#   uvicorn --app-dir /srv/http/puhveli/apache asgi:application
+# and proxy at least /ideaList/wait_state/ to it. The cache backend must be
+# shared between the processes (e.g. memcached), see ideaList/push.py.
+import os
+import sys
+
+paths = ['/srv/http', '/srv/http/puhveli', '/srv/http/puhveli/undelete']
+for path in paths:
+    if path not in sys.path:
+        sys.path.append(path)
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'puhveli.settings_production'
+
+from django.core.asgi import get_asgi_application
+application = get_asgi_application()
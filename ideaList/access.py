@@ -0,0 +1,51 @@
+"""
+Per-request memo of what a user may touch, for the permission checks.
+
+for_user(user) loads the ids of the user's nontrashed subscriptions and of
+their lists with one query the first time it is asked and keeps them on the
+user object, which lives as long as the request (request.user). Checking any
+number of items, lists or subscriptions after that costs no more queries
+than fetching the objects themselves.
+
+The signal receivers in ideaList.models call invalidate whenever a
+subscription or list is saved, trashed, restored or deleted in this process,
+after which every memo is loaded again, so a request that changes them sees
+its own writes.
+"""
+import itertools
+
+_generations = itertools.count(1)
+_generation = next(_generations)
+
+class Access(object):
+    """
+    The user's nontrashed subscriptions as ids:
+
+    - subscription_ids: the subscriptions
+    - subscribed_list_ids: their lists, including trashed ones
+    - list_ids: their nontrashed lists, the ones in the user's state
+    """
+    def __init__(self, user):
+        from ideaList.models import Subscription
+        self.generation = _generation
+        self.subscription_ids = set()
+        self.subscribed_list_ids = set()
+        self.list_ids = set()
+        for s_id, l_id, trashed in Subscription.nontrash.filter(user=user) \
+                .order_by().values_list('id', 'list_id', 'list__trashed_at'):
+            self.subscription_ids.add(s_id)
+            self.subscribed_list_ids.add(l_id)
+            if trashed is None:
+                self.list_ids.add(l_id)
+
+def for_user(user):
+    "Return the Access of user, loading it if this request hasn't yet."
+    access = getattr(user, '_idealist_access', None)
+    if access is None or access.generation != _generation:
+        access = user._idealist_access = Access(user)
+    return access
+
+def invalidate():
+    "Make every memo load again when it is next used."
+    global _generation
+    _generation = next(_generations)
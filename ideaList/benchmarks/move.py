@@ -0,0 +1,75 @@
+"""
+Benchmark of moving items as the tables grow.
+
+Run with ./manage.py test ideaList.benchmarks.move. For each size it prints
+the mean time and the number of queries of up, down, absolute and cross-list
+moves in a list of that many items, with ten times as many items in other
+lists. Both should stay flat as the size grows.
+"""
+import random
+import time
+from django import test
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from ideaList.models import List, Item, Subscription
+from ideaList.ordering import GAP
+from ideaList.views import move_object
+
+SIZES = (10, 100, 1000, 10000)
+ROUNDS = 20
+
+class MoveBenchmark(test.TestCase):
+    def setUp(self):
+        self.u = User.objects.create_user('bench', 'bench@example.com', 'x')
+
+    def make_list(self, name, size):
+        l = List.objects.create(name=name, owner=self.u)
+        Subscription.objects.create(list=l, user=self.u)
+        Item.objects.bulk_create([Item(list=l, text='item %d' % n,
+            position=n*GAP) for n in range(size)])
+        return l
+
+    def measure(self, size, moves):
+        "Return the mean time and the queries of the moves."
+        timings, queries = [], None
+        for n in range(ROUNDS):
+            source, where, list_id = moves(n)
+            item_id = Item.nontrash.filter(list=source).values_list(
+                    'id', flat=True)[size//2]
+            with CaptureQueriesContext(connection) as ctx:
+                start = time.perf_counter()
+                move_object(self.u, Item, item_id, where, list_id)
+                timings.append(time.perf_counter() - start)
+            queries = len(ctx.captured_queries)
+        return sum(timings) / len(timings), queries
+
+    def test_move_latency_is_flat(self):
+        # Each returns the list to move the middle item of, where and list_id
+        cases = (
+            ('up', lambda n: (self.l, 'up', None)),
+            ('down', lambda n: (self.l, 'down', None)),
+            ('index', lambda n: (self.l, random.randrange(self.size), None)),
+            ('other list', lambda n: n % 2 == 0 # Back and forth
+                and (self.l, random.randrange(self.size), self.l2.id)
+                or (self.l2, random.randrange(self.size), self.l.id)),
+        )
+        results = {}
+        for size in SIZES:
+            self.size = size
+            self.l = self.make_list('bench %d' % size, size)
+            self.l2 = self.make_list('bench %d other' % size, size)
+            for n in range(8):
+                self.make_list('filler %d %d' % (size, n), size)
+            for name, moves in cases:
+                results[name, size] = self.measure(size, moves)
+
+        print('\n%-12s' % 'move' + ''.join(['%18d' % s for s in SIZES]))
+        for name, moves in cases:
+            print('%-12s' % name + ''.join(['%11.2f ms %3dq' % (
+                results[name, s][0]*1000, results[name, s][1])
+                for s in SIZES]))
+        for name, moves in cases:
+            counts = set([results[name, s][1] for s in SIZES])
+            self.assertEqual(len(counts), 1,
+                    'query count of %s moves grows with size' % name)
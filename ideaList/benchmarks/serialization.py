@@ -0,0 +1,70 @@
+"""
+Benchmark of building and serializing a large state.
+
+Run with ./manage.py test ideaList.benchmarks.serialization. On a synthetic
+state of LISTS subscribed lists of ITEMS items each, it prints the mean time
+of building the state from model instances with as_dict and encoding it with
+the standard json module (as the views used to), of make_state, and of
+encoding its result with each backend of ideaList.fastjson.
+"""
+import json
+import time
+from django import test
+from django.contrib.auth.models import User
+from ideaList import fastjson
+from ideaList.models import List, Item, Subscription
+from ideaList.ordering import GAP
+from ideaList.views import make_state
+
+LISTS = 20
+ITEMS = 500
+ROUNDS = 5
+
+def state_from_instances(user):
+    "Build the state of make_state via model instances and as_dict."
+    subs = list(Subscription.nontrash.filter(user=user,
+        list__trashed_at__isnull=True).select_related('list').order_by())
+    items_by_list = dict([(s.list_id, []) for s in subs])
+    for i in Item.nontrash.filter(list__in=list(items_by_list)).order_by():
+        items_by_list[i.list_id].append(i)
+    return {'subscriptions': dict([(s.id, s.as_dict(
+            lst=s.list.as_dict(items=items_by_list[s.list_id])))
+            for s in subs])}
+
+def mean_time(f):
+    timings = []
+    for n in range(ROUNDS):
+        start = time.perf_counter()
+        f()
+        timings.append(time.perf_counter() - start)
+    return sum(timings) / len(timings)
+
+class SerializationBenchmark(test.TestCase):
+    def setUp(self):
+        self.u = User.objects.create_user('bench', 'bench@example.com', 'x')
+        for n in range(LISTS):
+            l = List.objects.create(name='bench %d' % n, owner=self.u)
+            Subscription.objects.create(list=l, user=self.u)
+            Item.objects.bulk_create([Item(list=l, text='item %d ä' % m,
+                url=m % 3 and 'http://example.com/%d' % m or '',
+                important=m % 7 == 0, position=m*GAP)
+                for m in range(ITEMS)])
+
+    def test_serialization(self):
+        state = make_state(self.u)
+        self.assertEqual(state, state_from_instances(self.u))
+        encoded = dict([(name, dumps(state))
+            for name, (dumps, loads) in fastjson.BACKENDS.items()])
+        self.assertEqual(len(set(encoded.values())), 1,
+                'backends encode differently')
+
+        results = [
+            ('as_dict + json', mean_time(
+                lambda: json.dumps(state_from_instances(self.u)))),
+            ('make_state', mean_time(lambda: make_state(self.u))),
+        ] + [('encode %s' % name, mean_time(lambda: dumps(state)))
+            for name, (dumps, loads) in sorted(fastjson.BACKENDS.items())]
+        print('\n%d lists of %d items, %d bytes:' % (LISTS, ITEMS,
+            len(encoded[fastjson.BACKEND])))
+        for name, seconds in results:
+            print('%-16s %9.2f ms' % (name, seconds*1000))
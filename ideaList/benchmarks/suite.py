@@ -0,0 +1,212 @@
+"""
+Benchmark suite of the main views and models, compared against a baseline.
+
+Run with ./manage.py test ideaList.benchmarks.suite. For each of SIZES it
+generates a user with LISTS subscribed lists of that many items (and as many
+item frequencies) and measures every operation in OPERATIONS: the median wall
+time of ROUNDS runs, the number of queries and the peak memory allocated
+during one run (with tracemalloc). The results are printed and compared with
+the JSON baseline in BASELINE. A time or allocation that exceeds its baseline
+by more than THRESHOLD (and by more than noise) and any query count that
+exceeds its baseline at all is flagged as a regression, and the benchmark
+fails if there are any.
+
+Times depend on the machine, so record the baseline on the machine you compare
+on by running with IDEALIST_BENCHMARK_SAVE=1, which writes the results to
+BASELINE. IDEALIST_BENCHMARK_BASELINE and IDEALIST_BENCHMARK_THRESHOLD in the
+environment override BASELINE and THRESHOLD.
+"""
+import json
+import os
+import random
+import statistics
+import time
+import tracemalloc
+from django import test
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.db import connection
+from ideaList import versions
+from ideaList.models import List, Item, ItemFrequency, Subscription
+from ideaList.ordering import GAP
+from ideaList.views import make_state
+
+SIZES = (10, 100, 1000)
+LISTS = 5
+ROUNDS = 10
+OPERATIONS = ('make_state', 'get_state', 'move_item', 'remove_items',
+        'set_item_importances', 'get_frequents', 'undelete', 'add_item')
+
+BASELINE = os.environ.get('IDEALIST_BENCHMARK_BASELINE',
+        os.path.join(os.path.dirname(__file__), 'baseline.json'))
+# How much worse than the baseline a result may be (0.5 is 50 %). Times of
+# whole runs on a busy machine easily differ by a third.
+THRESHOLD = float(os.environ.get('IDEALIST_BENCHMARK_THRESHOLD', 0.5))
+# Differences up to these are noise, whatever the threshold
+NOISE = {'ms': 1.0, 'kb': 32, 'queries': 0}
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """Return the results that regressed from baseline as messages. Both are
+    dicts of {operation: {size: {metric: value}}}."""
+    regressions = []
+    for name, sizes in sorted(results.items()):
+        for size, result in sorted(sizes.items(), key=lambda s: int(s[0])):
+            base = baseline.get(name, {}).get(size)
+            if base is None:
+                continue
+            for metric, noise in sorted(NOISE.items()):
+                limit = base[metric] if metric == 'queries' else max(
+                        base[metric] * (1 + threshold), base[metric] + noise)
+                if result[metric] > limit:
+                    regressions.append('%s of %s items: %s %s -> %s' % (name,
+                        size, metric, base[metric], result[metric]))
+    return regressions
+
+class QueryCounter(object):
+    """Database execute wrapper that counts the queries. Unlike
+    CaptureQueriesContext it also counts those of test client requests, which
+    reset the query log."""
+    def __init__(self):
+        self.count = 0
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+class BenchmarkSuite(test.TestCase):
+    def make_dataset(self, size):
+        "Make a user with LISTS lists of size items and frequencies each."
+        self.u = User.objects.create_user('bench%d' % size,
+                'bench@example.com', 'x')
+        self.lists = []
+        for n in range(LISTS):
+            l = List.objects.create(name='bench %d %d' % (size, n),
+                    owner=self.u)
+            Subscription.objects.create(list=l, user=self.u)
+            Item.objects.bulk_create([Item(list=l, text='item %d' % m,
+                url=m % 3 and 'http://example.com/%d' % m or '',
+                important=m % 7 == 0, position=m*GAP) for m in range(size)])
+            ItemFrequency.objects.bulk_create([ItemFrequency(list=l,
+                text='item %d' % m, frequency=size - m) for m in range(size)])
+            # Something to undelete
+            Item.objects.filter(pk__in=Item.objects.filter(list=l)
+                    .values_list('pk', flat=True)[:size//10]).trash()
+            self.lists.append(l)
+        self.size = size
+        self.client.force_login(self.u)
+
+    def item_ids(self, count):
+        "Return the ids of count nontrashed items from the middle of a list."
+        start = max(0, (self.size - self.size//10 - count) // 2)
+        return list(Item.nontrash.filter(list=self.lists[0])
+                .values_list('id', flat=True)[start:start+count])
+
+    def post(self, view, data):
+        return self.client.post(reverse('ideaList.views.'+view), data,
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+    # Each returns the run of round n and what to undo after it (or None)
+    def op_make_state(self, n):
+        return lambda: make_state(self.u), None
+
+    def op_get_state(self, n):
+        versions.bump_users([self.u.id]) # So that the state isn't cached
+        return lambda: self.client.get(
+                reverse('ideaList.views.get_state')), None
+
+    def op_move_item(self, n):
+        item_id = self.item_ids(1)[0]
+        where = random.randrange(self.size - self.size//10)
+        return lambda: self.post('move_item',
+                {'item_id': item_id, 'where': where}), None
+
+    def op_remove_items(self, n):
+        item_ids = self.item_ids(10)
+        return (lambda: self.post('remove_items', {'item_ids': item_ids}),
+                lambda: Item.trash.filter(pk__in=item_ids).restore())
+
+    def op_set_item_importances(self, n):
+        key = n % 2 and 'unimportant_item_ids' or 'important_item_ids'
+        item_ids = self.item_ids(10)
+        return lambda: self.post('set_item_importances',
+                {key: item_ids}), None
+
+    def op_get_frequents(self, n):
+        versions.bump_users([self.u.id])
+        return lambda: self.client.get(
+                reverse('ideaList.views.get_frequents')), None
+
+    def op_undelete(self, n):
+        return lambda: self.client.get(reverse('ideaList.views.undelete')), \
+                None
+
+    def op_add_item(self, n):
+        return lambda: self.post('add_item_login_required',
+                {'list': self.lists[0].id, 'text': 'new item %d' % n,
+                    'position': 0}), None
+
+    def measure(self, op):
+        """Return the median time, the queries and the peak allocation of op's
+        rounds. The first round warms up and the second one is counted."""
+        timings = []
+        for n in range(ROUNDS + 2):
+            run, undo = op(n)
+            if n == 1:
+                queries = QueryCounter()
+                tracemalloc.start()
+                with connection.execute_wrapper(queries):
+                    response = run()
+                kb = tracemalloc.get_traced_memory()[1] / 1024
+                tracemalloc.stop()
+                self.assertEqual(getattr(response, 'status_code', 200), 200)
+            else:
+                start = time.perf_counter()
+                run()
+                if n:
+                    timings.append(time.perf_counter() - start)
+            if undo is not None:
+                undo()
+        return {'ms': round(statistics.median(timings) * 1000, 2),
+                'queries': queries.count, 'kb': round(kb)}
+
+    def test_suite(self):
+        results = dict([(name, {}) for name in OPERATIONS])
+        for size in SIZES:
+            self.make_dataset(size)
+            for name in OPERATIONS:
+                results[name][str(size)] = self.measure(
+                        getattr(self, 'op_'+name))
+
+        print('\n%-22s' % 'operation' + ''.join(['%24d' % s for s in SIZES]))
+        for name in OPERATIONS:
+            print('%-22s' % name + ''.join(['%9.2f ms %3dq %6d kB' % (
+                results[name][str(s)]['ms'], results[name][str(s)]['queries'],
+                results[name][str(s)]['kb']) for s in SIZES]))
+
+        if os.environ.get('IDEALIST_BENCHMARK_SAVE'):
+            with open(BASELINE, 'w') as f:
+                json.dump(results, f, indent=1, sort_keys=True)
+            print('Baseline written to %s' % BASELINE)
+            return
+        try:
+            with open(BASELINE) as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            print('No baseline in %s to compare with' % BASELINE)
+            return
+        regressions = compare(results, baseline)
+        for regression in regressions:
+            print('REGRESSION: ' + regression)
+        self.assertEqual(regressions, [], '%d results regressed more than '
+                '%d %% from the baseline' % (len(regressions), THRESHOLD*100))
+
+class CompareTest(test.SimpleTestCase):
+    def test_compare(self):
+        baseline = {'get_state': {'10': {'ms': 10, 'queries': 3, 'kb': 100},
+            '100': {'ms': 20, 'queries': 3, 'kb': 1000}}}
+        results = {'get_state': {'10': {'ms': 10.9, 'queries': 3, 'kb': 150},
+            '100': {'ms': 30, 'queries': 4, 'kb': 1200}},
+            'new': {'10': {'ms': 1, 'queries': 1, 'kb': 1}}}
+        self.assertEqual(compare(results, baseline, 0.25), [
+            'get_state of 10 items: kb 100 -> 150',
+            'get_state of 100 items: ms 20 -> 30',
+            'get_state of 100 items: queries 3 -> 4'])
@@ -0,0 +1,172 @@
+"""
+Compression of JSON and HTML responses with brotli (if installed) or gzip.
+
+Most of a state response is the user's state, which stays the same until it
+changes, so its compressed bytes are cached. A view marks the part of its
+content that recurs with reusable(response, length), and the compressed bytes
+of that part are cached under a hash of it:
+
+- If the whole content recurs (get_frequents), the whole compressed body is
+  cached, with either encoding.
+- If only a prefix recurs (the state before the version and msg of each
+  response), it is compressed as deflate blocks that end with a full flush, so
+  that the blocks of the rest can be appended by a fresh compressor. The gzip
+  CRC of the prefix is cached with it and extended by the rest. Brotli streams
+  can't be joined like this, so such responses are sent with gzip.
+
+Streamed responses are compressed as they are sent.
+"""
+import hashlib
+import struct
+import zlib
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Smaller responses aren't worth compressing
+MIN_SIZE = getattr(settings, 'IDEALIST_COMPRESSION_MIN_SIZE', 200)
+GZIP_LEVEL = getattr(settings, 'IDEALIST_GZIP_LEVEL', 6)
+BROTLI_QUALITY = getattr(settings, 'IDEALIST_BROTLI_QUALITY', 5)
+# How long compressed bodies are cached (in seconds)
+CACHE_TIMEOUT = getattr(settings, 'IDEALIST_COMPRESSION_CACHE_TIMEOUT', 3600)
+CONTENT_TYPES = ('application/json', 'text/html')
+
+# Header of a gzip member without a file name or time
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+def reusable(response, length=None):
+    """Mark the first length bytes of response's content (by default all of
+    it) as ones that recur in other responses, so their compressed bytes are
+    cached."""
+    response.reusable_length = len(response.content) if length is None \
+            else length
+    return response
+
+def accepted_encodings(accept_encoding):
+    "Return the content codings allowed by an Accept-Encoding header."
+    encodings = set()
+    for part in accept_encoding.split(','):
+        params = [p.strip() for p in part.split(';')]
+        try:
+            q = float([p[2:] for p in params[1:] if p.startswith('q=')][0])
+        except (IndexError, ValueError):
+            q = 1
+        if params[0] and q > 0:
+            encodings.add(params[0].lower())
+    return encodings
+
+def deflate(data, flush=zlib.Z_FINISH):
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(flush)
+
+def gzip_compress(data):
+    return GZIP_HEADER + deflate(data) + struct.pack('<LL',
+            zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+
+def brotli_compress(data):
+    return brotli.compress(data, mode=brotli.MODE_TEXT,
+            quality=BROTLI_QUALITY)
+
+COMPRESSORS = {'gzip': gzip_compress}
+if brotli is not None:
+    COMPRESSORS['br'] = brotli_compress
+
+def cache_key(kind, data):
+    return 'ideaList:compressed:%s:%s' % (kind, hashlib.blake2b(data,
+        digest_size=20).hexdigest())
+
+def compress_whole(data, encoding):
+    "Compress data with encoding, caching the result under a hash of data."
+    key = cache_key(encoding, data)
+    compressed = cache.get(key)
+    if compressed is None:
+        compressed = COMPRESSORS[encoding](data)
+        cache.set(key, compressed, CACHE_TIMEOUT)
+    return compressed
+
+def gzip_with_prefix(data, length):
+    """Return data gzipped, reusing the cached deflate blocks and CRC of its
+    first length bytes."""
+    prefix = data[:length]
+    key = cache_key('deflate-prefix', prefix)
+    cached = cache.get(key)
+    if cached is None:
+        cached = (deflate(prefix, zlib.Z_FULL_FLUSH), zlib.crc32(prefix))
+        cache.set(key, cached, CACHE_TIMEOUT)
+    blocks, crc = cached
+    rest = data[length:]
+    return GZIP_HEADER + blocks + deflate(rest) + struct.pack('<LL',
+            zlib.crc32(rest, crc) & 0xffffffff, len(data) & 0xffffffff)
+
+def compress_sequence(chunks, encoding):
+    "Yield the compressed bytes of a streamed content as they come."
+    if encoding == 'br':
+        compressor = brotli.Compressor(mode=brotli.MODE_TEXT,
+                quality=BROTLI_QUALITY)
+        process, finish = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED,
+                16 + zlib.MAX_WBITS) # With the gzip header and trailer
+        process, finish = compressor.compress, compressor.flush
+    for chunk in chunks:
+        data = process(chunk)
+        if data:
+            yield data
+    yield finish()
+
+def compress_response(request, response):
+    "Compress response's content in place if the client accepts it."
+    if response.has_header('Content-Encoding') or \
+            response.get('Content-Type', '').split(';')[0] \
+            not in CONTENT_TYPES:
+        return response
+    patch_vary_headers(response, ['Accept-Encoding'])
+    if not response.streaming and len(response.content) < MIN_SIZE:
+        return response
+    accepted = accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    encodings = [e for e in ('br', 'gzip') if e in COMPRESSORS and e in accepted]
+    if not encodings:
+        return response
+
+    if response.streaming:
+        encoding = encodings[0]
+        response.streaming_content = compress_sequence(
+                response.streaming_content, encoding)
+        if response.has_header('Content-Length'):
+            del response['Content-Length']
+    else:
+        content = response.content
+        length = getattr(response, 'reusable_length', 0)
+        if length >= len(content):
+            encoding = encodings[0]
+            compressed = compress_whole(content, encoding)
+        elif length and 'gzip' in encodings:
+            encoding = 'gzip'
+            compressed = gzip_with_prefix(content, length)
+        else:
+            encoding = encodings[0]
+            compressed = COMPRESSORS[encoding](content)
+        if len(compressed) >= len(content):
+            return response
+        response.content = compressed
+        response['Content-Length'] = str(len(compressed))
+
+    response['Content-Encoding'] = encoding
+    # The compressed body is not byte for byte the one the ETag was made for
+    if response.has_header('ETag') and response['ETag'].startswith('"'):
+        response['ETag'] = 'W/' + response['ETag']
+    return response
+
+class CompressionMiddleware(MiddlewareMixin):
+    """
+    Compresses JSON and HTML responses, see the module docstring. Must be
+    above any middleware that changes the content.
+    """
+    def process_response(self, request, response):
+        return compress_response(request, response)
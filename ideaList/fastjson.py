@@ -0,0 +1,31 @@
+"""
+JSON encoding and decoding of all AJAX responses and requests.
+
+dumps returns UTF-8 bytes that can be written to a response as is. The backend
+is picked when the module is first imported: orjson if it is installed (or the
+one named by the IDEALIST_JSON_BACKEND setting), else the standard library.
+Both produce the same bytes for the data the views send: compact separators,
+non-ASCII characters as is and integer dict keys as strings.
+"""
+import json
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, separators=(',', ':'),
+            ensure_ascii=False).encode('utf-8')
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+BACKENDS = {'stdlib': (_stdlib_dumps, json.loads)}
+if orjson is not None:
+    BACKENDS['orjson'] = (_orjson_dumps, orjson.loads)
+
+BACKEND = getattr(settings, 'IDEALIST_JSON_BACKEND',
+        'orjson' if orjson is not None else 'stdlib')
+dumps, loads = BACKENDS[BACKEND]
@@ -14,93 +14,86 @@ const alexaListIdToIdeaListListId = {
     'YW16bjEuYWNjb3VudC5BR01UTUtVS1ZWNldMUFNXRFZRN0dDV1RaQkxBLVRBU0s=': 67, // To-do <-> TODO
 }
 
+// Resolves with the response's status code and body
+const request = (options, body) => new Promise((resolve, reject) => {
+    const req = https.request(options, res => {
+        let data = ''
+        res.on('data', chunk => {
+            data += chunk
+        })
+        res.on('end', () => resolve({statusCode: res.statusCode, body: data}))
+    })
+    req.on('error', reject)
+    if (body) {
+        req.write(body)
+    }
+    req.end()
+})
+
 exports.handler = async (event, context) => {
     console.log("Jevent", JSON.stringify(event, null, 2))
+    if (event.request.type !== 'AlexaHouseholdListEvent.ItemsCreated') {
+        throw 'Unsupported request type ' + event.request.type
+    }
     const listId = event.request.body.listId
-    const listItemId = event.request.body.listItemIds[0]
+    const listItemIds = event.request.body.listItemIds
     const apiAccessToken = event.context.System.apiAccessToken
     const alexaApiHost = url.parse(event.context.System.apiEndpoint).host
-
-    return new Promise((resolve, reject) => {
-        if (event.request.type !== 'AlexaHouseholdListEvent.ItemsCreated') {
-            reject('Unsupported request type ' + event.request.type)
+    const alexaItemOptions = (method, listItemId) => ({
+        method: method,
+        host: alexaApiHost,
+        path: `/v2/householdlists/${listId}/items/${listItemId}`,
+        headers: {
+            "Authorization": `Bearer ${apiAccessToken}`
         }
+    })
 
-        const getItemOptions = {
-            host: alexaApiHost,
-            path: `/v2/householdlists/${listId}/items/${listItemId}`,
+    let items
+    try {
+        items = await Promise.all(listItemIds.map(async listItemId => {
+            const res = await request(alexaItemOptions('GET', listItemId))
+            return JSON.parse(res.body)
+        }))
+    } catch (err) {
+        console.log("Failed to get items: " + err)
+        throw "Failed to get items: " + err
+    }
+    console.log("Got dada", JSON.stringify(items, null, 2))
+
+    // All items in one request, which ideaList queues and answers with 202
+    const postData = querystring.encode({
+        items: JSON.stringify(items.map(item => ({
+            list: alexaListIdToIdeaListListId[listId] || 1,
+            text: item.value
+        })))
+    })
+    try {
+        const res = await request({
+            method: 'POST',
+            hostname: 'vdb.re',
+            path: '/d/ideaList/alexa/AEKA5AEFAHHEEJA6HEI7/add_items/',
             headers: {
-                "Authorization": `Bearer ${apiAccessToken}`
+                'Content-Type': 'application/x-www-form-urlencoded',
+                'Content-Length': Buffer.byteLength(postData)
             }
+        }, postData)
+        console.log(`Posted ${postData} to ideaList, statusCode=${res.statusCode}`)
+        if (res.statusCode !== 202) {
+            throw 'statusCode ' + res.statusCode
         }
+    } catch (e) {
+        console.log('Error posting to ideaList', e)
+        throw 'Error posting to ideaList ' + e
+    }
 
-        https.get(getItemOptions, res => {
-            let itemData = ''
-            res.on('data', (chunk) => {
-                itemData += chunk
-            })
-            res.on('end', () => {
-                const item = JSON.parse(itemData)
-                console.log("Got dada", JSON.stringify(item, null, 2))
-
-                const postData = querystring.encode({
-                    list: alexaListIdToIdeaListListId[listId] || 1,
-                    text: item.value,
-                    position: 0
-                })
-                const postToIdeaListOptions = {
-                    method: 'POST',
-                    hostname: 'vdb.re',
-                    path: '/d/ideaList/alexa/AEKA5AEFAHHEEJA6HEI7/add_item/',
-                    headers: {
-                        'Content-Type': 'application/x-www-form-urlencoded',
-                        'Content-Length': postData.length
-                    }
-                }
-                const postToIdeaListReq = https.request(postToIdeaListOptions, res => {
-                    console.log(`Posted ${postData} to ideaList, statusCode=${res.statusCode}`)
-
-                    const deleteFromAlexaList = {
-                        method: 'DELETE',
-                        host: alexaApiHost,
-                        path: `/v2/householdlists/${listId}/items/${listItemId}`,
-                        headers: {
-                            "Authorization": `Bearer ${apiAccessToken}`
-                        }
-                    }
-                    const deleteFromAlexaListReq = https.request(deleteFromAlexaList, res => {
-                        console.log(`Deleted ${listItemId} from Alexa list ${listId}, statusCode=${res.statusCode}`)
-                        let deleteResponseBody = ''
-                        res.on('data', chunk => {
-                            deleteResponseBody += chunk
-                        })
-                        res.on('end', () => {
-                            console.log("Delete response body", deleteResponseBody)
-                            resolve('Jesh')
-                        })
-
-                    })
-                    deleteFromAlexaListReq.on('error', (err) => {
-                        console.log("Failed to delete item: " + err)
-                        resolve("Failed to delete item: " + err) // ignore error on delete
-                    })
-                    deleteFromAlexaListReq.end()
-
-
-                })
-                postToIdeaListReq.on('error', e => {
-                    console.log('Error posting to ideaList', e)
-                    reject('Error posting to ideaList ' + e)
-                })
-
-                postToIdeaListReq.write(postData)
-                postToIdeaListReq.end()
-            })
-
-        }).on('error', (err) => {
-            console.log("Failed to get item: " + err)
-            reject("Failed to get item: " + err)
-        })
-    })
+    await Promise.all(listItemIds.map(async listItemId => {
+        try {
+            const res = await request(alexaItemOptions('DELETE', listItemId))
+            console.log(`Deleted ${listItemId} from Alexa list ${listId}, statusCode=${res.statusCode}`)
+            console.log("Delete response body", res.body)
+        } catch (err) {
+            console.log("Failed to delete item: " + err) // ignore error on delete
+        }
+    }))
+    return 'Jesh'
 }
-
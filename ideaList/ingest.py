@@ -0,0 +1,157 @@
+"""
+Queued, batched adding of items from voice assistants (see ideaList-proxy).
+
+The add_items_alexa view only checks the request and hands its items to
+enqueue, which writes them to a file of their own in QUEUE_DIR and returns, so
+the request never waits for the database. The queued items are added by flush,
+which takes all files queued so far, groups their items by list and adds the
+items of each list in one transaction with one bulk insert: a burst like "add
+milk, eggs and bread" locks the list once instead of once per item.
+
+A flush is started in a thread of the enqueuing process DELAY seconds after
+the first item of a burst comes in. Files that are left behind, e.g. if the
+process dies before its flush, are added by the next flush or by running
+./manage.py idealist_ingest (from cron). As soon as the items of a list are
+committed they are removed from the files, and emptied files are deleted, so
+an interrupted flush may add the items of the list it was on twice but never
+loses any. The items of a list that can't be added are logged and moved aside
+to a file of their own ending with FAILED_SUFFIX, so that they neither block
+the queue nor make the lists added with them be added again.
+"""
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+logger = logging.getLogger(__name__)
+
+# Where the queued items are kept. Must be on a persistent file system that is
+# shared by all processes of the site.
+QUEUE_DIR = getattr(settings, 'IDEALIST_INGEST_DIR',
+        os.path.join(tempfile.gettempdir(), 'ideaList-ingest'))
+# Seconds from the first item of a burst to the flush that adds it
+DELAY = getattr(settings, 'IDEALIST_INGEST_DELAY', 2)
+# Ending of the files of items that couldn't be added, which flush ignores
+FAILED_SUFFIX = '.failed'
+
+def new_name():
+    return '%020d-%s' % (time.time_ns(), uuid.uuid4().hex)
+
+def write_items(path, items):
+    """Write the (list_id, text) pairs to path durably. Readers see either
+    the old file or the whole new one."""
+    tmp_path = path+'.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(items, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def enqueue(items):
+    """Queue the given (list_id, text) pairs durably and schedule a flush.
+    Items of a list are added in the given order."""
+    os.makedirs(QUEUE_DIR, exist_ok=True)
+    write_items(os.path.join(QUEUE_DIR, new_name()+'.json'), items)
+    schedule_flush()
+
+_timer = None
+_timer_lock = threading.Lock()
+
+def schedule_flush():
+    "Start a flush in DELAY seconds unless one is pending already."
+    global _timer
+    with _timer_lock:
+        if _timer is None:
+            _timer = threading.Timer(DELAY, _run_scheduled_flush)
+            _timer.daemon = True
+            _timer.start()
+
+def _run_scheduled_flush():
+    global _timer
+    with _timer_lock:
+        # Items queued from now on schedule a flush of their own
+        _timer = None
+    try:
+        flush()
+    except Exception:
+        logger.exception('Flushing queued items failed')
+    finally:
+        close_old_connections()
+
+def queued_paths(suffix='.json'):
+    """Return the paths of the queued files, or of the files with the given
+    suffix (e.g. FAILED_SUFFIX), oldest first."""
+    try:
+        names = os.listdir(QUEUE_DIR)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(QUEUE_DIR, name)
+            for name in sorted(names) if name.endswith(suffix)]
+
+def flush():
+    """
+    Add all queued items, one transaction per list, and return how many were
+    added. Only one flush runs at a time on QUEUE_DIR; any other waits for it
+    and then adds what was queued meanwhile.
+    """
+    os.makedirs(QUEUE_DIR, exist_ok=True)
+    added = 0
+    with open(os.path.join(QUEUE_DIR, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        items_by_path = OrderedDict()
+        texts_by_list = OrderedDict()
+        for path in queued_paths():
+            with open(path) as f:
+                items_by_path[path] = json.load(f)
+            for list_id, text in items_by_path[path]:
+                texts_by_list.setdefault(list_id, []).append(text)
+        for list_id, texts in texts_by_list.items():
+            try:
+                added += add_items(list_id, texts)
+            except Exception:
+                failed_path = os.path.join(QUEUE_DIR,
+                        new_name()+FAILED_SUFFIX)
+                logger.exception('Adding %d queued items to list %s failed, '
+                        'moved them to %s', len(texts), list_id, failed_path)
+                write_items(failed_path, [[list_id, text] for text in texts])
+            dequeue(items_by_path, list_id)
+    return added
+
+def dequeue(items_by_path, list_id):
+    """Remove the items of list_id from the queued files in items_by_path, a
+    dict of their items by path, deleting the files that are left empty."""
+    for path, items in list(items_by_path.items()):
+        left = [item for item in items if item[0] != list_id]
+        if len(left) == len(items):
+            continue
+        if left:
+            write_items(path, left)
+            items_by_path[path] = left
+        else:
+            os.remove(path)
+            del items_by_path[path]
+
+def add_items(list_id, texts):
+    """Add items with the given texts on top of list_id in one transaction,
+    the last text on top. Return how many were added."""
+    from ideaList import versions
+    from ideaList.models import Item, ItemFrequency
+    with transaction.atomic():
+        if not Item(list_id=list_id).lock_collections():
+            logger.warning('Dropped %d queued items of missing list %s',
+                    len(texts), list_id)
+            return 0
+        Item.create_on_top([Item(list_id=list_id, text=text)
+            for text in texts])
+        # Bulk inserts send no post_save, so do what its receivers would
+        ItemFrequency.objects.increment_many([(list_id, text)
+            for text in texts])
+        versions.bump_lists([list_id])
+    return len(texts)
@@ -0,0 +1,120 @@
+"""
+Nightly cleanup: purge old trash and prune infrequent ItemFrequencies.
+
+Every step works through the rows in chunks in primary key order, each chunk
+in a transaction of its own, so locks are only held briefly. The run can be
+interrupted at any point: committed chunks stay done and running the command
+again simply continues with what is left. The pruning of a long run can also
+be resumed with --after-list from the last list id it reported.
+"""
+from datetime import datetime, timedelta
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.db.models import BooleanField, ExpressionWrapper, F, Q, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+from ideaList.models import Item, List, ItemFrequency
+
+class Command(BaseCommand):
+    help = ('Purge old trashed items and lists and prune the infrequent '
+            'item frequencies of every list.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                help='Only report what would be deleted.')
+        parser.add_argument('--trash-days', type=int, default=7,
+                help='Purge items and lists trashed this many days ago.')
+        parser.add_argument('--frequency-days', type=int, default=365,
+                help='Frequencies of 1 unchanged for this many days are old.')
+        parser.add_argument('--min-frequents', type=int, default=200,
+                help='How many frequencies to keep per list even if old.')
+        parser.add_argument('--max-frequents', type=int, default=500,
+                help='How many frequencies to keep per list at most.')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                help='How many rows or lists to handle per transaction.')
+        parser.add_argument('--after-list', type=int, default=0,
+                help='Resume pruning frequencies after this list id.')
+
+    def handle(self, **options):
+        self.dry_run = options['dry_run']
+        self.chunk_size = options['chunk_size']
+        self.verbosity = options['verbosity']
+        cutoff = datetime.now() - timedelta(days=options['trash_days'])
+        for model in (Item, List):
+            self.purge_trash(model, cutoff)
+        self.prune_frequencies(
+                timezone.now() - timedelta(days=options['frequency_days']),
+                options['min_frequents'], options['max_frequents'],
+                options['after_list'])
+
+    def report(self, msg, level=1):
+        if self.verbosity >= level:
+            self.stdout.write(('[dry run] ' if self.dry_run else '') + msg)
+
+    def purge_trash(self, model, cutoff):
+        "Purge the objects of model trashed before cutoff."
+        name = model._meta.verbose_name_plural
+        old_trash = model.trash.filter(trashed_at__lt=cutoff).order_by('pk')
+        last, total = 0, 0
+        while True:
+            with transaction.atomic():
+                pks = list(old_trash.filter(pk__gt=last)
+                        .values_list('pk', flat=True)[:self.chunk_size])
+                if not pks:
+                    break
+                if not self.dry_run:
+                    model.trash.filter(pk__in=pks).purge()
+            last = pks[-1]
+            total += len(pks)
+            self.report('Purged %d %s' % (total, name), 2)
+        self.report('Purged %d %s in total' % (total, name))
+
+    def prune_frequencies(self, cutoff, min_kept, max_kept, after_list=0):
+        """
+        Delete the ItemFrequencies that rank past max_kept in their list and
+        those of frequency 1 unchanged since cutoff that rank past min_kept.
+        The rank goes by frequency and then last change, so the old rows of
+        frequency 1 are the last ones of their list and deleting them never
+        moves the rest past max_kept. Each chunk of lists is ranked with one
+        windowed query, and its prunable rows are deleted chunk_size at a time.
+        Rows that change after the ranking are left for the next run.
+        """
+        list_ids = List.objects.order_by('pk').values_list('pk', flat=True)
+        last, total = after_list, 0
+        while True:
+            chunk = list(list_ids.filter(pk__gt=last)[:self.chunk_size])
+            if not chunk:
+                break
+            ranked_at = timezone.now()
+            pks = self.prunable_frequencies(chunk[0], chunk[-1], cutoff,
+                    min_kept, max_kept)
+            for start in range(0, len(pks), self.chunk_size):
+                if self.dry_run:
+                    total += len(pks[start:start+self.chunk_size])
+                    continue
+                with transaction.atomic():
+                    total += ItemFrequency.objects.filter(
+                            pk__in=pks[start:start+self.chunk_size],
+                            last_changed__lt=ranked_at).delete()[0]
+            last = chunk[-1]
+            self.report('Pruned %d item frequencies, lists up to id %d done'
+                    % (total, last), 2)
+        self.report('Pruned %d item frequencies in total' % total)
+
+    def prunable_frequencies(self, first_list, last_list, cutoff, min_kept,
+            max_kept):
+        "Return the pks to prune of the lists between the given ids."
+        ranked = ItemFrequency.objects.filter(list__gte=first_list,
+                list__lte=last_list).order_by().annotate(
+            freq_rank=Window(RowNumber(), partition_by=[F('list_id')],
+                order_by=[F('frequency').desc(), F('last_changed').desc(),
+                    F('id').asc()]),
+            old=ExpressionWrapper(Q(frequency=1, last_changed__lt=cutoff),
+                output_field=BooleanField())) \
+            .values('id', 'freq_rank', 'old')
+        sql, params = ranked.query.sql_with_params()
+        with connections[ItemFrequency.objects.db].cursor() as cursor:
+            cursor.execute('SELECT id FROM (%s) ranked WHERE freq_rank > %%s '
+                'OR (freq_rank > %%s AND old)' % sql,
+                params + (max_kept, min_kept))
+            return [row[0] for row in cursor.fetchall()]
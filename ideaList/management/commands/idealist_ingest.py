@@ -0,0 +1,17 @@
+"""
+Add the items left in the voice assistant queue (see ideaList.ingest).
+
+The queue is normally flushed by the process that queued the items, so this
+only has work to do after a process died with items still queued. Run it e.g.
+every few minutes from cron.
+"""
+from django.core.management.base import BaseCommand
+from ideaList import ingest
+
+class Command(BaseCommand):
+    help = 'Add the queued items of voice assistants to their lists.'
+
+    def handle(self, **options):
+        added = ingest.flush()
+        if options['verbosity'] >= 1:
+            self.stdout.write('Added %d queued items' % added)
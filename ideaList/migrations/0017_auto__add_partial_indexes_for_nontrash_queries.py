@@ -0,0 +1,133 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+# (name, table, columns, condition) of the indexes. The partial ones only
+# cover the rows the hot queries of the views ask for; backends without
+# partial indexes get full ones instead.
+INDEXES = (
+    ('ideaList_item_nontrash_pos', 'ideaList_item', ['list_id', 'position'],
+        'trashed_at IS NULL'),
+    ('ideaList_item_trashed', 'ideaList_item', ['trashed_at'],
+        'trashed_at IS NOT NULL'),
+    ('ideaList_sub_nontrash_pos', 'ideaList_subscription',
+        ['user_id', 'position'], 'trashed_at IS NULL'),
+    ('ideaList_list_nontrash', 'ideaList_list', ['id', 'name', 'owner_id'],
+        'trashed_at IS NULL'),
+    ('ideaList_list_trashed', 'ideaList_list', ['trashed_at'],
+        'trashed_at IS NOT NULL'),
+    ('ideaList_itemfreq_list_freq', 'ideaList_itemfrequency',
+        ['list_id', 'frequency DESC'], None),
+)
+
+def applicable_indexes():
+    "Yield the indexes to create on this backend."
+    partial = db.backend_name in ('postgres', 'sqlite3')
+    for name, table, columns, condition in INDEXES:
+        if condition == 'trashed_at IS NULL' and not partial:
+            # The full indexes of 0016 and the primary key serve instead
+            continue
+        if not partial:
+            condition = None
+        yield name, table, columns, condition
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        for name, table, columns, condition in applicable_indexes():
+            columns = [' '.join([db.quote_name(c.split()[0])] + c.split()[1:])
+                    for c in columns]
+            db.execute('CREATE INDEX %s ON %s (%s)%s' % (db.quote_name(name),
+                db.quote_name(table), ', '.join(columns),
+                condition and ' WHERE '+condition or ''))
+
+
+    def backwards(self, orm):
+        for name, table, columns, condition in applicable_indexes():
+            if db.backend_name == 'mysql':
+                db.execute('DROP INDEX %s ON %s' % (db.quote_name(name),
+                    db.quote_name(table)))
+            else:
+                db.execute('DROP INDEX %s' % db.quote_name(name))
+
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'ideaList.item': {
+            'Meta': {'ordering': "['position']", 'object_name': 'Item'},
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'important': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_changed': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'list': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'items'", 'to': "orm['ideaList.List']"}),
+            'position': ('django.db.models.fields.BigIntegerField', [], {'default': '-1'}),
+            'text': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'trashed_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'url': ('django.db.models.fields.URLField', [], {'default': "''", 'max_length': '200', 'blank': 'True'})
+        },
+        'ideaList.itemfrequency': {
+            'Meta': {'ordering': "['-frequency']", 'unique_together': "(('list', 'text'),)", 'object_name': 'ItemFrequency'},
+            'frequency': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_changed': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'list': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'itemfrequencies'", 'to': "orm['ideaList.List']"}),
+            'text': ('django.db.models.fields.CharField', [], {'max_length': '200'})
+        },
+        'ideaList.list': {
+            'Meta': {'object_name': 'List'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_changed': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '50'}),
+            'owner': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'lists_owned'", 'to': "orm['auth.User']"}),
+            'subscribers': ('django.db.models.fields.related.ManyToManyField', [], {'related_name': "'subscribed_lists'", 'symmetrical': 'False', 'through': "orm['ideaList.Subscription']", 'to': "orm['auth.User']"}),
+            'trashed_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'})
+        },
+        'ideaList.subscription': {
+            'Meta': {'ordering': "['position']", 'unique_together': "(('user', 'list'),)", 'object_name': 'Subscription'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_changed': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'list': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'subscriptions'", 'to': "orm['ideaList.List']"}),
+            'position': ('django.db.models.fields.BigIntegerField', [], {'default': '-1'}),
+            'trashed_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'subscriptions'", 'to': "orm['auth.User']"})
+        }
+    }
+
+    complete_apps = ['ideaList']
@@ -1,11 +1,27 @@
-from django.db import models
+from django.db import models, connections, transaction, IntegrityError
+from django.db.models import F, Q, Window
+from django.db.models.functions import RowNumber
+from django.conf import settings
+from django.utils import timezone
 from django.contrib.auth.models import User
-from positions.fields import PositionField
-from undelete.models import Trashable
+from undelete.models import Trashable, signals
 from django.dispatch import receiver
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
+from ideaList import access, versions, suggestions
+from ideaList.ordering import Ordered
 #from undelete.signals import pre_trash, pre_restore
 
+# Condition of the partial indexes that only cover nontrashed rows, which are
+# what nearly every query of the views asks for. Backends without partial
+# indexes (MySQL) skip them and fall back on the full ones, which the others
+# don't get so that writes maintain only one index of the columns.
+NONTRASH = Q(trashed_at__isnull=True)
+FULL_POSITION_INDEXES = \
+        not connections['default'].features.supports_partial_indexes
+# The trashed rows are indexed by trashing time for the undelete view and the
+# cleanup command
+TRASH = Q(trashed_at__isnull=False)
+
 class List(Trashable):
     """
     A list of items (:model:`ideaList.Item`).
@@ -14,6 +30,7 @@ class List(Trashable):
     owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='lists_owned')
     subscribers = models.ManyToManyField(User,
             related_name='subscribed_lists', through='Subscription')
+    last_changed = models.DateTimeField(auto_now=True)
     def nontrashed_items(self):
         return self.items.filter(trashed_at__isnull=True)
     def n_items(self):
@@ -38,7 +55,16 @@ class List(Trashable):
             val += " (trashed)"
         return val
 
-class Item(Trashable):
+    class Meta:
+        indexes = [
+            # Covers the list menu (see views.cached_list_menu)
+            models.Index(fields=['id', 'name', 'owner'], condition=NONTRASH,
+                name='ideaList_list_nontrash'),
+            models.Index(fields=['trashed_at'], condition=TRASH,
+                name='ideaList_list_trashed'),
+        ]
+
+class Item(Trashable, Ordered):
     """
     A list item (:model:`ideaList.List`)
     """
@@ -46,16 +72,26 @@ class Item(Trashable):
     text = models.CharField(max_length=200)
     url = models.URLField(blank=True, default="")
     important = models.BooleanField(default=False)
-    position = PositionField(collection='list', default=-1)
     last_changed = models.DateTimeField(auto_now=True)
     created = models.DateTimeField(auto_now_add=True)
 
+    position_collection = 'list'
+    position_filter = {'trashed_at__isnull': True}
+
     class Meta:
         ordering = ['position']
+        index_together = FULL_POSITION_INDEXES and (('list', 'position'),) \
+                or ()
+        indexes = [
+            models.Index(fields=['list', 'position'], condition=NONTRASH,
+                name='ideaList_item_nontrash_pos'),
+            models.Index(fields=['trashed_at'], condition=TRASH,
+                name='ideaList_item_trashed'),
+        ]
 
     def is_on_subscribed_list(self, user):
         "Return true iff the item is on a list that the user is subscribed to."
-        return self.list.subscription_for(user) != None
+        return self.list_id in access.for_user(user).subscribed_list_ids
 
     def as_dict(self):
         return {'id':self.id, 'list_id':self.list_id, 'text':self.text,
@@ -67,30 +103,97 @@ class Item(Trashable):
             val += " (trashed)"
         return val
 
+# How many of the most frequent texts of each list are sent for suggestions
+FREQUENTS_PER_LIST = getattr(settings, 'IDEALIST_FREQUENTS_PER_LIST', 200)
+
 class ItemFrequencyManager(models.Manager):
     def increment(self, list, text):
         """Increment the frequency of the given text if it exists or create a
-        new ItemFrequency with frequency=1. Returns the ItemFrequency object."""
-        text = text.lower().strip()
-        try:
-            freq = self.get(list=list, text=text)
-            freq.frequency += 1
-            freq.save()
-            return freq
-        except ItemFrequency.DoesNotExist:
-            return self.create(list=list, text=text, frequency=1)
+        new ItemFrequency with frequency=1, in one statement."""
+        self.increment_many([(list, text)])
+    def increment_many(self, list_texts):
+        """Increment the frequencies of the given (list, text) pairs, creating
+        the missing ones. A pair given n times is incremented by n. Where the
+        database supports it, all pairs are upserted with one statement, which
+        is atomic, so concurrent increments are never lost."""
+        counts = {}
+        for l, text in list_texts:
+            key = (getattr(l, 'pk', l), text.lower().strip())
+            counts[key] = counts.get(key, 0) + 1
+        if not counts:
+            return
+        self._upsert(counts)
+        # Keep the suggestion indexes of this process up to date
+        transaction.on_commit(lambda: suggestions.add_counts(counts),
+                using=self.db)
+    def _upsert(self, counts):
+        "Write the counts of increment_many, where possible in one statement."
+        connection = connections[self.db]
+        if connection.vendor in ('postgresql', 'sqlite'):
+            if connection.vendor == 'sqlite' and \
+                    connection.Database.sqlite_version_info < (3, 24, 0):
+                return self._increment_each(counts)
+            table = connection.ops.quote_name(self.model._meta.db_table)
+            conflict = ('ON CONFLICT (list_id, text) DO UPDATE SET '
+                'frequency = %s.frequency + EXCLUDED.frequency, '
+                'last_changed = EXCLUDED.last_changed' % table)
+        elif connection.vendor == 'mysql':
+            table = connection.ops.quote_name(self.model._meta.db_table)
+            conflict = ('ON DUPLICATE KEY UPDATE '
+                'frequency = frequency + VALUES(frequency), '
+                'last_changed = VALUES(last_changed)')
+        else:
+            return self._increment_each(counts)
+
+        now = connection.ops.adapt_datetimefield_value(timezone.now())
+        rows = [(l, text, n, now) for (l, text), n in sorted(counts.items())]
+        with connection.cursor() as cursor:
+            for start in range(0, len(rows), 500):
+                chunk = rows[start:start+500]
+                cursor.execute('INSERT INTO %s (list_id, text, frequency, '
+                    'last_changed) VALUES %s %s' % (table,
+                        ', '.join(['(%s, %s, %s, %s)'] * len(chunk)), conflict),
+                    [value for row in chunk for value in row])
+    def _increment_each(self, counts):
+        "Fallback of increment_many for databases without upserts."
+        now = timezone.now()
+        for (l, text), n in sorted(counts.items()):
+            freqs = self.filter(list=l, text=text)
+            if freqs.update(frequency=F('frequency')+n, last_changed=now):
+                continue
+            try:
+                with transaction.atomic(using=self.db):
+                    self.create(list_id=l, text=text, frequency=n)
+            except IntegrityError: # Created by a concurrent increment
+                freqs.update(frequency=F('frequency')+n, last_changed=now)
     def frequents_by_list(self, user, limit=None):
-        """ Return the most frequent texts, most frequent first"""
-        relevant_freqs = ItemFrequency.objects.filter(
-                list__in=user.subscribed_lists.filter(trashed_at__isnull=True)
-                ).order_by('-frequency')[:limit].values_list('list_id','text')
+        """
+        Return the most frequent texts of each of the user's lists by list id,
+        most frequent first. At most limit (default FREQUENTS_PER_LIST) texts
+        are returned per list, all with one windowed query.
+        """
+        if limit is None:
+            limit = FREQUENTS_PER_LIST
+        ranked = self.filter(list__in=Subscription.nontrash.filter(user=user,
+            list__trashed_at__isnull=True).values('list_id')).annotate(
+                freq_rank=Window(RowNumber(), partition_by=[F('list_id')],
+                    order_by=[F('frequency').desc(), F('id').asc()])) \
+            .values('list_id', 'text', 'freq_rank')
+        sql, params = ranked.query.sql_with_params()
         freqs_by_list = {}
-        for l, text in relevant_freqs:
-            if l not in freqs_by_list:
-                freqs_by_list[l] = [text]
-            else:
-                freqs_by_list[l].append(text)
+        with connections[self.db].cursor() as cursor:
+            cursor.execute('SELECT list_id, text FROM (%s) ranked '
+                'WHERE freq_rank <= %%s ORDER BY list_id, freq_rank' % sql,
+                params + (limit,))
+            for l, text in cursor.fetchall():
+                freqs_by_list.setdefault(l, []).append(text)
         return freqs_by_list
+    def frequents_page(self, list_id, offset, limit):
+        """Return limit texts of the list from offset on, most frequent first,
+        and whether there are more after them."""
+        texts = list(self.filter(list=list_id).order_by('-frequency', 'id')
+                .values_list('text', flat=True)[offset:offset+limit+1])
+        return texts[:limit], len(texts) > limit
 class ItemFrequency(models.Model):
     """
     Info about frequency of a certain Item text on a certain List. Used for item
@@ -105,6 +208,10 @@ class ItemFrequency(models.Model):
     class Meta:
         ordering = ['-frequency']
         unique_together = (("list","text"),)
+        indexes = [
+            models.Index(fields=['list', '-frequency'],
+                name='ideaList_itemfreq_list_freq'),
+        ]
 
     def __unicode__(self):
         return '%s: %s: %d' % (self.list.name, self.text, self.frequency)
@@ -115,18 +222,28 @@ def autoincrement_on_item_creation(sender, **kwargs):
         i = kwargs['instance']
         ItemFrequency.objects.increment(i.list, i.text)
 
-class Subscription(Trashable):
+class Subscription(Trashable, Ordered):
     """
     A user's (:model:`django.contrib.auth.User`) subscription of a certain List
     (:model:`ideaList.List`)
     """
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='subscriptions')
     list = models.ForeignKey(List, on_delete=models.CASCADE, related_name='subscriptions')
-    position = PositionField(collection='user', default=-1)
+    last_changed = models.DateTimeField(auto_now=True)
+
+    position_collection = 'user'
+    position_filter = {'trashed_at__isnull': True,
+            'list__trashed_at__isnull': True}
 
     class Meta:
         ordering = ['position']
         unique_together = (('user','list'),)
+        index_together = FULL_POSITION_INDEXES and (('user', 'position'),) \
+                or ()
+        indexes = [
+            models.Index(fields=['user', 'position'], condition=NONTRASH,
+                name='ideaList_sub_nontrash_pos'),
+        ]
 
     def as_dict(self, lst=None):
         if lst is None:
@@ -155,3 +272,59 @@ class NonTrashSubscriptionsDescriptor(User.subscriptions.__class__):
         manager.core_filters['list__trashed_at__isnull'] = True
         return manager
 User.nontrash_subscriptions = NonTrashSubscriptionsDescriptor()
+
+# Keep the state versions in ideaList.versions up to date. Trashing and
+# restoring single objects save them, so they are covered by post_save. Bulk
+# updates send no post_save, so they have receivers of their own.
+@receiver(post_save, sender=Item)
+@receiver(post_delete, sender=Item)
+def bump_version_on_item_change(sender, **kwargs):
+    versions.bump_lists([kwargs['instance'].list_id])
+
+@receiver(signals.post_bulk_trash, sender=Item)
+@receiver(signals.post_bulk_restore, sender=Item)
+def bump_version_on_item_bulk_change(sender, pks, **kwargs):
+    versions.bump_lists(Item.objects.filter(pk__in=pks).order_by()
+            .values_list('list_id', flat=True).distinct())
+
+@receiver(post_save, sender=List)
+@receiver(post_delete, sender=List)
+def bump_version_on_list_change(sender, **kwargs):
+    versions.bump_list_menu()
+    versions.bump_lists([kwargs['instance'].id])
+
+@receiver(signals.post_bulk_trash, sender=List)
+@receiver(signals.post_bulk_restore, sender=List)
+def bump_version_on_list_bulk_change(sender, pks, **kwargs):
+    versions.bump_list_menu()
+    versions.bump_lists(pks)
+
+@receiver(post_save, sender=Subscription)
+@receiver(post_delete, sender=Subscription)
+def bump_version_on_subscription_change(sender, **kwargs):
+    versions.bump_users([kwargs['instance'].user_id])
+
+@receiver(signals.post_bulk_trash, sender=Subscription)
+@receiver(signals.post_bulk_restore, sender=Subscription)
+def bump_version_on_subscription_bulk_change(sender, pks, **kwargs):
+    versions.bump_users(Subscription.objects.filter(pk__in=pks).order_by()
+            .values_list('user_id', flat=True))
+
+# The permission memos of ideaList.access go stale with any subscription or
+# list, whoever's it is
+@receiver(post_save, sender=Subscription)
+@receiver(post_delete, sender=Subscription)
+@receiver(signals.post_bulk_trash, sender=Subscription)
+@receiver(signals.post_bulk_restore, sender=Subscription)
+@receiver(post_save, sender=List)
+@receiver(post_delete, sender=List)
+@receiver(signals.post_bulk_trash, sender=List)
+@receiver(signals.post_bulk_restore, sender=List)
+def invalidate_access_memos(sender, **kwargs):
+    access.invalidate()
+
+# Rows deleted by the cleanup script only drop out of the suggestions when the
+# indexes are rebuilt, but those of a deleted list must go right away
+@receiver(post_delete, sender=List)
+def forget_suggestions_of_deleted_list(sender, **kwargs):
+    suggestions.forget(kwargs['instance'].id)
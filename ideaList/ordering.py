@@ -0,0 +1,280 @@
+"""
+Ordering of objects within a collection by sparse sort keys.
+
+The position field of an object holds an integer key that is only meaningful
+in relation to the keys of the other objects of its collection. A new key is
+put halfway between the keys of the neighbours, so inserting or moving an
+object writes only that object. When two neighbours have no room left between
+them, the keys of the whole collection are spread out again, which is rare.
+
+Positions given by clients (where in the move views, position when adding an
+item) are indexes among the visible objects of the collection.
+"""
+import bisect
+from django.db import models, transaction
+from django.utils import timezone
+
+# Distance between adjacent keys after rebalancing: allows 24 inserts to the
+# same place before a rebalance is needed
+GAP = 2**24
+# Keys further from zero cause a rebalance, so that they stay exact in
+# JavaScript (up to 2**53)
+MAX_KEY = 2**50
+
+def key_between(before, after):
+    """Return a key between the keys before and after, either of which may be
+    None for the ends of the collection, or None if there's no room."""
+    if before is None and after is None:
+        return 0
+    if before is None:
+        key = after - GAP
+    elif after is None:
+        key = before + GAP
+    else:
+        key = (before + after) // 2
+        if key <= before:
+            return None
+    if abs(key) > MAX_KEY:
+        return None
+    return key
+
+def spread_keys(before, after, count):
+    """Return count ascending keys between before and after (either may be
+    None), as far apart as possible, or None if there's no room."""
+    if before is None and after is None:
+        keys = [n * GAP for n in range(count)]
+    elif before is None:
+        keys = [after - (count - n) * GAP for n in range(count)]
+    elif after is None:
+        keys = [before + (n + 1) * GAP for n in range(count)]
+    else:
+        step = (after - before) // (count + 1)
+        if step < 1:
+            return None
+        keys = [before + (n + 1) * step for n in range(count)]
+    if keys and max(abs(keys[0]), abs(keys[-1])) > MAX_KEY:
+        return None
+    return keys
+
+def increasing_run(keys):
+    "Return the indexes of a longest strictly increasing subsequence of keys."
+    tails, tail_indexes, previous = [], [], []
+    for i, key in enumerate(keys):
+        j = bisect.bisect_left(tails, key)
+        if j == len(tails):
+            tails.append(key)
+            tail_indexes.append(i)
+        else:
+            tails[j] = key
+            tail_indexes[j] = i
+        previous.append(tail_indexes[j-1] if j > 0 else None)
+    run = []
+    i = tail_indexes[-1] if tail_indexes else None
+    while i is not None:
+        run.append(i)
+        i = previous[i]
+    return run[::-1]
+
+def lock_rows(model, pks):
+    """Lock the rows of model with the given primary keys until the end of the
+    transaction and return them by primary key."""
+    return model._default_manager.select_for_update().filter(pk__in=pks) \
+            .order_by('pk').in_bulk()
+
+class Ordered(models.Model):
+    """
+    A mixin for models ordered within a collection. The collection is given by
+    the foreign key named in position_collection and the visible objects in it
+    by position_filter. When an object is created, its position is taken as
+    the index to insert it at, -1 meaning last, and the collection is locked
+    (see lock_collections) until the end of the transaction.
+    """
+    position = models.BigIntegerField(default=-1)
+
+    position_collection = None
+    position_filter = {}
+
+    def collection(self):
+        "Return all objects of the collection, including this one."
+        field = self._meta.get_field(self.position_collection)
+        return type(self)._default_manager.filter(
+                **{field.attname: getattr(self, field.attname)})
+
+    def siblings(self):
+        "Return the other visible objects of the collection."
+        return self.collection().filter(**self.position_filter) \
+                .exclude(pk=self.pk)
+
+    def index(self):
+        "Return the index of the object among the visible ones."
+        return self.siblings().filter(position__lt=self.position).count()
+
+    def key_for_index(self, index):
+        "Return a key that puts the object at index among its siblings."
+        keys = self.siblings().order_by('position') \
+                .values_list('position', flat=True)
+        if index < 0:
+            before, after = keys.reverse().first(), None
+        elif index == 0:
+            before, after = None, keys.first()
+        else:
+            neighbours = list(keys[index-1:index+1])
+            if not neighbours: # Past the end
+                neighbours = [keys.reverse().first()]
+            before, after = (neighbours + [None])[:2]
+        key = key_between(before, after)
+        if key is None:
+            self.rebalance()
+            return self.key_for_index(index)
+        return key
+
+    def rebalance(self):
+        """Spread the keys of the collection GAP apart, keeping the order of
+        all its objects."""
+        objs = list(self.collection().order_by('position', 'pk')
+                .only('pk', 'position'))
+        fields = ['position']
+        if hasattr(self, 'last_changed'): # So that deltas carry the new keys
+            fields.append('last_changed')
+        now = timezone.now()
+        for i, obj in enumerate(objs):
+            obj.position = i * GAP
+            obj.last_changed = now
+        type(self)._default_manager.bulk_update(objs, fields, batch_size=500)
+
+    def lock_collections(self, *pks):
+        """
+        Lock the rows that the collections with the given primary keys (by
+        default the object's own collection) belong to until the end of the
+        transaction, so that concurrent moves in them can't pick the same keys.
+        Return the locked rows by primary key.
+        """
+        field = self._meta.get_field(self.position_collection)
+        return lock_rows(field.related_model,
+                pks or [getattr(self, field.attname)])
+
+    @classmethod
+    def reorder(cls, collection, pks):
+        """
+        Put the visible objects of the collection with the primary key
+        collection in the order of pks, which must be their primary keys. The
+        longest run of objects that are already in order keep their keys, and
+        the others are written with one bulk update. Return the number of
+        objects moved, or None if pks aren't the visible objects.
+        """
+        field = cls._meta.get_field(cls.position_collection)
+        lock_rows(field.related_model, [collection])
+        current = dict(cls._default_manager.filter(**{field.attname:
+            collection}).filter(**cls.position_filter)
+            .values_list('pk', 'position'))
+        if len(pks) != len(current) or set(pks) != set(current):
+            return None
+
+        keys = [current[pk] for pk in pks]
+        kept = set(increasing_run(keys))
+        i = 0
+        while i < len(keys):
+            if i in kept:
+                i += 1
+                continue
+            j = i
+            while j < len(keys) and j not in kept:
+                j += 1
+            spread = spread_keys(keys[i-1] if i > 0 else None,
+                    keys[j] if j < len(keys) else None, j - i)
+            if spread is None: # No room: renumber the visible objects
+                keys = spread_keys(None, None, len(keys))
+                break
+            keys[i:j] = spread
+            i = j
+
+        now = timezone.now()
+        moved = []
+        for pk, key in zip(pks, keys):
+            if current[pk] != key:
+                obj = cls(pk=pk, position=key)
+                obj.last_changed = now
+                moved.append(obj)
+        fields = ['position']
+        if hasattr(cls, 'last_changed'):
+            fields.append('last_changed')
+        cls._default_manager.bulk_update(moved, fields, batch_size=500)
+        return len(moved)
+
+    @classmethod
+    def create_on_top(cls, objs):
+        """
+        Create the unsaved objs, all of the same collection, with one bulk
+        insert above the visible objects of the collection, the last one on
+        top, like creating them one by one at index 0 would. The collection
+        must be locked (see lock_collections). Return the created objects.
+        """
+        field = cls._meta.get_field(cls.position_collection)
+        keys = spread_keys(None, cls._default_manager.filter(**{field.attname:
+            getattr(objs[0], field.attname)}).filter(**cls.position_filter)
+            .order_by('position').values_list('position', flat=True).first(),
+            len(objs))
+        if keys is None:
+            objs[0].rebalance()
+            return cls.create_on_top(objs)
+        for obj, key in zip(reversed(objs), keys):
+            obj.position = key
+        return cls._default_manager.bulk_create(objs)
+
+    def save_position(self):
+        "Save only the position and collection of the object with one UPDATE."
+        fields = ['position',
+                self._meta.get_field(self.position_collection).attname]
+        if hasattr(self, 'last_changed'):
+            fields.append('last_changed')
+        self.save(update_fields=fields)
+
+    def move_to(self, index):
+        "Move the object to index among its siblings (-1 means last) and save."
+        self.position = self.key_for_index(index)
+        self.save_position()
+
+    def move_up(self):
+        "Swap places with the previous sibling. Return False if on top."
+        return self.move_past('up')
+
+    def move_down(self):
+        "Swap places with the next sibling. Return False if on bottom."
+        return self.move_past('down')
+
+    def move_past(self, direction):
+        if direction == 'up':
+            following = self.siblings().filter(position__lt=self.position) \
+                    .order_by('-position')
+        else:
+            following = self.siblings().filter(position__gt=self.position) \
+                    .order_by('position')
+        keys = list(following.values_list('position', flat=True)[:2])
+        if not keys:
+            return False
+        keys.append(None)
+        if direction == 'up':
+            key = key_between(keys[1], keys[0])
+        else:
+            key = key_between(keys[0], keys[1])
+        if key is None:
+            self.rebalance()
+            self.refresh_from_db(fields=['position'])
+            return self.move_past(direction)
+        self.position = key
+        self.save_position()
+        return True
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            super(Ordered, self).save(*args, **kwargs)
+            return
+        # Lock the collection like moves do, so that concurrent adds can't pick
+        # the same key and a rebalance can't overwrite the keys of a move
+        with transaction.atomic():
+            self.lock_collections()
+            self.position = self.key_for_index(self.position)
+            super(Ordered, self).save(*args, **kwargs)
+
+    class Meta:
+        abstract = True
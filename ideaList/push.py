@@ -0,0 +1,80 @@
+"""
+Long-polling push channel for state changes.
+
+A client waits in wait_state/ with the ETag of the state it has and gets the
+new state as soon as its version in ideaList.versions changes. The versions are
+bumped by the post_save/post_delete receivers in ideaList.models, which also
+cover trashing and restoring.
+
+All waiting requests of a process share one VersionWatcher, which reads the
+versions of every waiting user with a single cache query per interval, so idle
+clients cost neither database queries nor threads. This needs an ASGI server
+(see apache/asgi.py) and a cache backend shared by all server processes.
+"""
+import asyncio
+import weakref
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from ideaList import versions
+
+# How long a request waits for a change before it is answered with 304
+TIMEOUT = getattr(settings, 'IDEALIST_PUSH_TIMEOUT', 25)
+# How often the versions of waiting users are checked (in seconds)
+INTERVAL = getattr(settings, 'IDEALIST_PUSH_INTERVAL', 0.5)
+
+class VersionWatcher(object):
+    """
+    Wakes up the requests waiting for a change of a user's version. Bound to
+    the event loop it was created in.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.waiters = {} # user_id -> list of (known version, future)
+        self.task = None
+
+    async def wait(self, user_id, version, timeout):
+        """Wait until the version of user_id differs from the given version.
+        Return the new version or None if it didn't change in time."""
+        future = asyncio.get_running_loop().create_future()
+        waiter = (version, future)
+        self.waiters.setdefault(user_id, []).append(waiter)
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            waiters = self.waiters.get(user_id, [])
+            if waiter in waiters:
+                waiters.remove(waiter)
+            if not waiters:
+                self.waiters.pop(user_id, None)
+
+    async def run(self):
+        get_versions = sync_to_async(versions.user_versions,
+                thread_sensitive=False)
+        while self.waiters:
+            await asyncio.sleep(self.interval)
+            user_ids = list(self.waiters)
+            current = await get_versions(user_ids)
+            for user_id in user_ids:
+                for version, future in self.waiters.get(user_id, []):
+                    if current[user_id] != version and not future.done():
+                        future.set_result(current[user_id])
+
+_watchers = weakref.WeakKeyDictionary()
+
+async def wait_for_change(user_id, version, timeout=None):
+    """Return the version of user_id as soon as it differs from the given
+    version, or None if it stays the same for timeout (default TIMEOUT)
+    seconds."""
+    current = await sync_to_async(versions.user_version,
+            thread_sensitive=False)(user_id)
+    if current != version:
+        return current
+    loop = asyncio.get_running_loop()
+    if loop not in _watchers:
+        _watchers[loop] = VersionWatcher(INTERVAL)
+    return await _watchers[loop].wait(user_id, version,
+            TIMEOUT if timeout is None else timeout)
@@ -106,10 +106,107 @@ function mergeState(newState) {
     return false;
   }
   updateSubscriptions(newState);
-  updateListMenu(newState); // must come after updateSubscriptions
+  updateListMenu(); // must come after updateSubscriptions
   state_timestamp = new Date().getTime();
 }
 
+// Merge an AJAX response: either a whole state or a delta to the current one
+function mergeResponse(data) {
+  if (data.format == 'compact') {
+    if (data.delta)
+      data.delta = decodeCompactDelta(data.delta);
+    else
+      data.state = decodeCompactState(data.state);
+  }
+  if (data.delta)
+    mergeState(applyDelta(data.delta));
+  else
+    mergeState(data.state);
+  // Responses may arrive out of order, never go back to an older version
+  if (data.version && (!state_version || data.version > state_version))
+    state_version = data.version;
+}
+
+// Decoding of the compact state format that is asked for with
+// compactMediaType, see compact_state in views.py. Rows are positional arrays
+// with their trailing defaults left out.
+function decodeCompactItems(listId, rows) {
+  var items = {};
+  for (var i in rows) {
+    var row = rows[i];
+    items[row[0]] = {id: row[0], list_id: listId, text: row[1],
+      position: row[2], url: row.length > 3 ? row[3] : '',
+      important: row.length > 4 && row[4] == 1};
+  }
+  return items;
+}
+function decodeCompactLists(rows) {
+  var lists = {};
+  for (var i in rows)
+    lists[rows[i][0]] = {id: rows[i][0], name: rows[i][1],
+      owner_id: rows[i][2]};
+  return lists;
+}
+function decodeCompactSubscriptions(rows, lists, items) {
+  var subs = {};
+  for (var i in rows) {
+    var row = rows[i];
+    var list = cloneObject(lists[row[1]]);
+    list.items = decodeCompactItems(row[1], items[row[1]]);
+    subs[row[0]] = {id: row[0], user_id: user_id, list: list,
+      position: row[2]};
+  }
+  return subs;
+}
+function decodeCompactState(compact) {
+  return {subscriptions: decodeCompactSubscriptions(compact.subscriptions,
+    decodeCompactLists(compact.lists), compact.items)};
+}
+function decodeCompactDelta(compact) {
+  var delta = decodeCompactState(compact);
+  delta.removed_subscriptions = compact.removed_subscriptions;
+  delta.removed_items = compact.removed_items;
+  // Items of changed subscriptions came with them, the rest are separate
+  var listsOfSubs = {};
+  for (var i in delta.subscriptions)
+    listsOfSubs[delta.subscriptions[i].list.id] = true;
+  delta.items = {};
+  for (var listId in compact.items)
+    if (!listsOfSubs[listId])
+      $.extend(delta.items, decodeCompactItems(parseInt(listId),
+        compact.items[listId]));
+  return delta;
+}
+
+// Return a copy of the current state with the given delta applied to it
+function applyDelta(delta) {
+  var newState = $.extend(true, {}, {subscriptions: state.subscriptions});
+  var i, j;
+  for (i in delta.removed_subscriptions)
+    delete newState.subscriptions[delta.removed_subscriptions[i]];
+
+  // Items may have moved between lists, so remove their old copies first
+  var changedItemIds = delta.removed_items.concat(objectKeys(delta.items));
+  for (i in delta.subscriptions)
+    changedItemIds = changedItemIds.concat(
+      objectKeys(delta.subscriptions[i].list.items));
+  for (i in newState.subscriptions)
+    for (j in changedItemIds)
+      delete newState.subscriptions[i].list.items[changedItemIds[j]];
+
+  $.extend(newState.subscriptions, delta.subscriptions);
+  var subOfNewList = {};
+  for (i in newState.subscriptions)
+    subOfNewList[newState.subscriptions[i].list.id] = i;
+  for (i in delta.items) {
+    var item = delta.items[i];
+    if (subOfNewList[item.list_id] !== undefined)
+      newState.subscriptions[subOfNewList[item.list_id]]
+        .list.items[item.id] = item;
+  }
+  return newState;
+}
+
 function updateSubscriptions(newState) {
   var old_sub_ids = objectKeys(state.subscriptions);
   var new_sub_ids = objectKeys(newState.subscriptions);
@@ -127,12 +224,27 @@ function updateSubscriptions(newState) {
     $.map(subs_to_update, function(i){return newState.subscriptions[i];}));
 }
 
-// To be called as part of mergeState: after subscriptions have been updated
-function updateListMenu(newState) {
-  var newLists = valuesSortedById(newState.lists);
-  if (state && state.lists) {
+// The list menu isn't part of the state: it is fetched from get_lists/ when
+// it may have changed, e.g. when it is opened
+function refreshListMenu() {
+  $.ajax('get_lists/', { dataType: "json", type: "GET", cache: false,
+      headers: lists_etag ? {'If-None-Match': lists_etag} : {} })
+    .done(function(data, textStatus, jqXHR) {
+      if (jqXHR.status == 304)
+        return;
+      lists_etag = jqXHR.getResponseHeader('ETag');
+      menuLists = data.lists;
+      updateListMenu();
+    }).fail(getAjaxFailHandler('refresh lists'));
+}
+
+// To be called as part of mergeState (after subscriptions have been updated)
+// and when menuLists changes
+function updateListMenu() {
+  var newLists = valuesSortedById(menuLists);
+  if (shownLists) {
     // Check if update is necessary (if lists or subscriptions have changed)
-    var oldLists = valuesSortedById(state.lists);
+    var oldLists = valuesSortedById(shownLists);
     var listsChanged = false;
     if (newLists.length != oldLists.length) {
       listsChanged = true;
@@ -166,8 +278,8 @@ function updateListMenu(newState) {
     $.ajax(url, {dataType: "json", type: "POST", data: {list_id:res[2]}})
       .done(function(data) {
         flashSuccess('list '
-          +state.lists[res[2]].name+' '+res[1]+'d');
-        mergeState(data.state);
+          +menuLists[res[2]].name+' '+res[1]+'d');
+        mergeResponse(data);
       }).fail(getAjaxFailHandler('toggle subscription'));
   }
   function removeListHandler(e) {
@@ -180,8 +292,9 @@ function updateListMenu(newState) {
         {dataType: "json", type: "POST", data: {list_id:res[1]}})
       .done(function(data) {
         flashSuccess('list '
-         +state.subscriptions[subOfList[res[1]]].list.name+' removed');
-        mergeState(data.state);
+         +menuLists[res[1]].name+' removed');
+        mergeResponse(data);
+        refreshListMenu();
       }).fail(getAjaxFailHandler('remove list'));
   }
   for (var i in newLists) {
@@ -203,22 +316,36 @@ function updateListMenu(newState) {
   }
   $("#listmenu_listlist").html(listMenu);
   oldSubOfList = cloneObject(subOfList);
-  state.lists = newState.lists;
+  shownLists = menuLists;
 }
 
 function refresh(flashOnSuccess) {
-  $.ajax('get_state/', { dataType: "json", type: "GET", cache: false })
-    .done(function(data) {
+  $.ajax('get_state/', { dataType: "json", type: "GET", cache: false,
+      headers: state_etag ? {'If-None-Match': state_etag} : {} })
+    .done(function(data, textStatus, jqXHR) {
       if (flashOnSuccess)
         flashSuccess('refreshed');
-      mergeState(data.state);
+      if (jqXHR.status == 304) { // Nothing has changed since the last refresh
+        state_timestamp = new Date().getTime();
+        return;
+      }
+      state_etag = jqXHR.getResponseHeader('ETag');
+      mergeResponse(data);
     }).fail(getAjaxFailHandler('refresh'));
 }
+// Poll for state changes, but only while they can't be pushed: stops once
+// waitForChanges gets a response and is started again when it fails
 function refresher() {
+  if (pushWorking) {
+    refresherRunning = false;
+    return;
+  }
   if (autorefresh_freq < 3) {
     debug('Autorefresh switching off, frequency is too low: '+autorefresh_freq);
+    refresherRunning = false;
     return;
   }
+  refresherRunning = true;
   var now = new Date().getTime();
   if (now - state_timestamp > autorefresh_freq*1000) {
     refresh();
@@ -229,6 +356,40 @@ function refresher() {
   }
 }
 
+function startRefresher() {
+  if (!refresherRunning)
+    refresher();
+}
+
+// Wait for state changes in wait_state/ (long polling) and merge them as soon
+// as they happen. While the server can't push, the refresher polls instead.
+function waitForChanges() {
+  var headers = {};
+  if (state_etag)
+    headers['If-None-Match'] = state_etag;
+  if (state_version)
+    headers['X-State-Since'] = state_version;
+  // Not global: a request that is always pending would confuse status light
+  $.ajax('wait_state/', { dataType: "json", type: "GET", cache: false,
+      global: false, timeout: 60000, headers: headers })
+    .done(function(data, textStatus, jqXHR) {
+      pushWorking = true;
+      if (jqXHR.status != 304) {
+        state_etag = jqXHR.getResponseHeader('ETag');
+        mergeResponse(data);
+      }
+      waitForChanges();
+    }).fail(function(jqXHR) {
+      pushWorking = false;
+      startRefresher();
+      if (jqXHR.status == 501) {
+        debug('Push not available, relying on autorefresh');
+        return;
+      }
+      setTimeout(waitForChanges, autorefresh_freq*1000);
+    });
+}
+
 ///////////// COMMON HELPERS /////////////
 
 function getAjaxFailHandler(action) {
@@ -238,11 +399,29 @@ function getAjaxFailHandler(action) {
     var data = parseErrorThrown(errorThrown);
     console.error(action+" failed: "+(data && data.msg ? data.msg:textStatus));
     flashError(action+" failed");
-    if (data && data.state)
-      mergeState(data.state);
+    if (data && (data.state || data.delta))
+      mergeResponse(data);
   }
 }
 
+// Positions in the state are sort keys, but the server takes indexes. Return
+// the index of elem among the shown siblings that match selector.
+function domIndex(elem, selector) {
+  return elem.prevAll(selector).filter(function() {
+    return $(this).css('display') != 'none';
+  }).length;
+}
+
+// Return the ids of the shown children of container that match selector
+function domOrder(container, selector) {
+  var ids = [];
+  container.children(selector).each(function() {
+    if ($(this).css('display') != 'none')
+      ids.push($(this).data('id'));
+  });
+  return ids;
+}
+
 function parseErrorThrown(errorThrown) {
   try {
     var data = $.parseJSON(errorThrown);
@@ -253,6 +432,45 @@ function parseErrorThrown(errorThrown) {
   return data;
 }
 
+///////////// BATCHED OPERATIONS /////////////
+
+// Operations are queued and sent together to batch/ once no more have come
+// for batchDelay ms, so that rapid clicks, drags and check-offs take one
+// request and one transaction. done is called when the batch succeeds and
+// revert when it fails, in which case the whole batch was rejected.
+var batchDelay = 300;
+var batchQueue = [];
+var batchTimer = null;
+function queueOperation(op, done, revert) {
+  batchQueue.push({op: op, done: done, revert: revert});
+  clearTimeout(batchTimer);
+  batchTimer = setTimeout(sendBatch, batchDelay);
+}
+function sendBatch() {
+  var batch = batchQueue;
+  batchQueue = [];
+  batchTimer = null;
+  if (batch.length == 0)
+    return;
+  var ops = [];
+  for (var i in batch)
+    ops.push(batch[i].op);
+  $.ajax('batch/', { dataType:"json", type:"POST",
+      data:{ops:JSON.stringify(ops)} })
+    .done(function(data) {
+      for (var i in batch)
+        if (batch[i].done)
+          batch[i].done();
+      mergeResponse(data);
+    }).fail(function(jqXHR, textStatus, errorThrown) {
+      for (var i = batch.length-1; i >= 0; i--)
+        if (batch[i].revert)
+          batch[i].revert();
+      getAjaxFailHandler(ops.length == 1 ? ops[0].op : 'batch')(
+        jqXHR, textStatus, errorThrown);
+    });
+}
+
 function moveHandler(e) {
   e.preventDefault();
   var res = /^move_(item|subscription)_(\d+)_(up|down)$/
@@ -272,14 +490,11 @@ function moveHandler(e) {
     debug('Not moving; already topmost/bottommost.');
     return false;
   }
-  data = {where:direction};
-  data[obj_type+'_id'] = obj_id;
-  $.ajax('move_'+obj_type+'/', {
-    dataType:"json", type:"POST", data:data
-  }).done(function(data) {
+  var op = {op:'move_'+obj_type, where:direction};
+  op[obj_type+'_id'] = obj_id;
+  queueOperation(op, function() {
     flashSuccess(obj_type+' moved');
-    mergeState(data.state);
-  }).fail(getAjaxFailHandler('move '+obj_type));
+  });
 }
 
 ///////////// SUBSCRIPTION RELATED DOM MANIPULATION /////////////
@@ -307,7 +522,7 @@ function makeAddItemRow(list_id, pos) {
             addItemHtml.hide(500, function(){addItemHtml.remove()});
           else
             addField.val('');
-          mergeState(data.state);
+          mergeResponse(data);
         }).fail(getAjaxFailHandler('add item'));
       } else {
         setSuggestionBoxItems(getSuggestions(list_id, $(this).val()));
@@ -390,32 +605,25 @@ function makeSubscription(s) {
       update: function(e, ui) {
         if (ui.sender != null)
           return; // prevent double ajax: this call is for the destination list
-        var prev = ui.item.prev();
         var subscriptionElem = ui.item.parents('.subscription');
         var list_id = state.subscriptions[subscriptionElem.data('id')].list.id;
-        var where = null;
-        if (prev.length == 0) {
-          where = 0;
+        var op = null;
+        if (list_id == old_list_id) {
+          op = {op:'reorder_items', list_id:list_id,
+                item_ids:domOrder(ui.item.parent(), '.item')};
         } else {
-          where = state.subscriptions[subscriptionElem.data('id')]
-            .list.items[prev.data('id')].position;
-          if (ui.position.top<ui.originalPosition.top || list_id != old_list_id)
-            where++; //If moving up or b/w lists, must be 1 greater than prev's
+          op = {op:'move_item', item_id:ui.item.data('id'), list_id:list_id,
+                where:domIndex(ui.item, '.item')};
         }
-        var data = {item_id:ui.item.data('id'), where:where}
-        if (list_id != old_list_id)
-          data.list_id = list_id;
-        $.ajax('move_item/', { dataType:"json", type:"POST", data:data })
-          .done(function(data) {
-            flashSuccess('item moved (drag)');
-            mergeState(data.state);
-          }).fail(function(jqXHR, textStatus, errorThrown) {
-            if (old_prev_item.length == 0)
-              $('#subscription_'+old_sub_id+' > .itemlist').prepend(ui.item);
-            else
-              old_prev_item.after(ui.item);
-            getAjaxFailHandler('drag item')(jqXHR, textStatus, errorThrown);
-          });
+        var prev_item = old_prev_item, sub_id = old_sub_id; // For revert
+        queueOperation(op, function() {
+          flashSuccess('item moved (drag)');
+        }, function() {
+          if (prev_item.length == 0)
+            $('#subscription_'+sub_id+' > .itemlist').prepend(ui.item);
+          else
+            prev_item.after(ui.item);
+        });
       }
     });
   }, 1);
@@ -489,7 +697,7 @@ function makeSubscription(s) {
 }
 function insertSubscriptionToDOM(s, subscriptionHtml, animate) {
   var cursubs = valuesSortedByPosition(state.subscriptions);
-  if (cursubs.length == 0 || s.position == 0) {
+  if (cursubs.length == 0) {
     //debug('Inserting sub '+s.id+' to beginning');
     $('#listlist').prepend(subscriptionHtml);
   } else {
@@ -606,7 +814,7 @@ function makeItem(item) {
     var subscriptionElem = $(this).parents('.subscription');
     var subscription = state.subscriptions[subscriptionElem.data('id')];
     var addItemField = makeAddItemRow(subscription.list.id,
-      subscription.list.items[itemElem.data('id')].position+1);
+      domIndex(itemElem, '.item')+1);
     itemElem.after(addItemField);
     $('.additem', addItemField).focus();
     showAndResetSuggestionBox(subscription.list.id);
@@ -650,7 +858,7 @@ function makeItem(item) {
 function insertItemToDOM(item, itemHtml, animate) {
   sub_id = subOfList[item.list_id];
   var curitems = valuesSortedByPosition(state.subscriptions[sub_id].list.items);
-  if (objectKeys(curitems).length == 0 || item.position == 0) {
+  if (objectKeys(curitems).length == 0) {
     //debug('  Adding item to first position');
     $('#subscription_'+sub_id+' > ul').prepend(itemHtml);
   } else {
@@ -811,14 +1019,26 @@ $(document).ajaxSend(function(event, xhr, settings) {
   }
 });
 
+// Ask for only the changes since the state we already have, in the compact
+// format
+var compactMediaType = 'application/vnd.idealist.compact+json';
+$(document).ajaxSend(function(event, xhr, settings) {
+  if (state_version)
+    xhr.setRequestHeader("X-State-Since", state_version);
+  if (settings.dataType == 'json')
+    xhr.setRequestHeader("Accept", compactMediaType+', application/json');
+});
+
 $.ajaxSetup({timeout:15000});
 
 // The text that appears in the new item boxes
 var newitemText = "New item..."
 
 // Refresh when state is this old (in seconds). Must be at least 3 seconds.
-// Set to -1 to disable autorefresh.
+// Set to -1 to disable autorefresh. Only used while changes can't be pushed.
 var autorefresh_freq = 300;
+var pushWorking = false;
+var refresherRunning = false;
 
 var editableUrl = 'edit_text/';
 var editableSettings = {
@@ -833,7 +1053,7 @@ var editableSettings = {
         debug("Couldn't parse JSON: ", e);
         return;
       }
-      mergeState(data.state);
+      mergeResponse(data);
       return data.text;
     }};
 
@@ -873,16 +1093,12 @@ function initTopBar() {
       items = items.add('#item_'+checked_item_ids[i]);
     items.attr('checked', false).hide()
       .children('.itemcheck').attr('checked',false);
-    $.ajax('remove_items/', {dataType:"json", type:"POST", traditional:true,
-        data:{item_ids:checked_item_ids}})
-      .done(function(data) {
-          flashSuccess('items removed');
-          updateNavbarItemactions();
-          mergeState(data.state);
-        })
-      .fail(function(a,b,c) {
+    updateNavbarItemactions();
+    queueOperation({op:'remove_items', item_ids:checked_item_ids},
+      function() {
+        flashSuccess('items removed');
+      }, function() {
         items.show().children('.itemcheck').attr('checked', true);
-        getAjaxFailHandler('remove item')(a,b,c);
       });
   });
   $('#important_button').click(function(e) {
@@ -898,18 +1114,17 @@ function initTopBar() {
         important_items.push(checked_items[i]);
       $('#item_'+checked_items[i]).toggleClass('important');
     }
-    $.ajax('set_item_importances/', { dataType:"json", type:"POST",
-        traditional:true, data:{important_item_ids:important_items,
-                                unimportant_item_ids:unimportant_items}})
-      .done(function(data) {
-          flashSuccess('item importance(s) set');
-          $('.itemcheck:checked').attr('checked', false);
-          updateNavbarItemactions();
-          mergeState(data.state);
-      }).fail(function(a,b,c) {
+    // Uncheck now, the items checked before the batch is sent are the next's
+    $('.itemcheck:checked').attr('checked', false);
+    updateNavbarItemactions();
+    queueOperation({op:'set_item_importances',
+                    important_item_ids:important_items,
+                    unimportant_item_ids:unimportant_items},
+      function() {
+        flashSuccess('item importance(s) set');
+      }, function() {
         for (var i in checked_items)
           $('#item_'+checked_items[i]).toggleClass('important');
-        getAjaxFailHandler('set item importances')(a,b,c);
       });
   });
   $('#link_button').click(function(e) {
@@ -939,7 +1154,7 @@ function initTopBar() {
           $('.itemcheck:checked').attr('checked', false);
           updateNavbarItemactions();
           $('#url_input_container').hide();
-          mergeState(data.state);
+          mergeResponse(data);
         })
       .fail(getAjaxFailHandler('set item url'));
   }
@@ -960,6 +1175,7 @@ function initTopBar() {
     e.stopPropagation();
   });
   $(".dropcontent").click(function(e) { e.stopPropagation(); });
+  $("#lists_button").click(refreshListMenu);
   $('#background-underlay').add('body')
     .click(function(e) {$('.dropcontent').slideUp(500);});
   $('#create_list_nameinput').keyup(function(e) {
@@ -972,7 +1188,8 @@ function initTopBar() {
       ).done(function(data) {
         flashSuccess('list '+val+' created');
         $('#create_list_nameinput').val('');
-        mergeState(data.state);
+        mergeResponse(data);
+        refreshListMenu();
       }).fail(getAjaxFailHandler('add list'));
     }
   });
@@ -986,27 +1203,17 @@ function initSubscriptionDragAndDrop() {
       old_prev_sub = ui.item.prev('.subscription'); // For revert on AJAX fail
     },
     update: function(e, ui) {
-      var prev = ui.item.prev();
-      var where = null;
-      if (prev.length == 0) {
-        where = 0;
-      } else {
-        where = state.subscriptions[prev.data('id')].position;
-        if (ui.position.top < ui.originalPosition.top)
-          where++; //If moving up, position must be one greater than prev's
-      }
-      $.ajax('move_subscription/', {
-        dataType:"json", type:"POST",
-        data:{subscription_id:ui.item.data('id'), where:where}
-      }).done(function(data) {
-        flashSuccess('subscription moved (drag)');
-        mergeState(data.state);
-      }).fail(function(jqXHR, textStatus, errorThrown) {
-          if (old_prev_sub.length == 0)
+      var prev_sub = old_prev_sub; // For revert
+      queueOperation({op:'reorder_subscriptions',
+                      subscription_ids:domOrder($('#listlist'),
+                                                '.subscription')},
+        function() {
+          flashSuccess('subscription moved (drag)');
+        }, function() {
+          if (prev_sub.length == 0)
             $('#listlist').prepend(ui.item);
           else
-            old_prev_sub.after(ui.item);
-          getAjaxFailHandler('drag subscription')(jqXHR, textStatus, errorThrown);
+            prev_sub.after(ui.item);
         });
     }});
 }
@@ -1082,7 +1289,8 @@ function initSuggestionBox(nrOfInitials) {
     freqtreeInsert(tree[c], text, i+1)
   }
 
-  $.ajax('get_frequents/', { dataType: "json", type: "GET", cache: false })
+  // Cacheable: the browser revalidates it with If-None-Match
+  $.ajax('get_frequents/', { dataType: "json", type: "GET" })
     .done(function(frequents_by_list) {
       freqtrees = {};
       for (var i in frequents_by_list) {
@@ -1118,8 +1326,10 @@ $(document).ready(function() {
   setStatusLight();
   state = {subscriptions: {}};
   subOfList = {};
+  menuLists = init_lists;
+  shownLists = null;
   mergeState(init_state);
   initSubscriptionDragAndDrop();
-  refresher();
+  waitForChanges(); // Starts the refresher if the server can't push
   initDone = true;
 });
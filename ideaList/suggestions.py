@@ -0,0 +1,126 @@
+"""
+Per-process prefix indexes of item texts for the suggest/ view.
+
+The index of a list is built from its ItemFrequency rows the first time the
+list is asked for and kept up to date by ItemFrequencyManager.increment_many,
+which passes every committed increment to add_counts. After that, answering a
+prefix costs no database queries. The most frequent texts of every prefix up to
+PREFIX_LENGTH characters long are kept ready; longer prefixes are looked up in
+the alphabetically sorted texts, where they only match a few.
+
+Increments made by other server processes aren't seen until the index is
+rebuilt, which happens when it is older than MAX_AGE seconds.
+"""
+import bisect
+import heapq
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+
+# How many suggestions are returned by default
+SUGGESTIONS = getattr(settings, 'IDEALIST_SUGGESTIONS', 10)
+# Prefixes up to this long have their suggestions precomputed
+PREFIX_LENGTH = getattr(settings, 'IDEALIST_SUGGEST_PREFIX_LENGTH', 3)
+# Seconds after which an index is rebuilt from the database
+MAX_AGE = getattr(settings, 'IDEALIST_SUGGEST_MAX_AGE', 300)
+# How many lists have an index in a process at most
+MAX_LISTS = getattr(settings, 'IDEALIST_SUGGEST_MAX_LISTS', 1000)
+
+class PrefixIndex(object):
+    """The texts of one list with their frequencies. Texts are canonized like
+    in ItemFrequencyManager."""
+    def __init__(self, frequencies, size=SUGGESTIONS):
+        self.size = size
+        self.frequencies = dict(frequencies)
+        self.texts = sorted(self.frequencies)
+        self.top = {} # prefix -> [(-frequency, text)] of its best texts
+        for text, frequency in self.frequencies.items():
+            self.rank(text, None, frequency)
+        self.built = time.monotonic()
+
+    def rank(self, text, old, new):
+        "Update the best texts of the short prefixes of text."
+        entry = (-new, text)
+        for n in range(min(len(text), PREFIX_LENGTH) + 1):
+            top = self.top.setdefault(text[:n], [])
+            if old is not None and (-old, text) in top:
+                top.remove((-old, text))
+            # Frequencies only grow, so a text that isn't among the best can
+            # only get there by its own increment
+            if len(top) < self.size or entry < top[-1]:
+                bisect.insort(top, entry)
+                del top[self.size:]
+
+    def add(self, text, count):
+        "Increment the frequency of text by count."
+        old = self.frequencies.get(text)
+        if old is None:
+            bisect.insort(self.texts, text)
+        self.frequencies[text] = (old or 0) + count
+        self.rank(text, old, self.frequencies[text])
+
+    def suggest(self, prefix, limit):
+        "Return at most limit texts starting with prefix, most frequent first."
+        prefix = prefix.lower().lstrip()
+        if len(prefix) <= PREFIX_LENGTH and limit <= self.size:
+            return [text for _, text in self.top.get(prefix, [])[:limit]]
+        start = bisect.bisect_left(self.texts, prefix)
+        end = bisect.bisect_left(self.texts,
+                prefix[:-1] + chr(ord(prefix[-1]) + 1)) if prefix \
+                        else len(self.texts)
+        return [text for _, text in heapq.nsmallest(limit,
+            ((-self.frequencies[text], text)
+                for text in self.texts[start:end]))]
+
+_indexes = OrderedDict() # list_id -> PrefixIndex, least recently used first
+# Incremented on every change of a list, so that an index that was being built
+# from the database while the list changed isn't kept
+_generations = {}
+_lock = threading.Lock()
+
+def get_index(list_id):
+    "Return the index of list_id, building it if needed."
+    with _lock:
+        index = _indexes.get(list_id)
+        if index is not None and time.monotonic() - index.built <= MAX_AGE:
+            _indexes.move_to_end(list_id)
+            return index
+        generation = _generations.get(list_id, 0)
+    from ideaList.models import ItemFrequency
+    index = PrefixIndex(ItemFrequency.objects.filter(list=list_id)
+            .order_by().values_list('text', 'frequency'))
+    with _lock:
+        if _generations.get(list_id, 0) == generation:
+            _indexes[list_id] = index
+            _indexes.move_to_end(list_id)
+            while len(_indexes) > MAX_LISTS:
+                _indexes.popitem(last=False)
+    return index
+
+def suggest(list_id, prefix, limit=SUGGESTIONS):
+    """Return at most limit texts of list_id that start with prefix, most
+    frequent first."""
+    index = get_index(list_id)
+    with _lock:
+        return index.suggest(prefix, limit)
+
+def add_counts(counts):
+    "Apply a dict of {(list_id, text): increment} to the built indexes."
+    with _lock:
+        for (list_id, text), count in counts.items():
+            _generations[list_id] = _generations.get(list_id, 0) + 1
+            if list_id in _indexes:
+                _indexes[list_id].add(text, count)
+
+def forget(list_id):
+    "Drop the index of list_id, so that it is built again when needed."
+    with _lock:
+        _generations[list_id] = _generations.get(list_id, 0) + 1
+        _indexes.pop(list_id, None)
+
+def clear():
+    "Drop all indexes."
+    with _lock:
+        _indexes.clear()
+        _generations.clear()
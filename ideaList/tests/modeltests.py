@@ -1,6 +1,15 @@
+import threading
+from unittest import mock
+from datetime import datetime, timedelta
+from io import StringIO
 from ideaList.models import Item, ItemFrequency, List, Subscription
 from django.contrib.auth.models import User
 from django import test
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from ideaList import access, ordering, suggestions, versions
 
 
 class ListTest(test.TestCase):
@@ -40,13 +49,46 @@ class ItemTest(test.TestCase):
         self.assertEqual(i.text, 'testitem')
         self.assertEqual(i.url, '')
         self.assertEqual(i.important, False)
-        self.assertEqual(i.position, 0)
+        self.assertEqual(i.index(), 0)
     def test_is_on_subscribed_list(self):
         self.assertFalse(self.i1.is_on_subscribed_list(self.u))
         Subscription.objects.create(list=self.l1, user=self.u)
         self.assertTrue(self.i1.is_on_subscribed_list(self.u))
 
 
+class ItemBulkTrashTest(test.TestCase):
+    def setUp(self):
+        self.u = User.objects.create_user('pena', 'lol@lol.lol', 'passwd')
+        self.l1 = List.objects.create(name='List1', owner=self.u)
+        self.items = [Item.objects.create(list=self.l1, text=str(n))
+                for n in range(3)]
+    def test_trash_and_restore(self):
+        version = versions.list_version(self.l1.id)
+        before = Item.objects.get(pk=self.items[0].id).last_changed
+        self.assertEqual(Item.objects.filter(list=self.l1).trash(), 3)
+        self.assertEqual(self.l1.nontrashed_items().count(), 0)
+        self.assertNotEqual(versions.list_version(self.l1.id), version)
+        self.assertTrue(Item.objects.get(pk=self.items[0].id).last_changed
+                > before)
+        version = versions.list_version(self.l1.id)
+        self.assertEqual(Item.trash.filter(pk=self.items[1].id).restore(), 1)
+        self.assertEqual(list(self.l1.nontrashed_items()), [self.items[1]])
+        self.assertNotEqual(versions.list_version(self.l1.id), version)
+
+class CacheCheckTest(test.SimpleTestCase):
+    @test.override_settings(CACHES={'default': {'BACKEND':
+        'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_per_process_cache(self):
+        self.assertFalse(versions.cache_is_shared())
+        self.assertEqual([w.id for w in versions.check_cache(None)],
+                ['ideaList.W001'])
+    @test.override_settings(CACHES={'default': {'BACKEND':
+        'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': '/tmp/ideaList-test-cache'}})
+    def test_shared_cache(self):
+        self.assertTrue(versions.cache_is_shared())
+        self.assertEqual(versions.check_cache(None), [])
+
 class ItemFrequencyTest(test.TestCase):
     def setUp(self):
         self.u1 = User.objects.create_user('pena', 'lol@lol.lol', 'passwd')
@@ -80,6 +122,22 @@ class ItemFrequencyTest(test.TestCase):
         ItemFrequency.objects.increment(self.l1, '   milk')
         self.assertEqual(ItemFrequency.objects.count(), 1)
         self.assertEqual(ItemFrequency.objects.get(text='milk').frequency, 2)
+    def test_increment_many(self):
+        l2 = List.objects.create(name='List2', owner=self.u1)
+        ItemFrequency.objects.increment(self.l1, 'milk')
+        ItemFrequency.objects.increment_many([(self.l1, 'Milk'),
+            (self.l1, 'bread'), (l2.id, 'milk'), (self.l1, 'milk ')])
+        self.assertEqual(ItemFrequency.objects.get(list=self.l1,
+            text='milk').frequency, 3)
+        self.assertEqual(ItemFrequency.objects.get(list=self.l1,
+            text='bread').frequency, 1)
+        self.assertEqual(ItemFrequency.objects.get(list=l2,
+            text='milk').frequency, 1)
+    def test_increment_many_in_one_query(self):
+        with self.assertNumQueries(1):
+            ItemFrequency.objects.increment_many([(self.l1, 'text %d' % n)
+                for n in range(100)])
+        self.assertEqual(ItemFrequency.objects.count(), 100)
     def test_autoincrement(self):
         Item.objects.create(text='milk', list=self.l1)
         self.assertEqual(ItemFrequency.objects.count(), 1)
@@ -105,7 +163,306 @@ class ItemFrequencyTest(test.TestCase):
         self.assertIn(self.l1.id, f)
         self.assertEqual(len(f[self.l1.id]), 2)
         self.assertEqual(f[self.l1.id], ['c','b'])
+    def test_frequents_by_list_limit_is_per_list(self):
+        l2 = List.objects.create(name='List2', owner=self.u1)
+        Subscription.objects.create(user=self.u1, list=l2)
+        for t in ('a','b','c','b','c','c'):
+            Item.objects.create(text=t, list=self.l1)
+        for t in ('x','y','y'):
+            Item.objects.create(text=t, list=l2)
+        with self.assertNumQueries(1):
+            f = ItemFrequency.objects.frequents_by_list(self.u1, limit=2)
+        self.assertEqual(f, {self.l1.id: ['c','b'], l2.id: ['y','x']})
+    def test_frequents_by_list_skips_trashed_subscriptions(self):
+        Item.objects.create(text='a', list=self.l1)
+        self.s1.delete()
+        self.assertEqual(ItemFrequency.objects.frequents_by_list(self.u1), {})
+    def test_frequents_page(self):
+        for t in ('a','b','c','b','c','c'):
+            Item.objects.create(text=t, list=self.l1)
+        page = ItemFrequency.objects.frequents_page
+        self.assertEqual(page(self.l1.id, 0, 2), (['c','b'], True))
+        self.assertEqual(page(self.l1.id, 2, 2), (['a'], False))
+        self.assertEqual(page(self.l1.id, 3, 2), ([], False))
+
+
+class ItemFrequencyConcurrencyTest(test.TransactionTestCase):
+    def test_concurrent_increments(self):
+        u = User.objects.create_user('pena', 'lol@lol.lol', 'passwd')
+        l = List.objects.create(name='List1', owner=u)
+        errors = []
+        def hammer():
+            try:
+                for n in range(20):
+                    ItemFrequency.objects.increment(l, 'milk')
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+        threads = [threading.Thread(target=hammer) for n in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(ItemFrequency.objects.get(list=l,
+            text='milk').frequency, 100)
 
+class AccessTest(test.TestCase):
+    fixtures = ['auth.json']
+    def setUp(self):
+        self.u = User.objects.all()[0]
+        self.l1 = List.objects.create(name='List1', owner=self.u)
+        self.l2 = List.objects.create(name='List2', owner=self.u)
+        self.s1 = Subscription.objects.create(list=self.l1, user=self.u)
+        self.items = [Item.objects.create(list=l, text='item')
+                for l in (self.l1, self.l2, self.l1)]
+    def test_loaded_once(self):
+        with self.assertNumQueries(1):
+            self.assertEqual([i.is_on_subscribed_list(self.u)
+                for i in self.items], [True, False, True])
+            a = access.for_user(self.u)
+        self.assertEqual(a.subscription_ids, set([self.s1.id]))
+        self.assertEqual(a.list_ids, set([self.l1.id]))
+    def test_trashed_list(self):
+        self.l1.delete()
+        a = access.for_user(self.u)
+        self.assertEqual(a.subscribed_list_ids, set([self.l1.id]))
+        self.assertEqual(a.list_ids, set())
+    def test_invalidated_by_changes(self):
+        self.assertFalse(self.items[1].is_on_subscribed_list(self.u))
+        s2 = Subscription.objects.create(list=self.l2, user=self.u)
+        self.assertTrue(self.items[1].is_on_subscribed_list(self.u))
+        Subscription.objects.filter(pk=s2.id).trash()
+        self.assertFalse(self.items[1].is_on_subscribed_list(self.u))
+
+class SuggestionsTest(test.TestCase):
+    def setUp(self):
+        suggestions.clear()
+        u = User.objects.create_user('pena', 'lol@lol.lol', 'passwd')
+        self.l1 = List.objects.create(name='List1', owner=u)
+        ItemFrequency.objects.bulk_create([ItemFrequency(list=self.l1,
+            text=t, frequency=f) for t, f in (('milk', 5), ('mint', 2),
+                ('mince', 7), ('bread', 3), ('butter', 1))])
+    def test_prefix_index(self):
+        index = suggestions.PrefixIndex({'milk': 5, 'mint': 2, 'mince': 7,
+            'milkshake': 1, 'bread': 3}, size=2)
+        self.assertEqual(index.suggest('', 2), ['mince', 'milk'])
+        self.assertEqual(index.suggest('Mi', 3), ['mince', 'milk', 'mint'])
+        self.assertEqual(index.suggest('milk', 5), ['milk', 'milkshake'])
+        self.assertEqual(index.suggest('x', 5), [])
+        index.add('mint', 4)
+        index.add('minestrone', 1)
+        self.assertEqual(index.suggest('min', 2), ['mince', 'mint'])
+        self.assertEqual(index.suggest('mine', 2), ['minestrone'])
+    def test_suggest_without_queries(self):
+        self.assertEqual(suggestions.suggest(self.l1.id, 'm'),
+                ['mince', 'milk', 'mint'])
+        with self.assertNumQueries(0):
+            self.assertEqual(suggestions.suggest(self.l1.id, 'b', 1),
+                    ['bread'])
+    def test_increments_update_index(self):
+        suggestions.suggest(self.l1.id, '')
+        with self.captureOnCommitCallbacks(execute=True):
+            ItemFrequency.objects.increment_many([(self.l1, 'Butter'),
+                (self.l1, 'butter'), (self.l1, 'butter'), (self.l1, 'bun')])
+        with self.assertNumQueries(0):
+            self.assertEqual(suggestions.suggest(self.l1.id, 'bu'),
+                    ['butter', 'bun'])
+    def test_deleted_list_is_forgotten(self):
+        suggestions.suggest(self.l1.id, '')
+        self.l1.delete(trash=False)
+        self.assertEqual(suggestions.suggest(self.l1.id, ''), [])
+
+class CleanupCommandTest(test.TestCase):
+    def setUp(self):
+        self.u = User.objects.create_user('pena', 'lol@lol.lol', 'passwd')
+        self.l1 = List.objects.create(name='List1', owner=self.u)
+        self.l2 = List.objects.create(name='List2', owner=self.u)
+    def cleanup(self, *args):
+        out = StringIO()
+        call_command('idealist_cleanup', *args, stdout=out)
+        return out.getvalue()
+    def add_frequencies(self, l, frequencies, age_days=0):
+        changed = timezone.now() - timedelta(days=age_days)
+        ItemFrequency.objects.bulk_create([ItemFrequency(list=l,
+            text='%s %d' % (age_days, n), frequency=f)
+            for n, f in enumerate(frequencies)])
+        ItemFrequency.objects.filter(list=l, text__startswith='%s ' % age_days
+                ).update(last_changed=changed)
+    def test_purge_old_trash(self):
+        old = datetime.now() - timedelta(days=8)
+        i1 = Item.objects.create(text='old', list=self.l1)
+        i2 = Item.objects.create(text='new', list=self.l1)
+        Item.objects.filter(pk__in=[i1.pk, i2.pk]).trash()
+        Item.objects.filter(pk=i1.pk).update(trashed_at=old)
+        self.l2.delete()
+        List.objects.filter(pk=self.l2.pk).update(trashed_at=old)
+        out = self.cleanup('--chunk-size', '1')
+        self.assertIn('Purged 1 items in total', out)
+        self.assertIn('Purged 1 lists in total', out)
+        self.assertEqual(list(Item.objects.all()), [i2])
+        self.assertEqual(list(List.objects.all()), [self.l1])
+    def test_prune_frequencies(self):
+        self.add_frequencies(self.l1, [1] * 3, age_days=400)
+        self.add_frequencies(self.l1, [1, 2], age_days=10)
+        self.add_frequencies(self.l2, [5, 4, 3, 2], age_days=400)
+        out = self.cleanup('--min-frequents', '3', '--max-frequents', '3',
+                '--chunk-size', '1')
+        self.assertIn('Pruned 3 item frequencies in total', out)
+        # Old ones of frequency 1 go past the third, and past it anyway
+        self.assertEqual(sorted(ItemFrequency.objects.filter(list=self.l1)
+            .values_list('text', flat=True)), ['10 0', '10 1', '400 0'])
+        self.assertEqual(sorted(ItemFrequency.objects.filter(list=self.l2)
+            .values_list('frequency', flat=True)), [3, 4, 5])
+    def test_prune_in_chunks_of_rows(self):
+        self.add_frequencies(self.l1, [1] * 5, age_days=400)
+        with CaptureQueriesContext(connection) as ctx:
+            out = self.cleanup('--min-frequents', '0', '--chunk-size', '2')
+        self.assertIn('Pruned 5 item frequencies in total', out)
+        self.assertEqual(len([q for q in ctx.captured_queries
+            if q['sql'].startswith('DELETE FROM "ideaList_itemfrequency"')]),
+            3)
+    def test_keep_min_frequents(self):
+        self.add_frequencies(self.l1, [1] * 4, age_days=400)
+        self.cleanup('--min-frequents', '2')
+        self.assertEqual(ItemFrequency.objects.count(), 2)
+    def test_resume_after_list(self):
+        self.add_frequencies(self.l1, [1] * 4, age_days=400)
+        self.add_frequencies(self.l2, [1] * 4, age_days=400)
+        self.cleanup('--min-frequents', '0', '--after-list', str(self.l1.pk))
+        self.assertEqual(ItemFrequency.objects.filter(list=self.l1).count(), 4)
+        self.assertEqual(ItemFrequency.objects.filter(list=self.l2).count(), 0)
+    def test_dry_run(self):
+        self.add_frequencies(self.l1, [1] * 4, age_days=400)
+        Item.objects.create(text='old', list=self.l1).delete()
+        Item.trash.update(trashed_at=datetime.now() - timedelta(days=8))
+        out = self.cleanup('--dry-run', '--min-frequents', '0')
+        self.assertIn('[dry run] Pruned 4 item frequencies in total', out)
+        self.assertIn('[dry run] Purged 1 items in total', out)
+        self.assertEqual(ItemFrequency.objects.count(), 5)
+        self.assertEqual(Item.trash.count(), 1)
+    def test_few_queries_per_chunk(self):
+        for l in (self.l1, self.l2):
+            self.add_frequencies(l, [1] * 10, age_days=400)
+        with CaptureQueriesContext(connection) as queries:
+            self.cleanup('--min-frequents', '0')
+        statements = [q['sql'] for q in queries.captured_queries
+                if 'SAVEPOINT' not in q['sql']]
+        # Old items and lists: one empty chunk each. Frequencies: the chunk of
+        # lists, ranking, deleting and the empty chunk after it.
+        self.assertEqual(len(statements), 6)
+        self.assertEqual(ItemFrequency.objects.count(), 0)
+
+@test.skipUnlessDBFeature('supports_partial_indexes')
+class IndexUsageTest(test.TestCase):
+    "Check with EXPLAIN that the hot queries use the indexes meant for them."
+    def setUp(self):
+        self.u = User.objects.create_user('pena', 'lol@lol.lol', 'passwd')
+        self.l1 = List.objects.create(name='List1', owner=self.u)
+    def assertUsesIndex(self, queryset, index):
+        self.assertIn(index, queryset.explain())
+    def test_items_of_lists(self):
+        self.assertUsesIndex(Item.nontrash.filter(list__in=[self.l1.id])
+                .order_by(), 'ideaList_item_nontrash_pos')
+    def test_item_siblings(self):
+        i = Item.objects.create(text='milk', list=self.l1)
+        self.assertUsesIndex(i.siblings().filter(position__lt=i.position)
+                .order_by('-position'), 'ideaList_item_nontrash_pos')
+    def test_subscriptions_of_user(self):
+        self.assertUsesIndex(Subscription.nontrash.filter(user=self.u,
+            list__trashed_at__isnull=True).order_by('position'),
+            'ideaList_sub_nontrash_pos')
+    def test_list_menu(self):
+        self.assertUsesIndex(List.nontrash.order_by()
+                .values('id', 'name', 'owner_id'), 'ideaList_list_nontrash')
+    def test_no_full_position_indexes(self):
+        # The partial indexes are enough, writes shouldn't maintain two
+        for model, columns, index in ((Item, ['list_id', 'position'],
+                'ideaList_item_nontrash_pos'), (Subscription,
+                    ['user_id', 'position'], 'ideaList_sub_nontrash_pos')):
+            with connection.cursor() as cursor:
+                constraints = connection.introspection.get_constraints(
+                        cursor, model._meta.db_table)
+            self.assertEqual([name for name, c in constraints.items()
+                if c['index'] and c['columns'] == columns], [index])
+    def test_old_trash(self):
+        old = datetime.now() - timedelta(days=7)
+        self.assertUsesIndex(Item.trash.filter(trashed_at__lt=old),
+                'ideaList_item_trashed')
+        self.assertUsesIndex(List.trash.filter(trashed_at__lt=old),
+                'ideaList_list_trashed')
+    def test_frequents_of_list(self):
+        self.assertUsesIndex(ItemFrequency.objects.filter(list=self.l1)
+                .order_by('-frequency'), 'ideaList_itemfreq_list_freq')
+
+class OrderingTest(test.TestCase):
+    def setUp(self):
+        self.u = User.objects.create_user('pena', 'lol@lol.lol', 'passwd')
+        self.l1 = List.objects.create(name='List1', owner=self.u)
+        self.items = [Item.objects.create(list=self.l1, text=str(n))
+                for n in range(3)]
+    def texts(self):
+        return [i.text for i in Item.nontrash.filter(list=self.l1)]
+    def test_insert_at_index(self):
+        Item.objects.create(list=self.l1, text='top', position=0)
+        Item.objects.create(list=self.l1, text='mid', position=2)
+        Item.objects.create(list=self.l1, text='end')
+        self.assertEqual(self.texts(), ['top', '0', 'mid', '1', '2', 'end'])
+    def test_create_locks_collection_first(self):
+        calls = []
+        lock_rows = ordering.lock_rows
+        key_for_index = ordering.Ordered.key_for_index
+        with mock.patch.object(ordering, 'lock_rows', side_effect=lambda
+                    model, pks: calls.append((model, list(pks)))
+                    or lock_rows(model, pks)), \
+                mock.patch.object(ordering.Ordered, 'key_for_index',
+                    autospec=True,
+                    side_effect=lambda obj, index: calls.append('key')
+                    or key_for_index(obj, index)):
+            Item.objects.create(list=self.l1, text='new', position=0)
+            Subscription.objects.create(list=self.l1, user=self.u)
+        self.assertEqual(calls, [(List, [self.l1.id]), 'key',
+            (User, [self.u.id]), 'key'])
+        self.assertEqual(self.texts(), ['new', '0', '1', '2'])
+    def test_move_writes_one_row(self):
+        keys = dict(Item.objects.values_list('id', 'position'))
+        self.items[2].move_to(0)
+        changed = [i for i, key in Item.objects.values_list('id', 'position')
+                if keys[i] != key]
+        self.assertEqual(changed, [self.items[2].id])
+        self.assertEqual(self.texts(), ['2', '0', '1'])
+    def test_rebalance_when_no_room(self):
+        # Keep inserting right after the first item until the gap runs out
+        for n in range(30):
+            Item.objects.create(list=self.l1, text='x%d' % n, position=1)
+        self.assertEqual(self.texts(),
+                ['0'] + ['x%d' % n for n in reversed(range(30))] + ['1', '2'])
+        keys = list(Item.objects.filter(list=self.l1)
+                .values_list('position', flat=True))
+        self.assertEqual(len(set(keys)), len(keys))
+    def test_reorder_keeps_longest_run(self):
+        self.assertEqual(ordering.increasing_run([5, 1, 2, 9, 3]), [1, 2, 4])
+        ids = [i.id for i in self.items]
+        self.assertEqual(Item.reorder(self.l1.id, [ids[2], ids[0], ids[1]]),
+                1)
+        self.assertEqual(self.texts(), ['2', '0', '1'])
+        self.assertIsNone(Item.reorder(self.l1.id, ids[:2]))
+    def test_reorder_renumbers_when_no_room(self):
+        Item.objects.filter(pk=self.items[1].pk).update(position=
+                self.items[0].position + 1)
+        ids = [i.id for i in self.items]
+        # 2 can't go between 0 and 1, so all are renumbered and 0 stays at 0
+        self.assertEqual(Item.reorder(self.l1.id, [ids[0], ids[2], ids[1]]),
+                2)
+        self.assertEqual(self.texts(), ['0', '2', '1'])
+    def test_key_between(self):
+        self.assertEqual(ordering.key_between(None, None), 0)
+        self.assertEqual(ordering.key_between(0, 10), 5)
+        self.assertEqual(ordering.key_between(None, 0), -ordering.GAP)
+        self.assertEqual(ordering.key_between(0, None), ordering.GAP)
+        self.assertIsNone(ordering.key_between(4, 5))
+        self.assertIsNone(ordering.key_between(ordering.MAX_KEY, None))
 
 class SubscriptionTest(test.TestCase):
     def setUp(self):
@@ -117,7 +474,7 @@ class SubscriptionTest(test.TestCase):
         s = Subscription.objects.all()[0]
         self.assertEqual(s.user, self.u1)
         self.assertEqual(s.list, self.l1)
-        self.assertEqual(s.position, 0)
+        self.assertEqual(s.index(), 0)
 
 # Test the nontrash_subscriptions manager injected into User
 class UserNontrashSubscriptionsTest(test.TestCase):
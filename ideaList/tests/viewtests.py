@@ -1,9 +1,23 @@
+import gzip
 import json
+import tempfile
+from io import StringIO
+import unittest
+from unittest import mock
+from asgiref.sync import sync_to_async
+from datetime import datetime, timedelta
 from django import test
 from django.test.client import Client
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
-from ideaList.models import List, Item, Subscription
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from ideaList.models import List, Item, ItemFrequency, Subscription
+from ideaList.views import make_state, cached_state, STATE_VERSION_FORMAT
+from ideaList import compression, fastjson, ingest, ordering, push, \
+        suggestions, versions, views
+from undelete.models import signals
 
 class MyViewTest(test.TestCase):
     fixtures = ['auth.json']
@@ -35,6 +49,7 @@ class MainViewTest(MyViewTest):
         r = self.c.get(reverse('ideaList.views.main'))
         self.assertEqual(r.status_code, 200)
         self.assertIn('init_state', r.context)
+        self.assertIn('init_lists', r.context)
         self.assertIn('suggestions_per_row', r.context)
         self.assertIn('suggestions_per_col', r.context)
         self.assertIn('ideaList/main.html', [t.name for t in r.templates])
@@ -47,6 +62,40 @@ class BasicViewTest(MyViewTest):
         self.assertEqual(r.status_code, 200)
         self.assertIn('subscriptions', r.context)
         self.assertIn('ideaList/main_nojs.html', [t.name for t in r.templates])
+    def get_basic(self):
+        with CaptureQueriesContext(connection) as queries:
+            r = self.c.get(reverse('ideaList.views.basic'))
+        self.assertEqual(r.status_code, 200)
+        return r.content.decode('utf-8'), len(queries)
+    def test_lists_and_items(self):
+        l1 = List.objects.create(name='L\xe4ist1', owner=self.u1)
+        l2 = List.objects.create(name='List2', owner=self.u1)
+        for l in (l1, l2):
+            Subscription.objects.create(list=l, user=self.u1)
+        i1 = Item.objects.create(list=l1, text='<b>', important=True)
+        i2 = Item.objects.create(list=l2, text='item2', url='http://a.fi/')
+        Item.objects.create(list=l2, text='trashed').delete()
+        html, n_queries = self.get_basic()
+        self.assertIn('<b>L&auml;ist1</b>', html)
+        self.assertIn('<li class="important"><input type="checkbox" '
+                'name="item_ids" value="%d" /> &lt;b&gt;</li>' % i1.id, html)
+        self.assertIn('<a href="http://a.fi/">item2</a>', html)
+        self.assertNotIn('trashed', html)
+        self.assertLess(html.index('item_ids" value="%d"' % i1.id),
+                html.index('item_ids" value="%d"' % i2.id))
+    def test_queries_and_fragment_cache(self):
+        n_queries = self.get_basic()[1]
+        for n in range(3):
+            l = List.objects.create(name='List%d' % n, owner=self.u1)
+            Subscription.objects.create(list=l, user=self.u1)
+            Item.objects.create(list=l, text='item%d' % n)
+        self.assertEqual(self.get_basic()[1], n_queries + 1) # The items
+        self.assertEqual(self.get_basic()[1], n_queries) # All cached
+        Item.objects.create(list=l, text='new item')
+        html, n = self.get_basic()
+        self.assertEqual(n, n_queries + 1)
+        self.assertIn('new item', html)
+        self.assertIn('item0', html)
 
 class UndeleteViewTest(MyViewTest):
     def setUp(self):
@@ -138,6 +187,516 @@ class GetStateViewTest(MyViewTest):
         self.assertEqual(r.status_code, 200)
         self.check_state_in_response(r)
 
+class MakeStateTest(MyViewTest):
+    def setUp(self):
+        super(MakeStateTest, self).setUp()
+        self.l1 = List.objects.create(name='List1', owner=self.u1)
+        self.l2 = List.objects.create(name='List2', owner=self.u1)
+        self.l3 = List.objects.create(name='List3', owner=self.u2)
+        self.s1 = Subscription.objects.create(list=self.l1, user=self.u1)
+        self.s2 = Subscription.objects.create(list=self.l2, user=self.u1)
+        self.s3 = Subscription.objects.create(list=self.l3, user=self.u2)
+        self.i1 = Item.objects.create(list=self.l1, text='testitem1')
+        self.i2 = Item.objects.create(list=self.l2, text='testitem2')
+        self.i3 = Item.objects.create(list=self.l3, text='testitem3')
+    def test_only_own_subscriptions_and_items(self):
+        state = make_state(self.u1)
+        self.assertEqual(set(state['subscriptions']),
+                set([self.s1.id, self.s2.id]))
+        self.assertEqual(
+                list(state['subscriptions'][self.s1.id]['list']['items']),
+                [self.i1.id])
+        self.assertEqual(
+                list(state['subscriptions'][self.s2.id]['list']['items']),
+                [self.i2.id])
+        # The list menu is fetched separately, see GetListsViewTest
+        self.assertEqual(list(state), ['subscriptions'])
+    def test_trashed_list_excluded(self):
+        self.l2.delete()
+        state = make_state(self.u1)
+        self.assertEqual(list(state['subscriptions']), [self.s1.id])
+    def test_constant_number_of_queries(self):
+        with self.assertNumQueries(2):
+            make_state(self.u1)
+        for n in range(10):
+            l = List.objects.create(name='Extra%d' % n, owner=self.u1)
+            Subscription.objects.create(list=l, user=self.u1)
+            for m in range(5):
+                Item.objects.create(list=l, text='item%d' % m)
+        with self.assertNumQueries(2):
+            make_state(self.u1)
+
+class FastJsonTest(test.TestCase):
+    def test_backends_agree(self):
+        data = {1: {'text': 'maito \u00e4 "x"', 'url': '', 'ok': True},
+                'list': [1, 2.5, None]}
+        encoded = set([dumps(data)
+            for dumps, loads in fastjson.BACKENDS.values()])
+        self.assertEqual(len(encoded), 1)
+        self.assertEqual(fastjson.loads(encoded.pop()), json.loads(
+            json.dumps(data)))
+
+class CompressionTest(MyViewTest):
+    def setUp(self):
+        super(CompressionTest, self).setUp()
+        self.l1 = List.objects.create(name='List1', owner=self.u1)
+        Subscription.objects.create(list=self.l1, user=self.u1)
+        for n in range(20):
+            Item.objects.create(list=self.l1, text='testitem%d' % n)
+    def get_state(self, encoding):
+        r = self.c.get(reverse('ideaList.views.get_state'),
+                HTTP_ACCEPT_ENCODING=encoding)
+        self.assertEqual(r.status_code, 200)
+        self.assertIn('Accept-Encoding', r['Vary'])
+        return r
+    def test_gzip(self):
+        r = self.get_state('gzip, deflate')
+        self.assertEqual(r['Content-Encoding'], 'gzip')
+        self.assertTrue(r['ETag'].startswith('W/'))
+        data = json.loads(gzip.decompress(r.content))
+        self.assertIn(self.l1.id, [s['list']['id']
+            for s in data['state']['subscriptions'].values()])
+    def test_gzip_reuses_compressed_state(self):
+        first = gzip.decompress(self.get_state('gzip').content)
+        with mock.patch.object(compression, 'deflate',
+                wraps=compression.deflate) as deflate:
+            second = gzip.decompress(self.get_state('gzip').content)
+        # Only the version and msg after the state are compressed again
+        self.assertEqual(deflate.call_count, 1)
+        self.assertLess(len(deflate.call_args[0][0]), 100)
+        self.assertEqual(json.loads(first)['state'],
+                json.loads(second)['state'])
+    @unittest.skipIf(compression.brotli is None, 'brotli not installed')
+    def test_brotli(self):
+        r = self.c.get(reverse('ideaList.views.get_frequents'),
+                HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(r['Content-Encoding'], 'br')
+        self.assertIs(type(json.loads(compression.brotli.decompress(
+            r.content))), dict)
+    def test_not_accepted(self):
+        r = self.get_state('gzip;q=0, identity')
+        self.assertFalse(r.has_header('Content-Encoding'))
+        self.check_state_in_response(r)
+    def test_gzip_with_prefix(self):
+        data = b'{"state":' + b'x' * 1000 + b',"version":"1"}'
+        for length in (0, 10, len(data)):
+            self.assertEqual(gzip.decompress(
+                compression.gzip_with_prefix(data, length)), data)
+
+class StreamStateTest(MyViewTest):
+    def setUp(self):
+        super(StreamStateTest, self).setUp()
+        self.l1 = List.objects.create(name='List1', owner=self.u1)
+        self.l2 = List.objects.create(name='List2', owner=self.u1)
+        self.l3 = List.objects.create(name='Empty \u00e4', owner=self.u2)
+        for l in (self.l3, self.l1, self.l2):
+            Subscription.objects.create(list=l, user=self.u1)
+        for n in range(10):
+            Item.objects.create(list=self.l1 if n % 3 else self.l2,
+                    text='testitem "%d" \u00e4' % n, important=n % 2 == 0,
+                    url=n % 4 and 'http://example.com/' or '')
+    def test_byte_identical(self):
+        for dumps, loads in fastjson.BACKENDS.values():
+            with mock.patch.object(fastjson, 'dumps', dumps):
+                self.assertEqual(b''.join(views.stream_state(self.u1)),
+                        dumps(make_state(self.u1)))
+    def test_streamed_when_big(self):
+        with mock.patch.object(views, 'STREAM_STATE_ITEMS', 5):
+            r = self.c.get(reverse('ideaList.views.get_state'))
+        self.assertTrue(r.streaming)
+        content = b''.join(r.streaming_content)
+        self.assertTrue(content.startswith(b'{"state":'
+            + fastjson.dumps(make_state(self.u1)) + b',"version":'))
+        self.assertEqual(fastjson.loads(content)['msg'], '')
+    def test_streamed_gzipped(self):
+        with mock.patch.object(views, 'STREAM_STATE_ITEMS', 5):
+            r = self.c.get(reverse('ideaList.views.get_state'),
+                    HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(r['Content-Encoding'], 'gzip')
+        self.check_state_in_response(mock.Mock(content=gzip.decompress(
+            b''.join(r.streaming_content))))
+    def item_queries(self, **extra):
+        "Return the item queries of an uncached get_state and the response."
+        versions.bump_users([self.u1.id])
+        with CaptureQueriesContext(connection) as ctx:
+            r = self.c.get(reverse('ideaList.views.get_state'), **extra)
+            content = b''.join(r.streaming_content) if r.streaming \
+                    else r.content
+        return [q['sql'] for q in ctx.captured_queries
+                if 'ideaList_item' in q['sql']], r, content
+    def test_items_read_once(self):
+        for size in (5, 100):
+            with mock.patch.object(views, 'STREAM_STATE_ITEMS', size):
+                queries, r, content = self.item_queries()
+            self.assertEqual(r.streaming, size == 5)
+            self.assertEqual(len(queries), 1)
+            self.assertNotIn('COUNT', queries[0])
+            self.assertEqual(fastjson.loads(content)['state'],
+                    fastjson.loads(fastjson.dumps(make_state(self.u1))))
+    def test_not_streamed_when_small_or_cached(self):
+        r = self.c.get(reverse('ideaList.views.get_state'))
+        self.assertFalse(r.streaming)
+        with mock.patch.object(views, 'STREAM_STATE_ITEMS', 5):
+            r = self.c.get(reverse('ideaList.views.get_state'))
+        self.assertFalse(r.streaming)
+
+class CachedStateTest(MyViewTest):
+    def setUp(self):
+        super(CachedStateTest, self).setUp()
+        self.l1 = List.objects.create(name='List1', owner=self.u1)
+        self.l2 = List.objects.create(name='List2', owner=self.u2)
+        self.s1 = Subscription.objects.create(list=self.l1, user=self.u1)
+        self.i1 = Item.objects.create(list=self.l1, text='testitem1')
+    def test_cached(self):
+        state, content = cached_state(self.u1)
+        self.assertEqual(state, make_state(self.u1))
+        self.assertEqual(json.loads(content), json.loads(json.dumps(state)))
+        with self.assertNumQueries(0):
+            self.assertEqual(cached_state(self.u1)[1], content)
+    def test_invalidated_by_own_change(self):
+        cached_state(self.u1)
+        i2 = Item.objects.create(list=self.l1, text='testitem2')
+        items = cached_state(self.u1)[0]['subscriptions'][self.s1.id] \
+                ['list']['items']
+        self.assertIn(i2.id, items)
+        Item.objects.get(pk=i2.id).delete()
+        items = cached_state(self.u1)[0]['subscriptions'][self.s1.id] \
+                ['list']['items']
+        self.assertNotIn(i2.id, items)
+    def test_invalidated_by_subscription(self):
+        cached_state(self.u1)
+        s2 = Subscription.objects.create(list=self.l2, user=self.u1)
+        self.assertIn(s2.id, cached_state(self.u1)[0]['subscriptions'])
+    def test_not_invalidated_by_others(self):
+        cached_state(self.u1)
+        Item.objects.create(list=self.l2, text='testitem2')
+        with self.assertNumQueries(0):
+            cached_state(self.u1)
+    def test_state_response_uses_cache(self):
+        r = self.c.get(reverse('ideaList.views.get_state'))
+        data = self.check_state_in_response(r)
+        self.assertEqual(data['state'],
+                json.loads(json.dumps(make_state(self.u1))))
+
+class StateDeltaTest(MyViewTest):
+    def setUp(self):
+        super(StateDeltaTest, self).setUp()
+        self.l1 = List.objects.create(name='List1', owner=self.u1)
+        self.l2 = List.objects.create(name='List2', owner=self.u1)
+        self.s1 = Subscription.objects.create(list=self.l1, user=self.u1)
+        self.s2 = Subscription.objects.create(list=self.l2, user=self.u1)
+        self.i1 = Item.objects.create(list=self.l1, text='testitem1')
+        self.i2 = Item.objects.create(list=self.l1, text='testitem2')
+        # Pretend that everything above happened well before the version
+        past = datetime.now() - timedelta(minutes=20)
+        for cls in (List, Subscription, Item):
+            cls.objects.update(last_changed=past)
+        self.since = (datetime.now() - timedelta(minutes=10)).strftime(
+                STATE_VERSION_FORMAT)
+    def get_delta(self):
+        r = self.c.get(reverse('ideaList.views.get_state'),
+                {'since':self.since})
+        self.assertEqual(r.status_code, 200)
+        data = json.loads(r.content)
+        self.assertIn('version', data)
+        self.assertNotIn('state', data)
+        return data['delta']
+    def test_nothing_changed(self):
+        delta = self.get_delta()
+        for key in ('subscriptions', 'items'):
+            self.assertEqual(delta[key], {})
+        for key in ('removed_subscriptions', 'removed_items'):
+            self.assertEqual(delta[key], [])
+    def test_item_added_and_removed(self):
+        i3 = Item.objects.create(list=self.l2, text='testitem3')
+        Item.objects.get(pk=self.i2.id).delete()
+        delta = self.get_delta()
+        self.assertEqual(list(delta['items']), [str(i3.id)])
+        self.assertEqual(delta['removed_items'], [self.i2.id])
+        self.assertEqual(delta['subscriptions'], {})
+    def test_list_renamed(self):
+        self.l2.name = 'Renamed'
+        self.l2.save()
+        delta = self.get_delta()
+        self.assertEqual(list(delta['subscriptions']), [str(self.s2.id)])
+        self.assertEqual(
+                delta['subscriptions'][str(self.s2.id)]['list']['name'],
+                'Renamed')
+    def test_item_moved_to_unsubscribed_list(self):
+        l3 = List.objects.create(name='List3', owner=self.u2)
+        views.move_object(self.u2, Item, self.i1.id, 0, l3.id)
+        self.assertNotIn(self.i1.id, make_state(self.u1)['subscriptions']
+                [self.s1.id]['list']['items'])
+        delta = self.get_delta()
+        self.assertEqual(list(delta['subscriptions']), [str(self.s1.id)])
+        self.assertEqual(
+                list(delta['subscriptions'][str(self.s1.id)]['list']['items']),
+                [str(self.i2.id)])
+    def test_subscription_removed(self):
+        Subscription.objects.get(pk=self.s1.id).delete()
+        delta = self.get_delta()
+        self.assertEqual(delta['removed_subscriptions'], [self.s1.id])
+        self.assertEqual(delta['items'], {})
+    def test_new_subscription_sent_whole(self):
+        l3 = List.objects.create(name='List3', owner=self.u2)
+        i3 = Item.objects.create(list=l3, text='testitem3')
+        List.objects.filter(pk=l3.id).update(
+                last_changed=datetime.now() - timedelta(minutes=20))
+        Item.objects.filter(pk=i3.id).update(
+                last_changed=datetime.now() - timedelta(minutes=20))
+        s3 = Subscription.objects.create(list=l3, user=self.u1)
+        delta = self.get_delta()
+        self.assertEqual(list(delta['subscriptions']), [str(s3.id)])
+        self.assertEqual(
+                list(delta['subscriptions'][str(s3.id)]['list']['items']),
+                [str(i3.id)])
+    def test_invalid_version_gives_whole_state(self):
+        for since in ('invalid', '2001-01-01T00:00:00.000000'):
+            r = self.c.get(reverse('ideaList.views.get_state'),
+                    {'since':since})
+            self.assertEqual(r.status_code, 200)
+            data = self.check_state_in_response(r)
+            self.assertNotIn('delta', data)
+    def test_version_in_header(self):
+        r = self.c.post(reverse('ideaList.views.remove_items'),
+                {'item_ids':self.i1.id}, HTTP_X_STATE_SINCE=self.since,
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(r.status_code, 200)
+        data = json.loads(r.content)
+        self.assertEqual(data['delta']['removed_items'], [self.i1.id])
+
+class CompactStateTest(MyViewTest):
+    def setUp(self):
+        super(CompactStateTest, self).setUp()
+        self.l1 = List.objects.create(name='List1', owner=self.u1)
+        self.l2 = List.objects.create(name='List2', owner=self.u2)
+        self.s1 = Subscription.objects.create(list=self.l1, user=self.u1)
+        self.i1 = Item.objects.create(list=self.l1, text='testitem1')
+        self.i2 = Item.objects.create(list=self.l1, text='testitem2',
+                url='http://example.com/', important=True)
+        self.i3 = Item.objects.create(list=self.l1, text='testitem3',
+                position=0)
+    def get_state(self, **extra):
+        r = self.c.get(reverse('ideaList.views.get_state'), **extra)
+        self.assertEqual(r.status_code, 200)
+        self.assertIn('Accept', r['Vary'])
+        return json.loads(r.content)
+    def test_compact_state(self):
+        data = self.get_state(data={'format': 'compact'})
+        self.assertEqual(data['format'], 'compact')
+        positions = dict((i.id, i.position) for i in Item.objects.all())
+        self.assertEqual(data['state'], {
+            'lists': [[self.l1.id, 'List1', self.u1.id]],
+            'subscriptions': [[self.s1.id, self.l1.id, self.s1.position]],
+            'items': {str(self.l1.id): [
+                [self.i3.id, 'testitem3', positions[self.i3.id]],
+                [self.i1.id, 'testitem1', positions[self.i1.id]],
+                [self.i2.id, 'testitem2', positions[self.i2.id],
+                    'http://example.com/', 1]]}})
+    def test_accept_header(self):
+        data = self.get_state(
+                HTTP_ACCEPT='application/vnd.idealist.compact+json')
+        self.assertEqual(data['format'], 'compact')
+        self.assertNotIn('format', self.get_state())
+    def test_formats_have_own_etags(self):
+        etag = self.c.get(reverse('ideaList.views.get_state'))['ETag']
+        r = self.c.get(reverse('ideaList.views.get_state'),
+                {'format': 'compact'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 200)
+        self.assertNotEqual(r['ETag'], etag)
+    def test_compact_delta(self):
+        past = datetime.now() - timedelta(minutes=20)
+        for cls in (List, Subscription, Item):
+            cls.objects.update(last_changed=past)
+        since = (datetime.now() - timedelta(minutes=10)).strftime(
+                STATE_VERSION_FORMAT)
+        l3 = List.objects.create(name='List3', owner=self.u1)
+        s3 = Subscription.objects.create(list=l3, user=self.u1)
+        i4 = Item.objects.create(list=l3, text='testitem4')
+        Item.objects.get(pk=self.i2.id).delete()
+        data = self.get_state(data={'format': 'compact', 'since': since})
+        delta = data['delta']
+        self.assertEqual(delta['lists'], [[l3.id, 'List3', self.u1.id]])
+        self.assertEqual(delta['subscriptions'],
+                [[s3.id, l3.id, Subscription.objects.get(pk=s3.id).position]])
+        self.assertEqual(delta['items'], {
+            str(l3.id): [[i4.id, 'testitem4', i4.position]]})
+        self.assertEqual(delta['removed_items'], [self.i2.id])
+        self.assertEqual(delta['removed_subscriptions'], [])
+    def test_smaller(self):
+        for n in range(50):
+            Item.objects.create(list=self.l1, text='item%d' % n)
+        full = self.c.get(reverse('ideaList.views.get_state')).content
+        compact = self.c.get(reverse('ideaList.views.get_state'),
+                {'format': 'compact'}).content
+        self.assertLess(len(compact) * 2, len(full))
+
+class ConditionalGetTest(MyViewTest):
+    def setUp(self):
+        super(ConditionalGetTest, self).setUp()
+        self.l1 = List.objects.create(name='List1', owner=self.u1)
+        self.l2 = List.objects.create(name='List2', owner=self.u2)
+        self.s1 = Subscription.objects.create(list=self.l1, user=self.u1)
+    def check_not_modified(self, viewname):
+        r = self.c.get(reverse(viewname))
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.has_header('ETag'))
+        etag = r['ETag']
+        r = self.c.get(reverse(viewname), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 304)
+        return etag
+    def test_state_not_modified(self):
+        self.check_not_modified('ideaList.views.get_state')
+    def test_frequents_not_modified(self):
+        self.check_not_modified('ideaList.views.get_frequents')
+    def test_state_modified_by_item(self):
+        etag = self.check_not_modified('ideaList.views.get_state')
+        Item.objects.create(list=self.l1, text='testitem1')
+        r = self.c.get(reverse('ideaList.views.get_state'),
+                HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 200)
+        self.check_state_in_response(r)
+    def test_state_not_modified_by_unsubscribed_item(self):
+        etag = self.check_not_modified('ideaList.views.get_state')
+        Item.objects.create(list=self.l2, text='testitem1')
+        r = self.c.get(reverse('ideaList.views.get_state'),
+                HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 304)
+    def test_state_not_modified_by_unsubscribed_list(self):
+        etag = self.check_not_modified('ideaList.views.get_state')
+        List.objects.create(name='List3', owner=self.u2)
+        self.l2.name = 'Renamed'
+        self.l2.save()
+        r = self.c.get(reverse('ideaList.views.get_state'),
+                HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 304)
+    def test_lists_modified_by_new_list(self):
+        etag = self.check_not_modified('ideaList.views.get_lists')
+        List.objects.create(name='List3', owner=self.u2)
+        r = self.c.get(reverse('ideaList.views.get_lists'),
+                HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 200)
+    def test_frequents_modified_by_item(self):
+        etag = self.check_not_modified('ideaList.views.get_frequents')
+        Item.objects.create(list=self.l1, text='testitem1')
+        r = self.c.get(reverse('ideaList.views.get_frequents'),
+                HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 200)
+        self.assertIn(str(self.l1.id), json.loads(r.content))
+
+# Requests to the async view are handled in other threads, which can't see the
+# uncommitted data of a TestCase
+class WaitStateViewTest(test.TransactionTestCase):
+    fixtures = ['auth.json']
+    def setUp(self):
+        self.u1 = User.objects.get(username='visa')
+        self.l1 = List.objects.create(name='List1', owner=self.u1)
+        self.s1 = Subscription.objects.create(list=self.l1, user=self.u1)
+        self.client.force_login(self.u1)
+        self.etag = self.client.get(reverse('ideaList.views.get_state'))['ETag']
+        self.old_timeout = push.TIMEOUT
+        push.TIMEOUT = 0.5
+    def tearDown(self):
+        push.TIMEOUT = self.old_timeout
+    async def wait_state(self, login=True):
+        if login:
+            await sync_to_async(self.async_client.force_login)(self.u1)
+        # The async client takes extra headers by their HTTP names
+        return await self.async_client.get(
+                reverse('ideaList.views.wait_state'),
+                **{'If-None-Match': self.etag})
+    def test_not_available_under_wsgi(self):
+        r = self.client.get(reverse('ideaList.views.wait_state'),
+                HTTP_IF_NONE_MATCH=self.etag)
+        self.assertEqual(r.status_code, 501)
+    async def test_login_required(self):
+        r = await self.wait_state(login=False)
+        self.assertEqual(r.status_code, 403)
+    async def test_not_modified(self):
+        r = await self.wait_state()
+        self.assertEqual(r.status_code, 304)
+    async def test_changed(self):
+        await sync_to_async(Item.objects.create)(list=self.l1, text='item')
+        r = await self.wait_state()
+        self.assertEqual(r.status_code, 200)
+        self.assertNotEqual(r['ETag'], self.etag)
+        self.assertIn('state', json.loads(r.content))
+
+class AsyncStateTest(test.TransactionTestCase):
+    fixtures = ['auth.json']
+    def setUp(self):
+        self.u1 = User.objects.get(username='visa')
+        self.l1 = List.objects.create(name='List1', owner=self.u1)
+        self.l2 = List.objects.create(name='List2', owner=self.u1)
+        self.s1 = Subscription.objects.create(list=self.l1, user=self.u1)
+        Item.objects.create(list=self.l1, text='item1')
+        Item.objects.create(list=self.l2, text='item2')
+    async def get(self, viewname, login=True, **extra):
+        if login:
+            await sync_to_async(self.async_client.force_login)(self.u1)
+        return await self.async_client.get(reverse(viewname), **extra)
+    async def test_make_state_async(self):
+        self.assertEqual(await views.make_state_async(self.u1),
+                await sync_to_async(make_state)(self.u1))
+    def test_items_of_unsubscribed_lists_left_out(self):
+        subs = list(views.state_subscription_rows(self.u1))
+        state = views.build_state(subs, views.state_item_rows(
+            [self.l1.id, self.l2.id]))
+        self.assertEqual(state, make_state(self.u1))
+    async def test_login_required(self):
+        for viewname in ('ideaList.views.main', 'ideaList.views.get_state'):
+            r = await self.get(viewname, login=False)
+            self.assertEqual(r.status_code, 302)
+            self.assertIn(reverse('django.contrib.auth.views.login'),
+                    r['Location'])
+    async def test_get_state(self):
+        r = await self.get('ideaList.views.get_state')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(json.loads(r.content)['state'],
+                json.loads(fastjson.dumps(
+                    await sync_to_async(make_state)(self.u1))))
+        self.assertIn('no-cache', r['Cache-Control'])
+        r = await self.get('ideaList.views.get_state',
+                **{'If-None-Match': r['ETag']})
+        self.assertEqual(r.status_code, 304)
+    async def test_main_caches_state(self):
+        r = await self.get('ideaList.views.main')
+        self.assertEqual(r.status_code, 200)
+        self.assertIn('item1', r.content.decode('utf-8'))
+        key = await sync_to_async(views.state_cache_key)(self.u1)
+        self.assertTrue(await sync_to_async(views.cache.has_key)(key))
+
+class GetListsViewTest(MyViewTest):
+    def setUp(self):
+        super(GetListsViewTest, self).setUp()
+        self.l1 = List.objects.create(name='List1', owner=self.u1)
+        self.l2 = List.objects.create(name='List2', owner=self.u2)
+        self.l3 = List.objects.create(name='List3', owner=self.u2)
+        self.l3.delete()
+    def test_login_required(self):
+        self.check_login_required('ideaList.views.get_lists')
+    def test_get(self):
+        r = self.c.get(reverse('ideaList.views.get_lists'))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(json.loads(r.content), {'lists': {
+            str(self.l1.id): {'id': self.l1.id, 'name': 'List1',
+                'owner_id': self.u1.id},
+            str(self.l2.id): {'id': self.l2.id, 'name': 'List2',
+                'owner_id': self.u2.id}}})
+    def test_cached_once_for_all_users(self):
+        views.cached_list_menu()
+        with self.assertNumQueries(0):
+            views.cached_list_menu()
+        self.l2.name = 'Renamed'
+        self.l2.save()
+        self.assertIn(b'Renamed', views.cached_list_menu())
+    def test_user_versions_not_bumped(self):
+        version = versions.user_version(self.u2.id)
+        List.objects.create(name='List4', owner=self.u1)
+        self.l1.name = 'Renamed'
+        self.l1.save()
+        self.assertEqual(versions.user_version(self.u2.id), version)
+
 class GetFrequentsViewTest(MyViewTest):
     def test_login_required(self):
         self.check_login_required('ideaList.views.get_frequents')
@@ -150,6 +709,144 @@ class GetFrequentsViewTest(MyViewTest):
             self.fail('Response was not valid JSON')
         self.assertIs(type(response_data), dict)
 
+class GetFrequentsPageViewTest(MyViewTest):
+    def setUp(self):
+        super(GetFrequentsPageViewTest, self).setUp()
+        self.l1 = List.objects.create(name='List1', owner=self.u1)
+        Subscription.objects.create(user=self.u1, list=self.l1)
+        for t in ('a','b','c','b','c','c'):
+            Item.objects.create(text=t, list=self.l1)
+    def test_login_required(self):
+        self.check_login_required('ideaList.views.get_frequents_page')
+    def test_get_page(self):
+        r = self.c.get(reverse('ideaList.views.get_frequents_page'),
+                {'list_id': self.l1.id, 'offset': 1, 'limit': 1})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(json.loads(r.content), {'list_id': self.l1.id,
+            'offset': 1, 'texts': ['b'], 'more': True})
+    def test_limit_is_capped(self):
+        r = self.c.get(reverse('ideaList.views.get_frequents_page'),
+                {'list_id': self.l1.id, 'offset': 0, 'limit': 10**6})
+        self.assertEqual(json.loads(r.content)['texts'], ['c','b','a'])
+    def test_not_subscribed(self):
+        l2 = List.objects.create(name='List2', owner=self.u1)
+        r = self.c.get(reverse('ideaList.views.get_frequents_page'),
+                {'list_id': l2.id})
+        self.assertEqual(r.status_code, 403)
+    def test_invalid_parameters(self):
+        r = self.c.get(reverse('ideaList.views.get_frequents_page'),
+                {'list_id': self.l1.id, 'offset': 'x'})
+        self.assertEqual(r.status_code, 400)
+
+class SuggestViewTest(MyViewTest):
+    def setUp(self):
+        super(SuggestViewTest, self).setUp()
+        suggestions.clear()
+        self.l1 = List.objects.create(name='List1', owner=self.u1)
+        Subscription.objects.create(user=self.u1, list=self.l1)
+        for t in ('milk', 'mint', 'milk', 'bread'):
+            Item.objects.create(text=t, list=self.l1)
+    def test_login_required(self):
+        self.check_login_required('ideaList.views.suggest')
+    def test_suggest(self):
+        r = self.c.get(reverse('ideaList.views.suggest'),
+                {'list_id': self.l1.id, 'prefix': 'mi'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(json.loads(r.content), {'list_id': self.l1.id,
+            'prefix': 'mi', 'suggestions': ['milk', 'mint']})
+    def test_limit(self):
+        r = self.c.get(reverse('ideaList.views.suggest'),
+                {'list_id': self.l1.id, 'prefix': '', 'limit': 1})
+        self.assertEqual(json.loads(r.content)['suggestions'], ['milk'])
+    def test_not_subscribed(self):
+        l2 = List.objects.create(name='List2', owner=self.u1)
+        r = self.c.get(reverse('ideaList.views.suggest'),
+                {'list_id': l2.id, 'prefix': 'mi'})
+        self.assertEqual(r.status_code, 403)
+    def test_missing_prefix(self):
+        r = self.c.get(reverse('ideaList.views.suggest'),
+                {'list_id': self.l1.id})
+        self.assertEqual(r.status_code, 400)
+
+class AddItemsAlexaViewTest(MyViewTest):
+    def setUp(self):
+        super(AddItemsAlexaViewTest, self).setUp()
+        self.l1 = List.objects.create(name='List1', owner=self.u1)
+        self.l2 = List.objects.create(name='List2', owner=self.u1)
+        self.old = Item.objects.create(list=self.l1, text='old')
+        queue_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(queue_dir.cleanup)
+        for patcher in (mock.patch.object(ingest, 'QUEUE_DIR', queue_dir.name),
+                mock.patch.object(ingest, 'schedule_flush')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.url = reverse('ideaList.views.add_items_alexa')
+    def post(self, items):
+        return self.c.post(self.url, {'items': json.dumps(items)})
+    def test_queued_and_flushed(self):
+        r = self.post([{'list': self.l1.id, 'text': 'milk'},
+            {'list': self.l2.id, 'text': ' Eggs '}])
+        self.assertEqual(r.status_code, 202)
+        r = self.post([{'list': self.l1.id, 'text': 'bread'}])
+        self.assertEqual(r.status_code, 202)
+        self.assertEqual(ingest.schedule_flush.call_count, 2)
+        self.assertEqual(Item.objects.count(), 1)
+        version = versions.list_version(self.l1.id)
+
+        # A transaction of five statements per list
+        with self.assertNumQueries(2*(5+2)):
+            self.assertEqual(ingest.flush(), 3)
+        self.assertEqual(list(self.l1.items.values_list('text', flat=True)),
+                ['bread', 'milk', 'old'])
+        self.assertEqual(list(self.l2.items.values_list('text', flat=True)),
+                ['Eggs'])
+        self.assertNotEqual(versions.list_version(self.l1.id), version)
+        self.assertEqual(ItemFrequency.objects.get(list=self.l2,
+            text='eggs').frequency, 1)
+        self.assertEqual(ingest.queued_paths(), [])
+        self.assertEqual(ingest.flush(), 0)
+    def test_missing_list_dropped(self):
+        self.post([{'list': self.l1.id + 1000, 'text': 'milk'},
+            {'list': self.l2.id, 'text': 'eggs'}])
+        self.assertEqual(ingest.flush(), 1)
+        self.assertEqual(ingest.queued_paths(), [])
+    def test_failing_list_moved_aside(self):
+        self.post([{'list': self.l1.id, 'text': 'milk'},
+            {'list': self.l2.id, 'text': 'eggs'}])
+        self.post([{'list': self.l2.id, 'text': 'bread'}])
+        add_items = ingest.add_items
+        def fail_on_l2(list_id, texts):
+            if list_id == self.l2.id:
+                raise ValueError('broken')
+            return add_items(list_id, texts)
+        with mock.patch.object(ingest, 'add_items', side_effect=fail_on_l2), \
+                self.assertLogs('ideaList.ingest', 'ERROR'):
+            self.assertEqual(ingest.flush(), 1)
+        self.assertEqual(ingest.queued_paths(), [])
+        failed = ingest.queued_paths(ingest.FAILED_SUFFIX)
+        self.assertEqual(len(failed), 1)
+        with open(failed[0]) as f:
+            self.assertEqual(json.load(f),
+                    [[self.l2.id, 'eggs'], [self.l2.id, 'bread']])
+        # The list that was added isn't added again
+        self.assertEqual(ingest.flush(), 0)
+        self.assertEqual(self.l1.items.count(), 2)
+    def test_invalid(self):
+        self.assertEqual(self.c.get(self.url).status_code, 400)
+        self.assertEqual(self.c.post(self.url).status_code, 400)
+        for items in ({'list': self.l1.id, 'text': 'milk'},
+                [{'list': self.l1.id}], [{'list': 'x', 'text': 'milk'}],
+                [{'list': self.l1.id, 'text': ' '}],
+                [{'list': self.l1.id, 'text': 'x'*201}]):
+            self.assertEqual(self.post(items).status_code, 400, items)
+        self.assertEqual(ingest.queued_paths(), [])
+    def test_command(self):
+        self.post([{'list': self.l1.id, 'text': 'milk'}])
+        out = StringIO()
+        call_command('idealist_ingest', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'Added 1 queued items')
+        self.assertEqual(self.l1.items.count(), 2)
+
 class AddSubscriptionViewTest(MyViewTest):
     def setUp(self):
         super(AddSubscriptionViewTest, self).setUp()
@@ -259,9 +956,9 @@ class MoveSubscriptionViewTest(MyViewTest):
         self.s1 = Subscription.objects.create(list=self.l1, user=self.u1)
         self.s2 = Subscription.objects.create(list=self.l2, user=self.u1)
         self.s3 = Subscription.objects.create(list=self.l3, user=self.u1)
-        self.assertEqual(self.s1.position, 0)
-        self.assertEqual(self.s2.position, 1)
-        self.assertEqual(self.s3.position, 2)
+        self.assertEqual(self.s1.index(), 0)
+        self.assertEqual(self.s2.index(), 1)
+        self.assertEqual(self.s3.index(), 2)
     def test_login_required(self):
         self.check_login_required('ideaList.views.move_subscription')
     def test_move_up(self):
@@ -269,24 +966,24 @@ class MoveSubscriptionViewTest(MyViewTest):
                 {'subscription_id':self.s2.id, 'where':'up'},
                 HTTP_X_REQUESTED_WITH='XMLHttpRequest')
         self.assertEqual(r.status_code, 200)
-        self.assertEqual(Subscription.objects.get(pk=self.s2.id).position, 0)
-        self.assertEqual(Subscription.objects.get(pk=self.s1.id).position, 1)
+        self.assertEqual(Subscription.objects.get(pk=self.s2.id).index(), 0)
+        self.assertEqual(Subscription.objects.get(pk=self.s1.id).index(), 1)
         self.check_state_in_response(r)
     def test_move_upmost_up(self):
         r = self.c.post(reverse('ideaList.views.move_subscription'),
                 {'subscription_id':self.s1.id, 'where':'up'},
                 HTTP_X_REQUESTED_WITH='XMLHttpRequest')
         self.assertEqual(r.status_code, 200)
-        self.assertEqual(Subscription.objects.get(pk=self.s1.id).position, 0)
-        self.assertEqual(Subscription.objects.get(pk=self.s2.id).position, 1)
+        self.assertEqual(Subscription.objects.get(pk=self.s1.id).index(), 0)
+        self.assertEqual(Subscription.objects.get(pk=self.s2.id).index(), 1)
         self.check_state_in_response(r)
     def test_move_down(self):
         r = self.c.post(reverse('ideaList.views.move_subscription'),
                 {'subscription_id':self.s2.id, 'where':'down'},
                 HTTP_X_REQUESTED_WITH='XMLHttpRequest')
         self.assertEqual(r.status_code, 200)
-        self.assertEqual(Subscription.objects.get(pk=self.s2.id).position, 2)
-        self.assertEqual(Subscription.objects.get(pk=self.s3.id).position, 1)
+        self.assertEqual(Subscription.objects.get(pk=self.s2.id).index(), 2)
+        self.assertEqual(Subscription.objects.get(pk=self.s3.id).index(), 1)
         self.check_state_in_response(r)
     def test_move_down_across_trashed_subscription(self):
         self.s2.delete()
@@ -294,9 +991,9 @@ class MoveSubscriptionViewTest(MyViewTest):
                 {'subscription_id':self.s1.id, 'where':'down'},
                 HTTP_X_REQUESTED_WITH='XMLHttpRequest')
         self.assertEqual(r.status_code, 200)
-        self.assertEqual(Subscription.objects.get(pk=self.s1.id).position, 2)
-        self.assertEqual(Subscription.objects.get(pk=self.s2.id).position, 0)
-        self.assertEqual(Subscription.objects.get(pk=self.s3.id).position, 1)
+        self.assertEqual(Subscription.objects.get(pk=self.s1.id).index(), 1)
+        self.assertEqual(Subscription.objects.get(pk=self.s2.id).index(), 0)
+        self.assertEqual(Subscription.objects.get(pk=self.s3.id).index(), 0)
         self.check_state_in_response(r)
     def test_move_up_across_trashed_subscription(self):
         self.s2.delete()
@@ -304,18 +1001,18 @@ class MoveSubscriptionViewTest(MyViewTest):
                 {'subscription_id':self.s3.id, 'where':'up'},
                 HTTP_X_REQUESTED_WITH='XMLHttpRequest')
         self.assertEqual(r.status_code, 200)
-        self.assertEqual(Subscription.objects.get(pk=self.s1.id).position, 1)
-        self.assertEqual(Subscription.objects.get(pk=self.s2.id).position, 2)
-        self.assertEqual(Subscription.objects.get(pk=self.s3.id).position, 0)
+        self.assertEqual(Subscription.objects.get(pk=self.s1.id).index(), 1)
+        self.assertEqual(Subscription.objects.get(pk=self.s2.id).index(), 2)
+        self.assertEqual(Subscription.objects.get(pk=self.s3.id).index(), 0)
         self.check_state_in_response(r)
     def test_move_abs(self):
         r = self.c.post(reverse('ideaList.views.move_subscription'),
                 {'subscription_id':self.s1.id, 'where':2},
                 HTTP_X_REQUESTED_WITH='XMLHttpRequest')
         self.assertEqual(r.status_code, 200)
-        self.assertEqual(Subscription.objects.get(pk=self.s1.id).position, 2)
-        self.assertEqual(Subscription.objects.get(pk=self.s2.id).position, 0)
-        self.assertEqual(Subscription.objects.get(pk=self.s3.id).position, 1)
+        self.assertEqual(Subscription.objects.get(pk=self.s1.id).index(), 2)
+        self.assertEqual(Subscription.objects.get(pk=self.s2.id).index(), 0)
+        self.assertEqual(Subscription.objects.get(pk=self.s3.id).index(), 1)
         self.check_state_in_response(r)
 
 class RemoveItemsViewTest(MyViewTest):
@@ -338,6 +1035,27 @@ class RemoveItemsViewTest(MyViewTest):
         self.assertEqual(Item.trash.count(), 1)
         self.assertEqual(Item.nontrash.count(), 2)
         self.check_state_in_response(r)
+    def test_query_count_independent_of_item_count(self):
+        trashed = []
+        def receiver(sender, pks, **kwargs):
+            trashed.append(sorted(pks))
+        signals.post_bulk_trash.connect(receiver, sender=Item)
+        def count_queries(item_ids):
+            with CaptureQueriesContext(connection) as ctx:
+                r = self.c.post(reverse('ideaList.views.remove_items'),
+                        {'item_ids':item_ids},
+                        HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            self.assertEqual(r.status_code, 200)
+            return len(ctx.captured_queries)
+        try:
+            few = count_queries([self.i1.id, self.i2.id])
+            many = [Item.objects.create(list=self.l1, text='i%d' % n).id
+                    for n in range(40)]
+            self.assertEqual(count_queries(many), few)
+        finally:
+            signals.post_bulk_trash.disconnect(receiver, sender=Item)
+        self.assertEqual(trashed, [sorted([self.i1.id, self.i2.id]), many])
+        self.assertEqual(Item.nontrash.count(), 1)
     def test_valid_item_ids(self):
         r = self.c.post(reverse('ideaList.views.remove_items'),
                 {'item_ids':(self.i1.id, self.i3.id)},
@@ -387,36 +1105,56 @@ class MoveItemViewTest(MyViewTest):
         self.i3 = Item.objects.create(list=self.l1, text='testitem1-3')
         self.i4 = Item.objects.create(list=self.l2, text='testitem2-1')
         self.i5 = Item.objects.create(list=self.l2, text='testitem2-2')
-        self.assertEqual(self.i1.position, 0)
-        self.assertEqual(self.i2.position, 1)
-        self.assertEqual(self.i3.position, 2)
-        self.assertEqual(self.i4.position, 0)
-        self.assertEqual(self.i5.position, 1)
+        self.assertEqual(self.i1.index(), 0)
+        self.assertEqual(self.i2.index(), 1)
+        self.assertEqual(self.i3.index(), 2)
+        self.assertEqual(self.i4.index(), 0)
+        self.assertEqual(self.i5.index(), 1)
     def test_login_required(self):
         self.check_login_required('ideaList.views.move_item')
+    def test_collections_locked_before_item(self):
+        # In the order of reorder and create_on_top, so that they can't
+        # deadlock with moves
+        locks = []
+        lock_rows = ordering.lock_rows
+        select_for_update = Item.objects.select_for_update
+        with mock.patch.object(ordering, 'lock_rows', side_effect=lambda
+                    model, pks: locks.append(model) or lock_rows(model, pks)), \
+                mock.patch.object(Item.objects, 'select_for_update',
+                    side_effect=lambda: locks.append(Item)
+                        or select_for_update()):
+            for data in ({'item_id': self.i2.id, 'where': 'up'},
+                    {'item_id': self.i2.id, 'where': 0,
+                        'list_id': self.l2.id}):
+                locks[:] = []
+                r = self.c.post(reverse('ideaList.views.move_item'), data,
+                        HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+                self.assertEqual(r.status_code, 200)
+                self.assertEqual(locks, [List, Item])
+        self.assertEqual(Item.objects.get(pk=self.i2.id).list_id, self.l2.id)
     def test_move_up(self):
         r = self.c.post(reverse('ideaList.views.move_item'),
                 {'item_id':self.i2.id, 'where':'up'},
                 HTTP_X_REQUESTED_WITH='XMLHttpRequest')
         self.assertEqual(r.status_code, 200)
-        self.assertEqual(Item.objects.get(pk=self.i2.id).position, 0)
-        self.assertEqual(Item.objects.get(pk=self.i1.id).position, 1)
+        self.assertEqual(Item.objects.get(pk=self.i2.id).index(), 0)
+        self.assertEqual(Item.objects.get(pk=self.i1.id).index(), 1)
         self.check_state_in_response(r)
     def test_move_upmost_up(self):
         r = self.c.post(reverse('ideaList.views.move_item'),
                 {'item_id':self.i1.id, 'where':'up'},
                 HTTP_X_REQUESTED_WITH='XMLHttpRequest')
         self.assertEqual(r.status_code, 200)
-        self.assertEqual(Item.objects.get(pk=self.i1.id).position, 0)
-        self.assertEqual(Item.objects.get(pk=self.i2.id).position, 1)
+        self.assertEqual(Item.objects.get(pk=self.i1.id).index(), 0)
+        self.assertEqual(Item.objects.get(pk=self.i2.id).index(), 1)
         self.check_state_in_response(r)
     def test_move_down(self):
         r = self.c.post(reverse('ideaList.views.move_item'),
                 {'item_id':self.i2.id, 'where':'down'},
                 HTTP_X_REQUESTED_WITH='XMLHttpRequest')
         self.assertEqual(r.status_code, 200)
-        self.assertEqual(Item.objects.get(pk=self.i2.id).position, 2)
-        self.assertEqual(Item.objects.get(pk=self.i3.id).position, 1)
+        self.assertEqual(Item.objects.get(pk=self.i2.id).index(), 2)
+        self.assertEqual(Item.objects.get(pk=self.i3.id).index(), 1)
         self.check_state_in_response(r)
     def test_move_down_across_trashed_item(self):
         self.i2.delete()
@@ -424,9 +1162,9 @@ class MoveItemViewTest(MyViewTest):
                 {'item_id':self.i1.id, 'where':'down'},
                 HTTP_X_REQUESTED_WITH='XMLHttpRequest')
         self.assertEqual(r.status_code, 200)
-        self.assertEqual(Item.objects.get(pk=self.i1.id).position, 2)
-        self.assertEqual(Item.objects.get(pk=self.i2.id).position, 0)
-        self.assertEqual(Item.objects.get(pk=self.i3.id).position, 1)
+        self.assertEqual(Item.objects.get(pk=self.i1.id).index(), 1)
+        self.assertEqual(Item.objects.get(pk=self.i2.id).index(), 0)
+        self.assertEqual(Item.objects.get(pk=self.i3.id).index(), 0)
         self.check_state_in_response(r)
     def test_move_up_across_trashed_item(self):
         self.i2.delete()
@@ -434,27 +1172,27 @@ class MoveItemViewTest(MyViewTest):
                 {'item_id':self.i3.id, 'where':'up'},
                 HTTP_X_REQUESTED_WITH='XMLHttpRequest')
         self.assertEqual(r.status_code, 200)
-        self.assertEqual(Item.objects.get(pk=self.i1.id).position, 1)
-        self.assertEqual(Item.objects.get(pk=self.i2.id).position, 2)
-        self.assertEqual(Item.objects.get(pk=self.i3.id).position, 0)
+        self.assertEqual(Item.objects.get(pk=self.i1.id).index(), 1)
+        self.assertEqual(Item.objects.get(pk=self.i2.id).index(), 2)
+        self.assertEqual(Item.objects.get(pk=self.i3.id).index(), 0)
         self.check_state_in_response(r)
     def test_move_abs(self):
         r = self.c.post(reverse('ideaList.views.move_item'),
                 {'item_id':self.i1.id, 'where':2},
                 HTTP_X_REQUESTED_WITH='XMLHttpRequest')
         self.assertEqual(r.status_code, 200)
-        self.assertEqual(Item.objects.get(pk=self.i1.id).position, 2)
-        self.assertEqual(Item.objects.get(pk=self.i2.id).position, 0)
-        self.assertEqual(Item.objects.get(pk=self.i3.id).position, 1)
+        self.assertEqual(Item.objects.get(pk=self.i1.id).index(), 2)
+        self.assertEqual(Item.objects.get(pk=self.i2.id).index(), 0)
+        self.assertEqual(Item.objects.get(pk=self.i3.id).index(), 1)
         self.check_state_in_response(r)
     def test_move_abs_with_invalid_integer(self):
         r = self.c.post(reverse('ideaList.views.move_item'),
                 {'item_id':self.i1.id, 'where':'invalid'},
                 HTTP_X_REQUESTED_WITH='XMLHttpRequest')
         self.assertEqual(r.status_code, 400)
-        self.assertEqual(Item.objects.get(pk=self.i1.id).position, 0)
-        self.assertEqual(Item.objects.get(pk=self.i2.id).position, 1)
-        self.assertEqual(Item.objects.get(pk=self.i3.id).position, 2)
+        self.assertEqual(Item.objects.get(pk=self.i1.id).index(), 0)
+        self.assertEqual(Item.objects.get(pk=self.i2.id).index(), 1)
+        self.assertEqual(Item.objects.get(pk=self.i3.id).index(), 2)
         self.check_state_in_response(r)
     def test_move_to_other_list(self):
         r = self.c.post(reverse('ideaList.views.move_item'),
@@ -462,32 +1200,117 @@ class MoveItemViewTest(MyViewTest):
                 HTTP_X_REQUESTED_WITH='XMLHttpRequest')
         self.assertEqual(r.status_code, 200)
         self.assertEqual(Item.objects.get(pk=self.i1.id).list, self.l1)
-        self.assertEqual(Item.objects.get(pk=self.i1.id).position, 0)
+        self.assertEqual(Item.objects.get(pk=self.i1.id).index(), 0)
         self.assertEqual(Item.objects.get(pk=self.i2.id).list, self.l2)
-        self.assertEqual(Item.objects.get(pk=self.i2.id).position, 1)
+        self.assertEqual(Item.objects.get(pk=self.i2.id).index(), 1)
         self.assertEqual(Item.objects.get(pk=self.i3.id).list, self.l1)
-        self.assertEqual(Item.objects.get(pk=self.i3.id).position, 1)
+        self.assertEqual(Item.objects.get(pk=self.i3.id).index(), 1)
         self.assertEqual(Item.objects.get(pk=self.i4.id).list, self.l2)
-        self.assertEqual(Item.objects.get(pk=self.i4.id).position, 0)
+        self.assertEqual(Item.objects.get(pk=self.i4.id).index(), 0)
         self.assertEqual(Item.objects.get(pk=self.i5.id).list, self.l2)
-        self.assertEqual(Item.objects.get(pk=self.i5.id).position, 2)
+        self.assertEqual(Item.objects.get(pk=self.i5.id).index(), 2)
         self.check_state_in_response(r)
+    def test_query_count_independent_of_list_size(self):
+        def count_queries():
+            with CaptureQueriesContext(connection) as ctx:
+                self.c.post(reverse('ideaList.views.move_item'),
+                        {'item_id':self.i2.id, 'where':'down'},
+                        HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+                self.c.post(reverse('ideaList.views.move_item'),
+                        {'item_id':self.i2.id, 'where':0},
+                        HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            return len(ctx.captured_queries)
+        count_queries() # Warm up the session and state caches
+        small = count_queries()
+        for n in range(50):
+            Item.objects.create(list=self.l1, text='filler %d' % n)
+        self.assertEqual(count_queries(), small)
     def test_up_with_other_list(self):
         r = self.c.post(reverse('ideaList.views.move_item'),
                 {'item_id':self.i2.id, 'list_id':self.l2.id, 'where':'up'},
                 HTTP_X_REQUESTED_WITH='XMLHttpRequest')
         self.assertEqual(r.status_code, 400)
         self.assertEqual(Item.objects.get(pk=self.i1.id).list, self.l1)
-        self.assertEqual(Item.objects.get(pk=self.i1.id).position, 0)
+        self.assertEqual(Item.objects.get(pk=self.i1.id).index(), 0)
         self.assertEqual(Item.objects.get(pk=self.i2.id).list, self.l1)
-        self.assertEqual(Item.objects.get(pk=self.i2.id).position, 1)
+        self.assertEqual(Item.objects.get(pk=self.i2.id).index(), 1)
         self.assertEqual(Item.objects.get(pk=self.i3.id).list, self.l1)
-        self.assertEqual(Item.objects.get(pk=self.i3.id).position, 2)
+        self.assertEqual(Item.objects.get(pk=self.i3.id).index(), 2)
         self.assertEqual(Item.objects.get(pk=self.i4.id).list, self.l2)
-        self.assertEqual(Item.objects.get(pk=self.i4.id).position, 0)
+        self.assertEqual(Item.objects.get(pk=self.i4.id).index(), 0)
         self.assertEqual(Item.objects.get(pk=self.i5.id).list, self.l2)
-        self.assertEqual(Item.objects.get(pk=self.i5.id).position, 1)
+        self.assertEqual(Item.objects.get(pk=self.i5.id).index(), 1)
+        self.check_state_in_response(r)
+
+class ReorderItemsViewTest(MyViewTest):
+    def setUp(self):
+        super(ReorderItemsViewTest, self).setUp()
+        self.l1 = List.objects.create(name='List1', owner=self.u1)
+        self.l2 = List.objects.create(name='List2', owner=self.u2)
+        self.s1 = Subscription.objects.create(list=self.l1, user=self.u1)
+        self.items = [Item.objects.create(list=self.l1, text=str(n))
+                for n in range(4)]
+        self.ids = [i.id for i in self.items]
+    def post(self, list_id, item_ids):
+        return self.c.post(reverse('ideaList.views.reorder_items'),
+                {'list_id':list_id, 'item_ids':item_ids},
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+    def texts(self):
+        return [i.text for i in Item.nontrash.filter(list=self.l1)]
+    def test_login_required(self):
+        self.check_login_required('ideaList.views.reorder_items')
+    def test_reorder(self):
+        r = self.post(self.l1.id, [self.ids[n] for n in (3, 0, 2, 1)])
+        self.assertEqual(r.status_code, 200)
+        self.check_state_in_response(r)
+        self.assertEqual(self.texts(), ['3', '0', '2', '1'])
+    def test_only_moved_items_written(self):
+        keys = dict(Item.objects.values_list('id', 'position'))
+        self.post(self.l1.id, [self.ids[n] for n in (1, 2, 3, 0)])
+        changed = [i for i, key in Item.objects.values_list('id', 'position')
+                if keys[i] != key]
+        self.assertEqual(changed, [self.ids[0]])
+        self.assertEqual(self.texts(), ['1', '2', '3', '0'])
+    def test_trashed_items_left_out(self):
+        self.items[1].delete()
+        r = self.post(self.l1.id, [self.ids[n] for n in (3, 2, 0)])
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.texts(), ['3', '2', '0'])
+    def test_mismatching_ids(self):
+        for item_ids in ([self.ids[n] for n in (3, 0, 2)],
+                self.ids + [self.ids[0]], ['invalid']):
+            r = self.post(self.l1.id, item_ids)
+            self.assertIn(r.status_code, (400, 409))
+            self.check_state_in_response(r)
+        self.assertEqual(self.texts(), ['0', '1', '2', '3'])
+    def test_not_subscribed(self):
+        i = Item.objects.create(list=self.l2, text='other')
+        r = self.post(self.l2.id, [i.id])
+        self.assertEqual(r.status_code, 403)
+
+class ReorderSubscriptionsViewTest(MyViewTest):
+    def setUp(self):
+        super(ReorderSubscriptionsViewTest, self).setUp()
+        self.subs = [Subscription.objects.create(user=self.u1,
+            list=List.objects.create(name='List%d' % n, owner=self.u1))
+            for n in range(3)]
+        self.ids = [s.id for s in self.subs]
+    def test_login_required(self):
+        self.check_login_required('ideaList.views.reorder_subscriptions')
+    def test_reorder(self):
+        r = self.c.post(reverse('ideaList.views.reorder_subscriptions'),
+                {'subscription_ids':self.ids[::-1]},
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(r.status_code, 200)
         self.check_state_in_response(r)
+        self.assertEqual(list(Subscription.objects.filter(user=self.u1)
+            .values_list('id', flat=True)), self.ids[::-1])
+    def test_other_users_subscription(self):
+        s = Subscription.objects.create(user=self.u2, list=self.subs[0].list)
+        r = self.c.post(reverse('ideaList.views.reorder_subscriptions'),
+                {'subscription_ids':self.ids + [s.id]},
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(r.status_code, 409)
 
 class SetItemImportancesViewTest(MyViewTest):
     def setUp(self):
@@ -549,6 +1372,24 @@ class SetItemImportancesViewTest(MyViewTest):
         self.assertFalse(Item.objects.get(pk=self.i4.id).important)
         self.check_state_in_response(r)
 
+    def test_query_count_independent_of_item_count(self):
+        def count_queries(important, unimportant):
+            with CaptureQueriesContext(connection) as ctx:
+                self.c.post(reverse('ideaList.views.set_item_importances'),
+                        {'important_item_ids':important,
+                         'unimportant_item_ids':unimportant},
+                        HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            return len(ctx.captured_queries)
+        few = count_queries([self.i2.id], [self.i1.id])
+        items = [Item.objects.create(list=self.l1, text='i%d' % n,
+            important=n % 2 == 0) for n in range(40)]
+        self.assertEqual(count_queries(
+            [i.id for i in items if not i.important],
+            [i.id for i in items if i.important]), few)
+        self.assertEqual(Item.objects.filter(pk__in=[i.id for i in items],
+            important=True).count(), 20)
+        self.assertFalse(Item.objects.get(pk=items[0].id).important)
+
 class SetItemUrlViewTest(MyViewTest):
     def setUp(self):
         super(SetItemUrlViewTest, self).setUp()
@@ -672,3 +1513,89 @@ class RemoveListViewTest(MyViewTest):
         self.check_state_in_response(r)
         self.assertEqual(List.objects.count(), 1)
         self.assertEqual(List.nontrash.count(), 1)
+
+class BatchViewTest(MyViewTest):
+    def setUp(self):
+        super(BatchViewTest, self).setUp()
+        self.l1 = List.objects.create(name='List1', owner=self.u1)
+        self.l2 = List.objects.create(name='List2', owner=self.u2)
+        self.s1 = Subscription.objects.create(list=self.l1, user=self.u1)
+        self.i1 = Item.objects.create(list=self.l1, text='testitem1')
+        self.i2 = Item.objects.create(list=self.l1, text='testitem2')
+        self.i3 = Item.objects.create(list=self.l1, text='testitem3')
+        self.i4 = Item.objects.create(list=self.l2, text='testitem4')
+    def post(self, ops, **extra):
+        return self.c.post(reverse('ideaList.views.batch'),
+                {'ops': json.dumps(ops)},
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest', **extra)
+    def test_login_required(self):
+        self.check_login_required('ideaList.views.batch')
+    def test_ops_applied_in_order(self):
+        r = self.post([
+            {'op': 'move_item', 'item_id': self.i3.id, 'where': 'up'},
+            {'op': 'move_item', 'item_id': self.i3.id, 'where': 'up'},
+            {'op': 'set_item_importances', 'important_item_ids': [self.i1.id]},
+            {'op': 'remove_items', 'item_ids': [self.i2.id]},
+            {'op': 'set_item_url', 'item_id': self.i1.id,
+                'url': 'http://google.com/'},
+            {'op': 'edit_text', 'element_id': 'item_%d_text' % self.i1.id,
+                'text': 'edited'},
+            {'op': 'add_item', 'list': self.l1.id, 'text': 'new',
+                'position': 0},
+        ])
+        self.assertEqual(r.status_code, 200)
+        self.check_state_in_response(r)
+        self.assertEqual(Item.objects.get(pk=self.i3.id).index(), 1)
+        i1 = Item.objects.get(pk=self.i1.id)
+        self.assertTrue(i1.important)
+        self.assertEqual(i1.url, 'http://google.com/')
+        self.assertEqual(i1.text, 'edited')
+        self.assertIsNotNone(Item.objects.get(pk=self.i2.id).trashed_at)
+        self.assertEqual(Item.nontrash.filter(list=self.l1)[0].text, 'new')
+    def test_non_string_url(self):
+        for url in (5, ['http://google.com/'], {}):
+            r = self.post([{'op': 'set_item_url', 'item_id': self.i1.id,
+                'url': url}])
+            self.assertEqual(r.status_code, 400)
+            self.assertIn('invalid url', json.loads(r.content)['msg'])
+        self.assertEqual(Item.objects.get(pk=self.i1.id).url, '')
+    def test_failing_op_rolls_back_batch(self):
+        r = self.post([
+            {'op': 'remove_items', 'item_ids': [self.i1.id]},
+            {'op': 'set_item_url', 'item_id': self.i2.id, 'url': 'invalid'},
+        ])
+        self.assertEqual(r.status_code, 400)
+        data = self.check_state_in_response(r)
+        self.assertTrue(data['msg'].startswith('op 1 (set_item_url)'))
+        self.assertIsNone(Item.objects.get(pk=self.i1.id).trashed_at)
+    def test_unsubscribed_item_rejects_batch(self):
+        r = self.post([
+            {'op': 'remove_items', 'item_ids': [self.i1.id]},
+            {'op': 'set_item_importances', 'important_item_ids': [self.i4.id]},
+        ])
+        self.assertEqual(r.status_code, 403)
+        self.check_state_in_response(r)
+        self.assertIsNone(Item.objects.get(pk=self.i1.id).trashed_at)
+        self.assertFalse(Item.objects.get(pk=self.i4.id).important)
+    def test_unsubscribed_list_rejects_batch(self):
+        r = self.post([{'op': 'add_item', 'list': self.l2.id, 'text': 'x'}])
+        self.assertEqual(r.status_code, 403)
+        self.assertEqual(Item.objects.filter(list=self.l2).count(), 1)
+    def test_invalid_ops(self):
+        for ops in ('', '{}', '[{"op": "nonexistent"}]', '[1]'):
+            r = self.c.post(reverse('ideaList.views.batch'), {'ops': ops},
+                    HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            self.assertEqual(r.status_code, 400)
+            self.check_state_in_response(r)
+    def test_delta_response(self):
+        long_ago = datetime.now() - timedelta(minutes=10)
+        List.objects.update(last_changed=long_ago)
+        Subscription.objects.update(last_changed=long_ago)
+        since = (datetime.now() - timedelta(minutes=1)) \
+                .strftime(STATE_VERSION_FORMAT)
+        r = self.post([{'op': 'remove_items', 'item_ids': [self.i1.id]}],
+                HTTP_X_STATE_SINCE=since)
+        self.assertEqual(r.status_code, 200)
+        data = json.loads(r.content)
+        self.assertNotIn('state', data)
+        self.assertIn(self.i1.id, data['delta']['removed_items'])
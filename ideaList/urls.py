@@ -6,18 +6,26 @@ urlpatterns = [
     re_path(r'^$', main, name="main"),
     re_path(r'^basic/$', basic, name="basic"),
     re_path(r'^get_state/$', get_state),
+    re_path(r'^wait_state/$', wait_state),
+    re_path(r'^get_lists/$', get_lists),
     re_path(r'^add_item/$', add_item_login_required),
     re_path(r'^alexa/AEKA5AEFAHHEEJA6HEI7/add_item/$', add_item_alexa),
+    re_path(r'^alexa/AEKA5AEFAHHEEJA6HEI7/add_items/$', add_items_alexa),
     re_path(r'^move_item/$', move_item),
+    re_path(r'^reorder_items/$', reorder_items),
     re_path(r'^remove_items/$', remove_items, name="remove_items"),
     re_path(r'^set_item_importances/$', set_item_importances),
     re_path(r'^set_item_url/$', set_item_url),
     re_path(r'^add_subscription/$', add_subscription),
     re_path(r'^remove_subscription/$', remove_subscription),
     re_path(r'^move_subscription/$', move_subscription),
+    re_path(r'^reorder_subscriptions/$', reorder_subscriptions),
     re_path(r'^add_list/$', add_list),
     re_path(r'^remove_list/$', remove_list),
     re_path(r'^edit_text/$', edit_text),
     re_path(r'^undelete/$', undelete, name='undelete'),
     re_path(r'^get_frequents/$', get_frequents),
+    re_path(r'^get_frequents_page/$', get_frequents_page),
+    re_path(r'^suggest/$', suggest),
+    re_path(r'^batch/$', batch),
 ]
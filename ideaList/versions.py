@@ -0,0 +1,126 @@
+"""
+Version tokens of the state that users see, kept in the cache.
+
+Every user has a token that is replaced whenever anything in their state may
+have changed and every list has one that is replaced whenever the list or its
+items change. The list menu shows all lists, so it is kept out of the users'
+states and has a token of its own: creating or renaming a list bumps only the
+menu and the list's subscribers, not every user. A token that has dropped out
+of the cache is simply created again, which only costs the clients one full
+response.
+
+Tokens are replaced by the signal receivers in ideaList.models both right away
+and again after the changing transaction commits, so that state read in
+between can't stay cached under the new token.
+
+The tokens, and so the ETags, the cached states and push (ideaList.push), are
+only right if every server process sees the same cache: with a per-process
+cache like LocMemCache (Django's default), a process that didn't see a change
+keeps answering with its old state or 304. CACHES must therefore name a shared
+backend such as memcached, redis, the database or the file system cache,
+unless the site runs in a single process. check_cache warns about this in
+./manage.py check and the first use of the tokens logs the same warning.
+"""
+import logging
+import uuid
+from django.core import checks
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'ideaList:version:'
+LIST_MENU_KEY = KEY_PREFIX+'listmenu'
+
+def user_key(user_id):
+    return '%suser:%d' % (KEY_PREFIX, user_id)
+
+def list_key(list_id):
+    return '%slist:%d' % (KEY_PREFIX, list_id)
+
+def new_token():
+    return uuid.uuid4().hex[:12]
+
+# Backends that don't share their contents between processes
+PER_PROCESS_BACKENDS = (LocMemCache, DummyCache)
+CACHE_WARNING = ('The default cache is not shared between processes, so '
+        'ideaList may answer with stale states and false 304s when the site '
+        'runs in several processes')
+
+def cache_is_shared():
+    "Return whether the default cache is shared by all server processes."
+    return not isinstance(caches[DEFAULT_CACHE_ALIAS], PER_PROCESS_BACKENDS)
+
+@checks.register(checks.Tags.caches)
+def check_cache(app_configs, **kwargs):
+    if cache_is_shared():
+        return []
+    return [checks.Warning(CACHE_WARNING, hint='Set CACHES to a shared '
+        'backend such as memcached, redis or the database cache.',
+        id='ideaList.W001')]
+
+_cache_checked = False
+
+def get_tokens(keys):
+    "Return the tokens of the given keys as a list, creating missing ones."
+    global _cache_checked
+    if not _cache_checked:
+        _cache_checked = True
+        if not cache_is_shared():
+            logger.warning(CACHE_WARNING)
+    tokens = cache.get_many(keys)
+    for key in keys:
+        if key not in tokens:
+            cache.add(key, new_token(), None)
+            tokens[key] = cache.get(key)
+    return [tokens[key] for key in keys]
+
+def user_version(user_id):
+    "Return the version of user_id's state, the main view but the list menu."
+    return user_versions([user_id])[user_id]
+
+def user_versions(user_ids):
+    "Return a dict of the versions of user_ids with a single cache query."
+    return dict(zip(user_ids, get_tokens([user_key(u) for u in user_ids])))
+
+def list_version(list_id):
+    "Return the version of the given list and its items."
+    return get_tokens([list_key(list_id)])[0]
+
+def list_versions(list_ids):
+    "Return a dict of the versions of list_ids with a single cache query."
+    return dict(zip(list_ids, get_tokens([list_key(l) for l in list_ids])))
+
+def list_menu_version():
+    "Return the version of the list menu, which is the same for every user."
+    return get_tokens([LIST_MENU_KEY])[0]
+
+def replace_tokens(keys):
+    cache.set_many(dict([(key, new_token()) for key in keys]), None)
+
+def bump(keys):
+    "Replace the tokens of keys now and after the current transaction."
+    keys = list(keys)
+    if not keys:
+        return
+    replace_tokens(keys)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: replace_tokens(keys))
+
+def bump_users(user_ids):
+    bump([user_key(u) for u in set(user_ids)])
+
+def bump_lists(list_ids):
+    "Bump the given lists and every user that is or has been subscribed."
+    from ideaList.models import Subscription
+    list_ids = set(list_ids)
+    if not list_ids:
+        return
+    user_ids = Subscription.objects.filter(list__in=list_ids).order_by() \
+            .values_list('user_id', flat=True).distinct()
+    bump([list_key(l) for l in list_ids] + [user_key(u) for u in user_ids])
+
+def bump_list_menu():
+    bump([LIST_MENU_KEY])
@@ -1,18 +1,36 @@
 import re
-import json
+import asyncio
 import logging
+from itertools import chain, islice
+from datetime import datetime, timedelta
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.contrib.auth.views import redirect_to_login
 from django.urls import reverse
 from django.core.validators import URLValidator
 from django.core.exceptions import ValidationError
-from django.http import HttpResponse,HttpResponseBadRequest,HttpResponseNotFound, HttpResponseRedirect
+from django.core.cache import cache
+from django.http import HttpResponse,HttpResponseBadRequest, HttpResponseRedirect, StreamingHttpResponse
 from django.shortcuts import render
+from django.template.loader import render_to_string
 from django.template import RequestContext
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from django.forms import ModelForm
+from django.db import close_old_connections, transaction
+from django.core.handlers.asgi import ASGIRequest
+from django.utils import timezone
+from django.utils.http import parse_etags, quote_etag
+from django.utils.cache import get_conditional_response, \
+        patch_cache_control, patch_vary_headers
+from asgiref.sync import sync_to_async
 from django.test.client import RequestFactory
 from urllib.parse import urlencode
-from ideaList.models import List, Item, ItemFrequency, Subscription
+from ideaList.models import List, Item, ItemFrequency, Subscription, \
+        FREQUENTS_PER_LIST
+from ideaList import access, compression, fastjson, ingest, versions, push, \
+        suggestions
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +46,35 @@ def render_to(template_name):
         return wrapper
     return renderer
 
+def in_thread(func):
+    """
+    Return an async version of func that runs it in a thread of its own
+    instead of the one thread that sync_to_async shares between all requests
+    by default, so that the database queries of many requests (and of one
+    request, see make_state_async) can be waited for at once. Each thread has
+    its own database connection, which is closed afterwards if it is too old,
+    like at the end of a request.
+    """
+    def run(*args, **kw):
+        close_old_connections()
+        try:
+            return func(*args, **kw)
+        finally:
+            close_old_connections()
+    return sync_to_async(run, thread_sensitive=False)
+
+def sync_to_async_for(request, func):
+    """Return an async version of func that runs it in_thread under ASGI and
+    in the request's own thread under WSGI."""
+    if isinstance(request, ASGIRequest):
+        return in_thread(func)
+    return sync_to_async(func)
+
+async def request_user(request):
+    "Return the logged in user of request or None, loading it off the loop."
+    return await sync_to_async_for(request,
+            lambda: request.user.is_authenticated and request.user or None)()
+
 #################################
 ########## User Views: ##########
 #################################
@@ -35,23 +82,78 @@ def render_to(template_name):
 def csrf_failure(req, reason=""):
     return HttpResponse('Security error: '+reason)
 
-@login_required
-@render_to('ideaList/main.html')
-def main(req):
+async def main(req):
+    """
+    The main page with the user's state in it. Async, so that under ASGI (see
+    apache/asgi.py) an uncached state is built by make_state_async without
+    tying up a thread while the database works. Under WSGI the page is made
+    in the request's thread as before.
+    """
+    if await request_user(req) is None:
+        return redirect_to_login(req.get_full_path())
     m = req.META
     agent = 'HTTP_USER_AGENT' in m and m['HTTP_USER_AGENT'] or None
     if agent and ("SymbianOS/9.1" in agent or "NokiaN73" in agent):
         return HttpResponseRedirect(reverse('basic'))
-    return {'init_state': json.dumps(make_state(req.user)),
+    if isinstance(req, ASGIRequest):
+        await cache_state_async(req)
+    return await sync_to_async_for(req, main_page)(req)
+
+@render_to('ideaList/main.html')
+def main_page(req):
+    # Versions before make_state so that no change is missed
+    etag = quote_etag(state_etag(req))
+    version = make_state_version()
+    lists_etag = quote_etag(list_menu_etag(req))
+    return {'init_state': cached_state(req.user)[1].decode('utf-8'),
+            'state_version': version,
+            'state_etag': etag,
+            'init_lists': cached_list_menu().decode('utf-8'),
+            'lists_etag': lists_etag,
             'suggestions_per_row': 3,
             'suggestions_per_col': 7}
 
 @login_required
 @render_to('ideaList/main_nojs.html')
 def basic(req):
+    """The page for browsers without JavaScript. Takes at most two queries
+    besides those of the session."""
     msg = 'msg' in req.GET and req.GET['msg'] or ''
-    nontrash_subs = req.user.subscriptions.filter(trashed_at__isnull=True)
-    return {'subscriptions': nontrash_subs, 'msg':msg}
+    nontrash_subs = list(req.user.subscriptions.filter(trashed_at__isnull=True)
+            .select_related('list'))
+    return {'subscriptions': nontrash_subs,
+            'lists_html': basic_lists_html([s.list for s in nontrash_subs]),
+            'msg':msg}
+
+# How long the HTML of the lists in the basic view is cached (in seconds). It
+# is cached under the list's version, so it never needs to be deleted.
+BASIC_LIST_CACHE_TIMEOUT = getattr(settings,
+        'IDEALIST_BASIC_LIST_CACHE_TIMEOUT', 3600)
+
+def basic_lists_html(lists):
+    """
+    Return the HTML of the given lists and their items in the basic view, a
+    string per list. The HTML of a list is the same for every user, so it is
+    cached under the list's version, and only the lists changed since they
+    were last shown are rendered again. Their items are loaded with one query.
+    """
+    tokens = versions.list_versions([l.id for l in lists])
+    keys = dict([(l.id, 'ideaList:basic:%d:%s' % (l.id, tokens[l.id]))
+        for l in lists])
+    html = cache.get_many(list(keys.values()))
+    changed = [l for l in lists if keys[l.id] not in html]
+    if changed:
+        items = dict([(l.id, []) for l in changed])
+        for i in Item.nontrash.filter(list__in=list(items)) \
+                .order_by('list_id', 'position', 'id') \
+                .values('id', 'list_id', 'text', 'url', 'important'):
+            items[i['list_id']].append(i)
+        rendered = dict([(keys[l.id], render_to_string(
+            'ideaList/basic_list.html', {'list': l, 'items': items[l.id]}))
+            for l in changed])
+        cache.set_many(rendered, BASIC_LIST_CACHE_TIMEOUT)
+        html.update(rendered)
+    return [html[keys[l.id]] for l in lists]
 
 @login_required
 @csrf_exempt
@@ -59,9 +161,8 @@ def basic(req):
 def undelete(req):
     "Undelete given item_ids and list_ids. Will ignore any invalid ids."
     def make_ctx(msg):
-        nontrash_subs = req.user.subscriptions.filter(trashed_at__isnull=True)
         items = Item.trash.filter(
-            list__in=[s.list for s in nontrash_subs]) \
+            list__in=access.for_user(req.user).subscribed_list_ids) \
                     .order_by('-trashed_at')
         lists = List.trash.filter(
                 pk__in=req.user.subscribed_lists.all()).order_by('-trashed_at')
@@ -86,21 +187,16 @@ def undelete(req):
             list_ids = []
         else:
             list_ids = req.POST.getlist('list_ids')
-        valid_lists = []
-
-        for list_id in list_ids:
-            try:
-                l = List.trash.get(pk=list_id)
-            except ValueError: continue # Invalid list id
-            except List.DoesNotExist: continue # No such trashed list
-            if l.subscription_for(req.user) == None: continue #!subscribed
-            valid_lists.append(l)
+        # Trashed lists of the user's subscriptions, invalid ids ignored
+        valid_lists = list(List.trash.filter(pk__in=item_pks(list_ids)
+            & access.for_user(req.user).subscribed_list_ids).order_by())
 
-        for x in valid_items + valid_lists:
+        for cls, objs in ((Item, valid_items), (List, valid_lists)):
+            objs = cls.trash.filter(pk__in=[x.id for x in objs])
             if purge:
-                x.delete()
+                objs.purge()
             else:
-                x.restore()
+                objs.restore()
 
         msg = "%s %d items and %d lists." % (purge and "Purged" or "Undeleted",
                 len(valid_items), len(valid_lists))
@@ -112,119 +208,648 @@ def undelete(req):
 ########## AJAX Views: ##########
 #################################
 
+# ETags of the polled views are derived from the user's state version, so an
+# unchanged state is answered with 304 without building it.
+def state_etag(req):
+    return versions.user_version(req.user.id)+'-state' \
+            +(wants_compact(req) and '-compact' or '')
+
+def frequents_etag(req):
+    return versions.user_version(req.user.id)+'-frequents'
+
+def list_menu_etag(req):
+    return versions.list_menu_version()+'-lists'
+
+async def get_state(req):
+    """
+    Respond with state_response, or with 304 if the state's ETag is in
+    If-None-Match. Async like main, for the same reason.
+    """
+    if await request_user(req) is None:
+        return redirect_to_login(req.get_full_path())
+    etag = quote_etag(await sync_to_async_for(req, state_etag)(req))
+    response = get_conditional_response(req, etag=etag)
+    if response is None:
+        if isinstance(req, ASGIRequest):
+            await cache_state_async(req)
+        response = await sync_to_async_for(req, state_response)(req)
+    if req.method in ('GET', 'HEAD') and not response.has_header('ETag'):
+        response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+async def wait_state(req):
+    """
+    Long-poll for state changes: respond like get_state as soon as the state
+    differs from the one whose ETag is in If-None-Match, or with 304 if it
+    doesn't change in time. Under WSGI each waiting request would tie up a
+    worker thread, so there the response is 501 and clients keep polling.
+    """
+    if not isinstance(req, ASGIRequest):
+        return HttpResponse(status=501, content_type="application/json",
+                content='{"msg": "Push is only available under ASGI"}')
+    user = await request_user(req)
+    if user is None:
+        return HttpResponse(status=403, content_type="application/json",
+                content='{"msg": "Not logged in"}')
+    version = None
+    for etag in parse_etags(req.META.get('HTTP_IF_NONE_MATCH', '')):
+        etag = etag[etag.index('"')+1:-1] # Drop quotes and weakness
+        if etag.endswith('-compact'): # Either format has the same versions
+            etag = etag[:-len('-compact')]
+        if etag.endswith('-state'):
+            version = etag[:-len('-state')]
+    if await push.wait_for_change(user.id, version) is None:
+        return HttpResponse(status=304)
+    return await get_state(req)
+
 @login_required
-def get_state(req):
-    return state_response(req)
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=list_menu_etag)
+def get_lists(req):
+    """
+    Respond with the lists of the list menu in key 'lists' (see
+    cached_list_menu). They aren't part of the state, so clients ask for them
+    separately, e.g. when the menu is opened.
+    """
+    return HttpResponse(content_type="application/json",
+            content=b'{"lists":'+cached_list_menu()+b'}')
 
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=frequents_etag)
 def get_frequents(req):
     frequents = ItemFrequency.objects.frequents_by_list(req.user)
+    return compression.reusable(HttpResponse(status=200,
+        content_type="application/json", content=fastjson.dumps(frequents)))
+
+# Most texts that one get_frequents_page request may ask for
+FREQUENTS_PAGE_MAX = getattr(settings, 'IDEALIST_FREQUENTS_PAGE_MAX', 200)
+
+@login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=frequents_etag)
+def get_frequents_page(req):
+    """
+    Page through the texts of a list beyond those sent by get_frequents.
+    Request must have GET key 'list_id' and may have 'offset' (default
+    IDEALIST_FREQUENTS_PER_LIST) and 'limit' (default and maximum
+    IDEALIST_FREQUENTS_PAGE_MAX).
+    """
+    try:
+        list_id = int(req.GET['list_id'])
+        offset = max(0, int(req.GET.get('offset', FREQUENTS_PER_LIST)))
+        limit = min(FREQUENTS_PAGE_MAX,
+                max(1, int(req.GET.get('limit', FREQUENTS_PAGE_MAX))))
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest('{"msg": "invalid list_id, offset or limit"}',
+                content_type="application/json")
+    if list_id not in access.for_user(req.user).subscribed_list_ids:
+        return HttpResponse(status=403, content_type="application/json",
+                content='{"msg": "Not subscribed"}')
+    texts, more = ItemFrequency.objects.frequents_page(list_id, offset, limit)
     return HttpResponse(status=200, content_type="application/json",
-            content=json.dumps(frequents))
+            content=fastjson.dumps({'list_id': list_id, 'offset': offset,
+                'texts': texts, 'more': more}))
+
+def suggestible_list_ids(user):
+    """Return the ids of the lists that user may get suggestions for. Cached
+    under the user's version, so that no database query is needed per
+    keystroke."""
+    key = 'ideaList:suggest:lists:%d:%s' % (user.id,
+            versions.user_version(user.id))
+    list_ids = cache.get(key)
+    if list_ids is None:
+        list_ids = access.for_user(user).list_ids
+        cache.set(key, list_ids)
+    return list_ids
+
+@login_required
+@cache_control(private=True, no_cache=True)
+def suggest(req):
+    """
+    Suggest item texts for a list by what has been added to it before. Request
+    must have GET keys 'list_id' and 'prefix' and may have 'limit' (default
+    and maximum IDEALIST_SUGGESTIONS). Response has the texts that start with
+    prefix, most frequent first.
+    """
+    try:
+        list_id = int(req.GET['list_id'])
+        prefix = req.GET['prefix']
+        limit = min(suggestions.SUGGESTIONS,
+                max(1, int(req.GET.get('limit', suggestions.SUGGESTIONS))))
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest('{"msg": "invalid list_id, prefix or limit"}',
+                content_type="application/json")
+    if list_id not in suggestible_list_ids(req.user):
+        return HttpResponse(status=403, content_type="application/json",
+                content='{"msg": "Not subscribed"}')
+    return HttpResponse(status=200, content_type="application/json",
+            content=fastjson.dumps({'list_id': list_id, 'prefix': prefix,
+                'suggestions': suggestions.suggest(list_id, prefix, limit)}))
 
 ########## COMMON STUFF: ##########
 
 def state_response(request, code=200, msg=''):
-    return HttpResponse(status=code, content_type="application/json",
-            content=json.dumps({'state': make_state(request.user), 'msg':msg}))
+    response = streamed_state_response(request, code, msg)
+    if response is not None:
+        return response
+    content, reusable_length = state_content(request, msg)
+    response = HttpResponse(status=code, content_type="application/json",
+            content=content)
+    patch_vary_headers(response, ['Accept'])
+    return compression.reusable(response, reusable_length)
+
+# Clients that can decode the compact state format ask for it with this media
+# type in Accept or with GET param format=compact
+COMPACT_MEDIA_TYPE = 'application/vnd.idealist.compact+json'
+
+def wants_compact(request):
+    return request.GET.get('format') == 'compact' or \
+            COMPACT_MEDIA_TYPE in request.META.get('HTTP_ACCEPT', '')
+
+def state_json(request, msg='', **extra):
+    """
+    Return the JSON response with the user's state in key 'state', msg in key
+    'msg' and any extra keys. If the request carries a valid state version (GET
+    param 'since' or header X-State-Since) from an earlier response, only the
+    changes made after it are sent in key 'delta' instead. The version of the
+    sent state is in key 'version'. If the request asks for the compact format
+    (see compact_state), the state or delta is in it and key 'format' is
+    'compact'.
+    """
+    return state_content(request, msg, **extra)[0]
+
+def state_content(request, msg='', **extra):
+    """Return the content of state_json and how many bytes at its start stay
+    the same as long as the state does (see ideaList.compression)."""
+    compact = wants_compact(request)
+    content = {'version': make_state_version(), 'msg': msg}
+    if compact:
+        content['format'] = 'compact'
+    content.update(extra)
+    since = parse_state_version(request.GET.get('since',
+        request.META.get('HTTP_X_STATE_SINCE')))
+    if since is not None:
+        delta = make_state_delta(request.user, since)
+        content['delta'] = compact and compact_delta(delta) or delta
+        return fastjson.dumps(content), 0
+    # Splice in the cached JSON of the state as is, first so that it is the
+    # reusable part
+    state = compact and cached_compact_state(request.user) \
+            or cached_state(request.user)[1]
+    head = b'{"state":'+state+b','
+    return head+fastjson.dumps(content)[1:], len(head)
+
+# How long the states of idle users are kept in the cache (in seconds). Any
+# change bumps the user's version, so they never need to be deleted.
+STATE_CACHE_TIMEOUT = getattr(settings, 'IDEALIST_STATE_CACHE_TIMEOUT', 3600)
+
+def state_cache_key(user):
+    return 'ideaList:state:%d:%s' % (user.id, versions.user_version(user.id))
+
+def cached_state(user):
+    """
+    Return make_state(user) and its JSON as a tuple. They are cached per user
+    under the user's state version, which the signal receivers in
+    ideaList.models bump whenever anything the user sees is saved, trashed,
+    restored or deleted. The version is also bumped in the request that made
+    the change, so a user always sees their own writes.
+    """
+    key = state_cache_key(user)
+    cached = cache.get(key)
+    if cached is None:
+        state = make_state(user)
+        cached = (state, fastjson.dumps(state))
+        cache.set(key, cached, STATE_CACHE_TIMEOUT)
+    return cached
+
+def cached_compact_state(user):
+    "Return the JSON of compact_state(make_state(user)), cached like it."
+    key = 'ideaList:cstate:%d:%s' % (user.id, versions.user_version(user.id))
+    content = cache.get(key)
+    if content is None:
+        content = fastjson.dumps(compact_state(cached_state(user)[0]))
+        cache.set(key, content, STATE_CACHE_TIMEOUT)
+    return content
+
+def list_menu_rows():
+    return List.nontrash.order_by('id').values('id', 'name', 'owner_id')
+
+def cached_list_menu():
+    """
+    Return the JSON of the list menu: a dict of the (id, name, owner_id) of
+    every nontrashed list by id. It is the same for every user, so it is
+    cached once under versions.list_menu_version(), which is bumped whenever a
+    list is saved, trashed, restored or deleted, and kept out of the users'
+    states so that such changes don't touch the states of unrelated users.
+    """
+    key = 'ideaList:listmenu:%s' % versions.list_menu_version()
+    content = cache.get(key)
+    if content is None:
+        content = fastjson.dumps(dict([(l['id'], l)
+            for l in list_menu_rows()]))
+        cache.set(key, content, STATE_CACHE_TIMEOUT)
+    return content
+
+def compact_items(items):
+    """
+    Return the given item dicts as rows of [id, text, position, url,
+    important] in position order. Trailing defaults (empty url, important
+    false) are left out and important is 1 or 0.
+    """
+    rows = []
+    for i in sorted(items, key=lambda i: (i['position'], i['id'])):
+        row = [i['id'], i['text'], i['position'], i['url'],
+                i['important'] and 1 or 0]
+        while len(row) > 3 and not row[-1]:
+            row.pop()
+        rows.append(row)
+    return rows
+
+def compact_state(state):
+    """
+    Return make_state's state in the compact format, where the lists of the
+    subscriptions are sent apart from them and objects are positional arrays:
+    {'lists': [[id, name, owner_id]] of the subscribed lists,
+     'subscriptions': [[id, list_id, position]] in position order,
+     'items': {list_id: compact_items of the list}}
+    """
+    subs = sorted(state['subscriptions'].values(),
+            key=lambda s: (s['position'], s['id']))
+    return {'lists': [[s['list']['id'], s['list']['name'],
+                s['list']['owner_id']] for s in sorted(subs,
+                    key=lambda s: s['list']['id'])],
+            'subscriptions': [[s['id'], s['list']['id'], s['position']]
+                for s in subs],
+            'items': dict([(s['list']['id'],
+                compact_items(s['list']['items'].values())) for s in subs])}
+
+def compact_delta(delta):
+    """
+    Return make_state_delta's delta in the compact format: lists,
+    subscriptions and items like in compact_state and the removed ids as is.
+    All changed items, including those of changed subscriptions, are in items.
+    """
+    items = {}
+    for s in delta['subscriptions'].values():
+        items[s['list']['id']] = list(s['list']['items'].values())
+    for i in delta['items'].values():
+        items.setdefault(i['list_id'], []).append(i)
+    compact = compact_state({'subscriptions': delta['subscriptions']})
+    compact['items'] = dict([(l, compact_items(i)) for l, i in items.items()])
+    for key in ('removed_subscriptions', 'removed_items'):
+        compact[key] = delta[key]
+    return compact
+
+# The queries of make_state and stream_state. Their order is fixed, so that
+# both give the same JSON.
+def state_subscription_rows(user):
+    return Subscription.nontrash.filter(user=user,
+        list__trashed_at__isnull=True).order_by('list_id').values_list('id',
+            'user_id', 'position', 'list_id', 'list__name', 'list__owner_id')
+
+def state_item_rows(list_ids):
+    return Item.nontrash.filter(list__in=list_ids) \
+            .order_by('list_id', 'position', 'id') \
+            .values('id', 'list_id', 'text', 'url', 'important', 'position')
 
 # Return all state that is used in client's main view
 def make_state(user):
-    # This function is messy to minimize number of SQL queries
+    """
+    Return the state dict used by the client's main view. Only the user's
+    nontrashed subscriptions of nontrashed lists and their items are loaded.
+
+    Runs at most two queries no matter how much data there is: one for the
+    subscriptions (with their lists joined in) and one for the items on those
+    lists. The dicts are built straight from the rows (the same ones that the
+    as_dict methods would make), and items are grouped by list in a single
+    pass. The list menu isn't part of the state, see cached_list_menu.
+    """
+    subs = list(state_subscription_rows(user))
+    return build_state(subs, state_item_rows([s[3] for s in subs]))
+
+def build_state(subs, item_rows):
+    """Return the state dict of make_state from the rows of its queries.
+    Items of lists that aren't among subs are left out."""
+    # Group all interesting items by list in one pass
+    items_by_list = dict([(s[3], {}) for s in subs])
+    for i in item_rows:
+        items = items_by_list.get(i['list_id'])
+        if items is not None:
+            items[i['id']] = i
+
+    subscriptions = dict([(s_id, {'id': s_id, 'user_id': user_id,
+        'list': {'id': l_id, 'name': name, 'owner_id': owner_id,
+            'items': items_by_list[l_id]},
+        'position': position})
+        for s_id, user_id, position, l_id, name, owner_id in subs])
+    return {'subscriptions':subscriptions}
+
+async def make_state_async(user):
+    """
+    Return make_state(user), running its two queries concurrently, each in
+    a thread (and so on a database connection) of its own. The items are
+    selected by a subquery of the user's subscriptions instead of the ids
+    read by the first query. The queries may see different snapshots, so an
+    item of a list that was subscribed meanwhile is left out like the list.
+    """
+    subs, items = await asyncio.gather(
+        in_thread(lambda: list(state_subscription_rows(user)))(),
+        in_thread(lambda: list(state_item_rows(Subscription.nontrash.filter(
+            user=user, list__trashed_at__isnull=True).values('list_id'))))())
+    return build_state(subs, items)
+
+async def cache_state_async(request):
+    """Build the state of request's user with make_state_async and cache it
+    for cached_state, unless it is cached already or only a delta is
+    requested."""
+    if parse_state_version(request.GET.get('since',
+            request.META.get('HTTP_X_STATE_SINCE'))) is not None:
+        return
+    key = await in_thread(state_cache_key)(request.user)
+    if await in_thread(cache.has_key)(key):
+        return
+    state = await make_state_async(request.user)
+    await in_thread(cache.set)(key, (state, fastjson.dumps(state)),
+            STATE_CACHE_TIMEOUT)
+
+# States with more items than this are streamed instead of built in memory
+STREAM_STATE_ITEMS = getattr(settings, 'IDEALIST_STREAM_STATE_ITEMS', 5000)
+# Size of the pieces a streamed state is sent in (in bytes) and how many rows
+# are fetched from the database at a time
+STREAM_CHUNK_SIZE = 64*1024
+STREAM_CHUNK_ROWS = 2000
+
+def stream_state(user, subs=None, items=None):
+    """
+    Yield the JSON of make_state(user) in pieces, byte for byte the same as
+    fastjson.dumps(make_state(user)). Only the subscriptions are held in
+    memory: the items are read from a cursor in the order of the
+    subscriptions' lists and written as they come. The rows of
+    state_subscription_rows and an iterator of those of state_item_rows may be
+    given if they have been read already.
+    """
+    dumps = fastjson.dumps
+    if subs is None:
+        subs = list(state_subscription_rows(user))
+    if items is None:
+        items = state_item_rows([s[3] for s in subs]) \
+                .iterator(chunk_size=STREAM_CHUNK_ROWS)
+    item = next(items, None)
+    yield b'{"subscriptions":{'
+    for n, (s_id, user_id, position, l_id, name, owner_id) in enumerate(subs):
+        yield (n and b',' or b'') + b'"%d":' % s_id \
+            + dumps({'id': s_id, 'user_id': user_id})[:-1] + b',"list":' \
+            + dumps({'id': l_id, 'name': name, 'owner_id': owner_id})[:-1] \
+            + b',"items":{'
+        separator = b''
+        while item is not None and item['list_id'] == l_id:
+            yield separator + b'"%d":' % item['id'] + dumps(item)
+            separator = b','
+            item = next(items, None)
+        yield b'}},"position":' + dumps(position) + b'}'
+    yield b'}}'
+
+def join_pieces(pieces, size=STREAM_CHUNK_SIZE):
+    "Yield the given pieces of bytes joined into chunks of about size bytes."
+    chunk, length = [], 0
+    for piece in pieces:
+        chunk.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield b''.join(chunk)
+            chunk, length = [], 0
+    if chunk:
+        yield b''.join(chunk)
+
+def streamed_state_response(request, code=200, msg=''):
+    """
+    Return a StreamingHttpResponse with the content state_json would have if
+    the request asks for a whole state that isn't cached and has more than
+    STREAM_STATE_ITEMS items, else None. Such states are also too big to cache.
+    Not under ASGI, where the content would be read in the event loop.
+
+    The size is found out by reading the items with the cursor that the
+    stream goes on with, so it costs no extra query. A smaller state is built
+    from the rows read and cached for cached_state instead.
+    """
+    if isinstance(request, ASGIRequest) or wants_compact(request) or \
+            parse_state_version(request.GET.get('since',
+                request.META.get('HTTP_X_STATE_SINCE'))) is not None:
+        return None
+    key = state_cache_key(request.user)
+    if cache.get(key) is not None:
+        return None
+    subs = list(state_subscription_rows(request.user))
+    items = state_item_rows([s[3] for s in subs]) \
+            .iterator(chunk_size=STREAM_CHUNK_ROWS)
+    first_items = list(islice(items, STREAM_STATE_ITEMS + 1))
+    if len(first_items) <= STREAM_STATE_ITEMS:
+        state = build_state(subs, first_items)
+        cache.set(key, (state, fastjson.dumps(state)), STATE_CACHE_TIMEOUT)
+        return None
+    content = {'version': make_state_version(), 'msg': msg}
+    response = StreamingHttpResponse(join_pieces(chain([b'{"state":'],
+        stream_state(request.user, subs, chain(first_items, items)),
+        [b','+fastjson.dumps(content)[1:]])),
+        status=code, content_type="application/json")
+    patch_vary_headers(response, ['Accept'])
+    return response
+
+# How old a state version may be and still be answered with a delta. Rows
+# purged from the trash don't show up in deltas, so this also bounds how long a
+# client can hold on to them.
+STATE_DELTA_MAX_AGE = timedelta(
+        seconds=getattr(settings, 'IDEALIST_STATE_DELTA_MAX_AGE', 3600))
+# Deltas reach this far behind the given version so that rows saved by a
+# transaction that committed only after the version was made aren't missed.
+STATE_DELTA_OVERLAP = timedelta(seconds=2)
+STATE_VERSION_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def make_state_version():
+    "Return a version token for state that is read after this call."
+    return datetime.now().strftime(STATE_VERSION_FORMAT)
+
+def parse_state_version(version):
+    """Return the time of the given state version or None if it is missing,
+    malformed or too old to compute a delta from."""
+    if not version:
+        return None
+    try:
+        since = datetime.strptime(version, STATE_VERSION_FORMAT)
+    except ValueError:
+        return None
+    now = datetime.now()
+    if since > now or now - since > STATE_DELTA_MAX_AGE:
+        return None
+    return since
 
-    subs = user.subscriptions.filter(trashed_at__isnull=True).order_by()
+def make_state_delta(user, since):
+    """
+    Return the changes to make_state(user) since the given time. Changed or new
+    subscriptions are sent whole (with all their items), other changes as a
+    separate dict of items and lists of removed ids:
+    {'subscriptions': {}, 'removed_subscriptions': [],
+     'items': {}, 'removed_items': []}
 
-    # Get all lists now to avoid select_related in above subs query. These are
-    # needed in the list dictionary generation anyway.
-    lsts = dict([(l.id, l) for l in List.nontrash.all()])
+    Runs at most three queries. Relies on the last_changed fields, which are
+    also updated for rows whose position is shifted by another row's move.
+    """
+    since = since - STATE_DELTA_OVERLAP
+    delta = {'subscriptions': {}, 'removed_subscriptions': [],
+             'items': {}, 'removed_items': []}
 
-    # Get all interesting items in one query
-    list_ids = [s.list_id for s in subs]
-    itms = Item.nontrash.filter(list__in=list_ids).order_by()
+    # Subscriptions are sent whole if they or their list changed, because the
+    # client might not have had them before (new, restored or resubscribed)
+    subscribed_list_ids = []
+    whole_subs = []
+    for s in Subscription.objects.filter(user=user).select_related('list') \
+            .order_by():
+        changed = s.last_changed >= since or s.list.last_changed >= since
+        if s.trashed_at is not None or s.list.trashed_at is not None:
+            if changed:
+                delta['removed_subscriptions'].append(s.id)
+            continue
+        if changed:
+            whole_subs.append(s)
+        else:
+            subscribed_list_ids.append(s.list_id)
 
-    items_by_sub = {s.id: list(filter(lambda i:i.list_id==s.list_id, itms)) for s in subs}
-    subscriptions = dict([(s.id, s.as_dict(
-        lst=lsts[s.list_id].as_dict(items=items_by_sub[s.id]))) for s in subs])
+    if whole_subs:
+        items_by_list = dict([(s.list_id, []) for s in whole_subs])
+        for i in Item.nontrash.filter(list__in=list(items_by_list)).order_by():
+            items_by_list[i.list_id].append(i)
+        for s in whole_subs:
+            delta['subscriptions'][s.id] = s.as_dict(
+                    lst=s.list.as_dict(items=items_by_list[s.list_id]))
 
+    if subscribed_list_ids:
+        for i in Item.objects.filter(list__in=subscribed_list_ids,
+                last_changed__gte=since).order_by():
+            if i.trashed_at is None:
+                delta['items'][i.id] = i.as_dict()
+            else:
+                delta['removed_items'].append(i.id)
+    return delta
 
-    # Generate list dictionary
-    lists = dict([(l.id, l.as_dict(include_items=False))
-        for l in iter(lsts.values())])
-    return {'subscriptions':subscriptions, 'lists':lists}
+class OperationError(Exception):
+    "Raised by the operations below with the status code to respond with."
+    def __init__(self, code, msg):
+        Exception.__init__(self, msg)
+        self.code = code
+        self.msg = msg
 
 # A generic view-template for moving objects with positions
 def move(req, cls):
     if 'position' not in dir(cls):
         raise ValueError("Provided class doesn't have a position field")
-    cls_name = cls.__name__.lower()
-    obj_id_name = cls_name+'_id'
+    obj_id_name = cls.__name__.lower()+'_id'
 
     if req.method != 'POST':
         return state_response(req, code=400, msg='Only POST supported')
-    if 'where' not in req.POST:
-        return state_response(req, code=400, msg='param where not provided')
-    where = req.POST['where']
+    try:
+        msg = move_object(req.user, cls, req.POST.get(obj_id_name),
+                req.POST.get('where'), req.POST.get('list_id'))
+    except OperationError as e:
+        return state_response(req, code=e.code, msg=e.msg)
+    return state_response(req, msg=msg)
+
+def move_object(user, cls, obj_id, where, list_id=None):
+    """
+    Move the cls object obj_id up/down or to index where, and if list_id is
+    given, to that list. Return a message describing the result.
+    """
+    cls_name = cls.__name__.lower()
+    obj_id_name = cls_name+'_id'
+
+    if where is None:
+        raise OperationError(400, 'param where not provided')
     if where not in ('up', 'down'):
         try:
             where = int(where)
-        except ValueError:
-            return state_response(req, code=400, msg='param where invalid')
+        except (ValueError, TypeError):
+            raise OperationError(400, 'param where invalid')
 
-    if obj_id_name not in req.POST:
-        return state_response(req, code=400, msg=obj_id_name+' not provided')
-    try:
-        obj = cls.objects.get(pk=req.POST[obj_id_name])
-    except ValueError:
-        return state_response(req, code=400, msg='invalid '+obj_id_name)
-    except cls.DoesNotExist:
-        return state_response(req, code=404, msg='No such '+cls_name)
-
-    # Calculate new position
-    if where == 'up':
-        oldpos = obj.position
-        followers = cls.nontrash.filter(
-                position__lt=oldpos).order_by('-position')
-        if 'user' in dir(cls):
-            followers = followers.filter(user=req.user)
-        if isinstance(obj, Item):
-            followers = followers.filter(list=obj.list)
-        elif isinstance(obj, Subscription):
-            followers = followers.filter(list__trashed_at__isnull=True)
-        if oldpos == 0 or followers.count() == 0:
-            return state_response(req, msg='Could not raise: was on top')
-        else:
-            newpos = followers[0].position
-    elif where == 'down':
-        oldpos = obj.position
-        followers = cls.nontrash.filter(position__gt=oldpos)
-        if 'user' in dir(cls):
-            followers = followers.filter(user=req.user)
-        if isinstance(obj, Item):
-            followers = followers.filter(list=obj.list)
-        elif isinstance(obj, Subscription):
-            followers = followers.filter(list__trashed_at__isnull=True)
-        if oldpos == cls.objects.count()-1 or followers.count() == 0:
-            return state_response(req, msg='Could not lower: was on bottom')
-        else:
-            newpos = followers[0].position
-    else:
-        newpos = where
-
-    if cls is Item and 'list_id' in req.POST:
+    if obj_id is None:
+        raise OperationError(400, obj_id_name+' not provided')
+    if cls is Item and list_id is not None:
         if where in ('up', 'down'):
-            return state_response(req, code=400, msg='up/down with list_id')
+            raise OperationError(400, 'up/down with list_id')
         try:
-            l = List.objects.get(pk=req.POST['list_id'])
-        except ValueError:
-            return state_response(req, code=400, msg='invalid list_id')
-        except List.DoesNotExist:
-            return state_response(req, code=400, msg='list_id does not exist')
-        obj.list = l
-
-    obj.position = newpos
-    obj.save()
-    return state_response(req, msg=cls_name+" "+str(obj.id)
-            +" moved to index "+str(obj.position))
+            list_id = int(list_id)
+        except (ValueError, TypeError):
+            raise OperationError(400, 'invalid list_id')
+    # The collection and then the object are locked, so that concurrent moves
+    # in the collection wait for each other instead of picking the same keys.
+    # Collections are always locked before their objects (as in reorder and
+    # rebalance), so that they can't deadlock.
+    collection = cls._meta.get_field(cls.position_collection).attname
+    with transaction.atomic():
+        while True:
+            try:
+                obj = cls.objects.get(pk=obj_id)
+            except (ValueError, TypeError):
+                raise OperationError(400, 'invalid '+obj_id_name)
+            except cls.DoesNotExist:
+                raise OperationError(404, 'No such '+cls_name)
+            collection_id = getattr(obj, collection)
+            locked = obj.lock_collections(*[pk for pk in
+                (collection_id, list_id) if pk is not None])
+            try:
+                obj = cls.objects.select_for_update().get(pk=obj_id)
+            except cls.DoesNotExist:
+                raise OperationError(404, 'No such '+cls_name)
+            if getattr(obj, collection) == collection_id:
+                break
+            # Moved to another collection meanwhile: lock that one instead
+
+        if cls is Item and list_id is not None:
+            if list_id not in locked:
+                raise OperationError(400, 'list_id does not exist')
+            if obj.list_id != list_id:
+                # Deltas only look at the items of subscribed lists, so the
+                # subscriptions of the old list are sent whole instead: a
+                # subscriber of only that list would keep the item forever
+                List.objects.filter(pk=obj.list_id).update(
+                        last_changed=timezone.now())
+            versions.bump_lists([obj.list_id]) # Saving obj bumps the new list
+            obj.list = locked[list_id]
+
+        if where == 'up':
+            if not obj.move_up():
+                return 'Could not raise: was on top'
+        elif where == 'down':
+            if not obj.move_down():
+                return 'Could not lower: was on bottom'
+        else:
+            obj.move_to(where)
+            where = 'to index %d' % where
+    return '%s %d moved %s' % (cls_name, obj.id, where)
+
+def reorder_objects(user, cls, collection_id, obj_ids):
+    """
+    Put user's visible cls objects in the collection collection_id (a list for
+    items, the user for subscriptions) in the order of obj_ids.
+    """
+    cls_name = cls.__name__.lower()
+    try:
+        collection_id = int(collection_id)
+        obj_ids = [int(obj_id) for obj_id in obj_ids]
+    except (ValueError, TypeError):
+        raise OperationError(400, 'invalid '+cls_name+'_ids')
+    if cls is Item and collection_id not in access.for_user(user).list_ids:
+        raise OperationError(403, 'Not subscribed')
+    with transaction.atomic():
+        moved = cls.reorder(collection_id, obj_ids)
+        if moved is None:
+            raise OperationError(409,
+                    cls_name+'_ids differ from the current '+cls_name+'s')
+    if cls is Item:
+        versions.bump_lists([collection_id])
+    else:
+        versions.bump_users([collection_id])
+    return '%d %ss reordered' % (moved, cls_name)
 
 @login_required
 def edit_text(request):
@@ -237,42 +862,46 @@ def edit_text(request):
     """
     if request.method != 'POST':
         return HttpResponseBadRequest('{"msg": "Only POST supported"}')
-    if 'element_id' not in request.POST or 'text' not in request.POST:
-        return HttpResponseBadRequest(
-                '{"msg":"param element_id or text not provided"}')
-    match = re.match('^item_(\d+)_text$', request.POST['element_id'])
+    text = request.POST.get('text')
+    try:
+        msg = update_text(request.user, request.POST.get('element_id'), text)
+    except OperationError as e:
+        return HttpResponse(status=e.code, content=fastjson.dumps({'msg': e.msg}))
+    content = state_json(request, msg, text=text)
+    return HttpResponse(content_type="application/json", content=content)
+
+def update_text(user, element_id, text):
+    """
+    Set the text of an item or the name of a subscription's list. element_id is
+    as in edit_text.
+    """
+    if element_id is None or text is None:
+        raise OperationError(400, 'param element_id or text not provided')
+    match = re.match('^item_(\d+)_text$', str(element_id))
     if match:
         try:
             i = Item.objects.get(pk=match.group(1))
         except Item.DoesNotExist:
-            return HttpResponseNotFound('{"msg": "No such item"}')
-        text = request.POST['text']
+            raise OperationError(404, 'No such item')
         if i.text != text:
             i.text = text
             i.save()
-        content = json.dumps({'state':make_state(request.user),
-                              'msg':"Item "+str(i.id)+"'s text updated",
-                              'text':text})
-        return HttpResponse(content_type="application/json", content=content)
+        return "Item "+str(i.id)+"'s text updated"
 
-    match = re.match('^subscription_(\d+)_listname$',request.POST['element_id'])
+    match = re.match('^subscription_(\d+)_listname$', str(element_id))
     if match:
         try:
             s = Subscription.objects.get(pk=match.group(1))
         except Subscription.DoesNotExist:
-            return HttpResponseNotFound('{"msg": "No such subscription"}')
-        text = request.POST['text']
+            raise OperationError(404, 'No such subscription')
         l = s.list
         if l.name != text:
             l.name = text
             l.save()
-        msg = "List "+str(l.id)+"'s name updated (sub "+str(s.id)+")"
-        content = json.dumps({'state':make_state(request.user),
-                              'msg':msg, 'text':text})
-        return HttpResponse(content_type="application/json", content=content)
+        return "List "+str(l.id)+"'s name updated (sub "+str(s.id)+")"
 
     # Neither regex matched to element_id
-    return HttpResponseBadRequest('{"msg": "param element_id invalid"}')
+    raise OperationError(400, 'param element_id invalid')
 
 
 ########## SUBSCRIPTION MANIPULATION VIEWS: ##########
@@ -325,6 +954,21 @@ def remove_subscription(req):
     except Subscription.DoesNotExist:
         return state_response(req, code=404, msg='No such subscription')
 
+@login_required
+def reorder_subscriptions(req):
+    """
+    Request must have POST key 'subscription_ids': the ids of all the user's
+    subscriptions in their new order.
+    """
+    if req.method != 'POST':
+        return state_response(req, code=400, msg='Only POST supported')
+    try:
+        msg = reorder_objects(req.user, Subscription, req.user.id,
+                req.POST.getlist('subscription_ids'))
+    except OperationError as e:
+        return state_response(req, code=e.code, msg=e.msg)
+    return state_response(req, msg=msg)
+
 @login_required
 def move_subscription(req):
     """
@@ -336,19 +980,23 @@ def move_subscription(req):
 
 ########## ITEM MANIPULATION VIEWS: ##########
 
-def get_valid_items(item_ids, user=None, manager=Item.objects):
-    """Filters invalid item ids out. If user is given, he/she must be subscribed
-    to the item's list."""
-    valid_items = []
+def item_pks(item_ids):
+    "Return the set of valid item primary keys in item_ids."
+    pks = set()
     for item_id in item_ids:
         try:
-            i = manager.get(pk=item_id)
-        except ValueError: continue # Invalid item id
-        except Item.DoesNotExist: continue # No such trashed item id
-        if user is not None and not i.is_on_subscribed_list(user):
-            continue # Not subscribed
-        valid_items.append(i)
-    return valid_items
+            pks.add(int(item_id))
+        except (ValueError, TypeError): continue # Invalid item id
+    return pks
+
+def get_valid_items(item_ids, user=None, manager=Item.objects):
+    """Filters invalid item ids out. If user is given, he/she must be subscribed
+    to the item's list (see ideaList.access). Takes one query."""
+    items = manager.filter(pk__in=item_pks(item_ids))
+    if user is not None:
+        items = items.filter(
+                list__in=access.for_user(user).subscribed_list_ids)
+    return list(items.order_by())
 
 class ItemForm(ModelForm):
     class Meta:
@@ -378,6 +1026,15 @@ def add_item(req, render):
     else:
         return HttpResponse('')
 
+def create_item(data):
+    "Create an item from ItemForm data."
+    i = Item()
+    form = ItemForm(data, instance=i)
+    if not form.is_valid():
+        raise OperationError(400, 'invalid args')
+    form.save()
+    return 'item '+str(i.id)+' added'
+
 @login_required
 def add_item_login_required(req):
     return add_item(req, True)
@@ -386,6 +1043,32 @@ def add_item_login_required(req):
 def add_item_alexa(req):
     return add_item(req, False)
 
+@csrf_exempt
+def add_items_alexa(req):
+    """
+    Queue items to be added on top of their lists (see ideaList.ingest).
+    Request must have POST key 'items': a JSON list of objects with the keys
+    'list' and 'text' of add_item. The response is 202 as soon as the items
+    are queued.
+    """
+    if req.method != 'POST':
+        return HttpResponseBadRequest('{"msg": "Only POST supported"}',
+                content_type="application/json")
+    max_length = Item._meta.get_field('text').max_length
+    try:
+        items = [(int(i['list']), i['text'].strip())
+                for i in fastjson.loads(req.POST.get('items', ''))]
+    except (ValueError, TypeError, KeyError, AttributeError):
+        items = None
+    if items is None or not all([text and len(text) <= max_length
+            for list_id, text in items]):
+        return HttpResponseBadRequest('{"msg": "param items invalid"}',
+                content_type="application/json")
+    if items:
+        ingest.enqueue(items)
+    return HttpResponse(status=202, content_type="application/json",
+            content=fastjson.dumps({'msg': '%d items queued' % len(items)}))
+
 @login_required
 @csrf_exempt
 def remove_items(req):
@@ -400,14 +1083,19 @@ def remove_items(req):
         return my_response(code=400, msg='Only POST supported')
     if 'item_ids' not in req.POST:
         return my_response(code=200, msg='Nothing removed')
-    item_ids = req.POST.getlist('item_ids')
-    items = get_valid_items(item_ids, user=req.user)
-    if len(items) != len(item_ids):
-        return my_response(code=400, msg='at least one invalid item_id')
-    for i in items:
-        if i.trashed_at == None:
-            i.delete()
-    return my_response(code=200, msg='Items '+(','.join(item_ids))+' removed')
+    try:
+        msg = trash_items(req.user, req.POST.getlist('item_ids'))
+    except OperationError as e:
+        return my_response(code=e.code, msg=e.msg)
+    return my_response(code=200, msg=msg)
+
+def trash_items(user, item_ids):
+    "Trash the given items of user's lists. If any of them are invalid, none."
+    items = get_valid_items(item_ids, user=user)
+    if len(items) != len(set([str(i) for i in item_ids])):
+        raise OperationError(400, 'at least one invalid item_id')
+    Item.objects.filter(pk__in=[i.id for i in items]).trash()
+    return 'Items '+(','.join([str(i) for i in item_ids]))+' removed'
 
 @login_required
 def move_item(req):
@@ -419,6 +1107,23 @@ def move_item(req):
     """
     return move(req, Item)
 
+@login_required
+def reorder_items(req):
+    """
+    Request must have POST keys 'list_id' and 'item_ids': the ids of all the
+    list's items in their new order.
+    """
+    if req.method != 'POST':
+        return state_response(req, code=400, msg='Only POST supported')
+    if 'list_id' not in req.POST:
+        return state_response(req, code=400, msg='list_id not provided')
+    try:
+        msg = reorder_objects(req.user, Item, req.POST['list_id'],
+                req.POST.getlist('item_ids'))
+    except OperationError as e:
+        return state_response(req, code=e.code, msg=e.msg)
+    return state_response(req, msg=msg)
+
 @login_required
 def set_item_importances(req):
     """
@@ -427,32 +1132,34 @@ def set_item_importances(req):
     disjoint, important_item_ids wins.
     """
     if req.method != 'POST':
-        return state_response(code=400, msg='Only POST supported')
-    if 'important_item_ids' in req.POST:
-        important_item_ids = req.POST.getlist('important_item_ids')
-    else:
-        important_item_ids = []
-    important_items = get_valid_items(important_item_ids, user=req.user)
+        return state_response(req, code=400, msg='Only POST supported')
+    msg = update_importances(req.user,
+            req.POST.getlist('important_item_ids'),
+            req.POST.getlist('unimportant_item_ids'))
+    return state_response(req, code=200, msg=msg)
 
-    if 'unimportant_item_ids' in req.POST:
-        unimportant_item_ids = req.POST.getlist('unimportant_item_ids')
-    else:
-        unimportant_item_ids = []
-    unimportant_items = get_valid_items(unimportant_item_ids, user=req.user)
+def update_importances(user, important_item_ids, unimportant_item_ids):
+    "Set the importances of the given items as in set_item_importances."
+    important_pks = item_pks(important_item_ids)
+    unimportant_pks = item_pks(unimportant_item_ids) - important_pks
+    items = get_valid_items(important_pks | unimportant_pks, user=user)
+    important_items = [i for i in items if i.id in important_pks]
+    unimportant_items = [i for i in items if i.id in unimportant_pks]
+
+    # Only the items whose importance changes are updated
+    changed = []
+    for value, items in ((True, important_items), (False, unimportant_items)):
+        pks = [i.id for i in items if i.important != value]
+        if pks:
+            Item.objects.filter(pk__in=pks).update(important=value,
+                    last_changed=datetime.now())
+            changed.extend([i for i in items if i.id in pks])
+    versions.bump_lists([i.list_id for i in changed])
 
-    # Unimportant first, so if sets aren't disjoint, important wins
-    for i in unimportant_items:
-        if i.important:
-            i.important = False
-            i.save()
-    for i in important_items:
-        if not i.important:
-            i.important = True
-            i.save()
- 
     total_items = len(important_item_ids) + len(unimportant_item_ids)
     updated_items = len(important_items) + len(unimportant_items)
-    return state_response(req, code=200, msg='Item priorities of %d/%d items updated' % (updated_items, total_items))
+    return 'Item priorities of %d/%d items updated' % (updated_items,
+            total_items)
 
 @login_required
 def set_item_url(req):
@@ -460,32 +1167,143 @@ def set_item_url(req):
     Request must have POST keys 'item_id' and 'url'.
     """
     if req.method != 'POST':
-        return state_response(code=400, msg='Only POST supported')
-    if 'item_id' not in req.POST:
-        return state_response(req, code=400, msg='item_id missing')
-    if 'url' not in req.POST:
-        return state_response(req, code=400, msg='url missing')
+        return state_response(req, code=400, msg='Only POST supported')
+    try:
+        msg = update_item_url(req.user, req.POST.get('item_id'),
+                req.POST.get('url'))
+    except OperationError as e:
+        return state_response(req, code=e.code, msg=e.msg)
+    return state_response(req, code=200, msg=msg)
+
+def update_item_url(user, item_id, url):
+    "Set the url of an item on user's lists. An empty url removes it."
+    if item_id is None:
+        raise OperationError(400, 'item_id missing')
+    if url is None:
+        raise OperationError(400, 'url missing')
+    if not isinstance(url, str):
+        raise OperationError(400, 'invalid url')
 
     try:
-        i = Item.objects.get(pk=req.POST['item_id'])
-    except ValueError:
-        return state_response(req, code=400, msg='Invalid item_id')
+        i = Item.objects.get(pk=item_id)
+    except (ValueError, TypeError):
+        raise OperationError(400, 'Invalid item_id')
     except Item.DoesNotExist:
-        return state_response(req, code=404, msg='item_id doesn\'t exist')
-    if req.user is not None and not i.is_on_subscribed_list(req.user):
-        return state_response(req, code=403, msg='Not subscribed')
+        raise OperationError(404, 'item_id doesn\'t exist')
+    if user is not None and not i.is_on_subscribed_list(user):
+        raise OperationError(403, 'Not subscribed')
 
-    if len(req.POST['url']) != 0:
+    if len(url) != 0:
         validate = URLValidator()
         try:
-            validate(req.POST['url'])
+            validate(url)
         except ValidationError:
-            return state_response(req, code=400, msg='invalid url')
+            raise OperationError(400, 'invalid url')
 
-    i.url = req.POST['url']
+    i.url = url
     i.save()
-    return state_response(req, code=200,
-            msg='Item %s\'s url updated' % req.POST['item_id'])
+    return 'Item %s\'s url updated' % item_id
+
+########## BATCHES: ##########
+
+def id_list(value):
+    "Return the ids of a batch operation's list parameter as a list."
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+# The operations that batch accepts, each called with the user and the
+# operation's object. The keys of the objects are those of the POST keys of the
+# corresponding views.
+BATCH_OPERATIONS = {
+    'add_item': lambda user, op: create_item(op),
+    'move_item': lambda user, op: move_object(user, Item,
+        op.get('item_id'), op.get('where'), op.get('list_id')),
+    'move_subscription': lambda user, op: move_object(user, Subscription,
+        op.get('subscription_id'), op.get('where')),
+    'reorder_items': lambda user, op: reorder_objects(user, Item,
+        op.get('list_id'), id_list(op.get('item_ids'))),
+    'reorder_subscriptions': lambda user, op: reorder_objects(user,
+        Subscription, user.id, id_list(op.get('subscription_ids'))),
+    'remove_items': lambda user, op: trash_items(user,
+        id_list(op.get('item_ids'))),
+    'set_item_importances': lambda user, op: update_importances(user,
+        id_list(op.get('important_item_ids')),
+        id_list(op.get('unimportant_item_ids'))),
+    'set_item_url': lambda user, op: update_item_url(user,
+        op.get('item_id'), op.get('url')),
+    'edit_text': lambda user, op: update_text(user,
+        op.get('element_id'), op.get('text')),
+}
+
+def check_batch_permissions(user, ops):
+    """
+    Raise OperationError unless every item, list and subscription referred to
+    in ops is on or is one of user's subscriptions. Ids that aren't numbers are
+    left for the operations to report. Takes one query besides the user's
+    ideaList.access memo.
+    """
+    item_ids, list_ids, subscription_ids = set(), set(), set()
+    def add_ids(ids, values):
+        for value in values:
+            try:
+                ids.add(int(value))
+            except (ValueError, TypeError):
+                pass
+    for op in ops:
+        add_ids(item_ids, [op.get('item_id')]
+                + id_list(op.get('item_ids'))
+                + id_list(op.get('important_item_ids'))
+                + id_list(op.get('unimportant_item_ids')))
+        add_ids(list_ids, [op.get('list_id'), op.get('list')])
+        add_ids(subscription_ids, [op.get('subscription_id')]
+                + id_list(op.get('subscription_ids')))
+        match = re.match('^(item|subscription)_(\d+)_(text|listname)$',
+                str(op.get('element_id')))
+        if match:
+            add_ids(item_ids if match.group(1) == 'item' else subscription_ids,
+                    [match.group(2)])
+
+    user_access = access.for_user(user)
+    own_subscriptions = user_access.subscription_ids
+    subscribed_lists = user_access.list_ids
+    if item_ids:
+        item_ids -= set(Item.objects.filter(pk__in=item_ids,
+            list__in=subscribed_lists).values_list('id', flat=True))
+    for ids, what in ((item_ids, 'item'), (list_ids - subscribed_lists, 'list'),
+            (subscription_ids - own_subscriptions, 'subscription')):
+        if ids:
+            raise OperationError(403, 'No access to %s %d' % (what, min(ids)))
+
+@login_required
+def batch(req):
+    """
+    Request must have POST key 'ops': a JSON list of operations, each an object
+    with the operation's name (see BATCH_OPERATIONS) in key 'op'. The
+    operations are applied in order in one transaction, so either all or none
+    of them take effect, and the response carries the state after all of them.
+    """
+    if req.method != 'POST':
+        return state_response(req, code=400, msg='Only POST supported')
+    try:
+        ops = fastjson.loads(req.POST.get('ops', ''))
+    except ValueError:
+        return state_response(req, code=400, msg='param ops invalid')
+    if not isinstance(ops, list) or not all([isinstance(op, dict)
+            and op.get('op') in BATCH_OPERATIONS for op in ops]):
+        return state_response(req, code=400, msg='param ops invalid')
+    try:
+        check_batch_permissions(req.user, ops)
+        with transaction.atomic():
+            for n, op in enumerate(ops):
+                try:
+                    BATCH_OPERATIONS[op['op']](req.user, op)
+                except OperationError as e:
+                    raise OperationError(e.code,
+                            'op %d (%s): %s' % (n, op['op'], e.msg))
+    except OperationError as e:
+        return state_response(req, code=e.code, msg=e.msg)
+    return state_response(req, msg='%d operations done' % len(ops))
 
 
 ########## LIST MANIPULATION VIEWS: ##########
@@ -509,7 +1327,7 @@ def add_list(req):
     except django.db.IntegrityError as e:
         # state_response fails here for some reason...
         return HttpResponse(status=400, content_type="application/json",\
-                content=json.dumps({'msg':'DB Integrity error: %s' % e}))
+                content=fastjson.dumps({'msg':'DB Integrity error: %s' % e}))
     except:
         return state_response(req, code=400, msg='Error creating list')
     if 'subscribe' in req.POST and req.POST['subscribe'] == 'true':
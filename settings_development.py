@@ -28,6 +28,21 @@ DATABASES = {
     }
 }
 
+# The version tokens and cached states of ideaList must be seen by every server
+# process (see ideaList/versions.py), so not the default per-process
+# LocMemCache. The file system cache is shared by the processes of one host;
+# use memcached or redis if the site runs on several.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': SITE_DIR+'/cache',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    }
+}
+
+# Queue of items added by voice assistants, see ideaList/ingest.py
+IDEALIST_INGEST_DIR = SITE_DIR+'/ingest'
+
 # Local time zone for this installation. Choices can be found here:
 # http://en.wikipedia.org/wiki/List_of_tz_zones_by_name
 # although not all choices may be available on all operating systems.
@@ -99,6 +114,7 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'ideaList.compression.CompressionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -2,12 +2,57 @@ from datetime import datetime
 from django.db import models
 import signals
 
-class NonTrashedManager(models.Manager):
+class TrashableQuerySet(models.QuerySet):
+    """
+    Bulk versions of trashing, restoring and deleting. Each runs as one
+    statement and sends the bulk signal pair with the primary keys of the
+    affected objects instead of the per-object signals.
+    """
+    def _bulk_update(self, pks, **values):
+        "Update the objects like save() would, auto_now fields included."
+        now = datetime.now()
+        for field in self.model._meta.concrete_fields:
+            if getattr(field, 'auto_now', False):
+                values[field.attname] = now
+        self.model._base_manager.filter(pk__in=pks).update(**values)
+
+    def trash(self):
+        "Trash the nontrashed objects. Return the number of objects trashed."
+        pks = list(self.filter(trashed_at__isnull=True)
+                .values_list('pk', flat=True))
+        if pks:
+            signals.pre_bulk_trash.send(sender=self.model, pks=pks)
+            self._bulk_update(pks, trashed_at=datetime.now())
+            signals.post_bulk_trash.send(sender=self.model, pks=pks)
+        return len(pks)
+
+    def restore(self):
+        "Restore the trashed objects. Return the number of objects restored."
+        pks = list(self.filter(trashed_at__isnull=False)
+                .values_list('pk', flat=True))
+        if pks:
+            signals.pre_bulk_restore.send(sender=self.model, pks=pks)
+            self._bulk_update(pks, trashed_at=None)
+            signals.post_bulk_restore.send(sender=self.model, pks=pks)
+        return len(pks)
+
+    def purge(self):
+        "Delete the objects for good. Return the number of objects deleted."
+        pks = list(self.values_list('pk', flat=True))
+        if pks:
+            signals.pre_bulk_purge.send(sender=self.model, pks=pks)
+            self.model._base_manager.filter(pk__in=pks).delete()
+            signals.post_bulk_purge.send(sender=self.model, pks=pks)
+        return len(pks)
+
+TrashableManager = models.Manager.from_queryset(TrashableQuerySet)
+
+class NonTrashedManager(TrashableManager):
     ''' Query only objects which have not been trashed. '''
     def get_queryset(self):
         query_set = super(NonTrashedManager, self).get_queryset()
         return query_set.filter(trashed_at__isnull=True)
-class TrashedManager(models.Manager):
+class TrashedManager(TrashableManager):
     ''' Query only objects which have been trashed. '''
     def get_queryset(self):
         query_set = super(TrashedManager, self).get_queryset()
@@ -20,7 +65,7 @@ class Trashable(models.Model):
     """
     trashed_at = models.DateTimeField('Trashed', editable=False, blank=True, null=True)
 
-    objects = models.Manager()
+    objects = TrashableManager()
     nontrash = NonTrashedManager()
     trash = TrashedManager()
 
@@ -44,8 +89,7 @@ class Trashable(models.Model):
 
     @classmethod
     def empty_trash(cls):
-        for i in cls.trash.all():
-            i.delete()
+        cls.trash.all().purge()
 
     class Meta:
         abstract = True
@@ -5,3 +5,14 @@ post_trash = dispatch.Signal()
 
 pre_restore = dispatch.Signal()
 post_restore = dispatch.Signal()
+
+# Sent by the TrashableQuerySet methods with the primary keys of the objects
+# in argument pks
+pre_bulk_trash = dispatch.Signal()
+post_bulk_trash = dispatch.Signal()
+
+pre_bulk_restore = dispatch.Signal()
+post_bulk_restore = dispatch.Signal()
+
+pre_bulk_purge = dispatch.Signal()
+post_bulk_purge = dispatch.Signal()
@@ -4,6 +4,7 @@ from django.core.management import call_command
 from django.contrib.auth.models import User
 import django.test
 from undelete.testmodels.models import Apple
+from undelete.models import signals
 
 class TestCase(django.test.TestCase):
     """
@@ -110,6 +111,51 @@ class TrashableTest(TestCase):
         self.assertEqual(Apple.trash.count(), 0)
         self.assertEqual(Apple.objects.all()[0].color, "green")
 
+class TrashableQuerySetTest(TestCase):
+    def setUp(self):
+        self.apples = [Apple.objects.create(color=c)
+                for c in ("red", "green", "yellow")]
+        self.received = []
+        for name in ('pre_bulk_trash', 'post_bulk_trash', 'pre_bulk_restore',
+                'post_bulk_restore', 'pre_bulk_purge', 'post_bulk_purge'):
+            getattr(signals, name).connect(self.receiver, sender=Apple)
+
+    def tearDown(self):
+        for name in ('pre_bulk_trash', 'post_bulk_trash', 'pre_bulk_restore',
+                'post_bulk_restore', 'pre_bulk_purge', 'post_bulk_purge'):
+            getattr(signals, name).disconnect(self.receiver, sender=Apple)
+
+    def receiver(self, signal, sender, pks, **kwargs):
+        self.received.append((signal, sorted(pks)))
+
+    def test_trash(self):
+        self.apples[0].delete()
+        del self.received[:]
+        self.assertEqual(Apple.objects.all().trash(), 2)
+        self.assertEqual(Apple.trash.count(), 3)
+        pks = sorted([a.pk for a in self.apples[1:]])
+        self.assertEqual(self.received, [(signals.pre_bulk_trash, pks),
+            (signals.post_bulk_trash, pks)])
+
+    def test_restore(self):
+        Apple.objects.filter(color="red").trash()
+        del self.received[:]
+        self.assertEqual(Apple.trash.all().restore(), 1)
+        self.assertEqual(Apple.trash.count(), 0)
+        pks = [self.apples[0].pk]
+        self.assertEqual(self.received, [(signals.pre_bulk_restore, pks),
+            (signals.post_bulk_restore, pks)])
+
+    def test_purge(self):
+        self.assertEqual(Apple.nontrash.exclude(color="red").purge(), 2)
+        self.assertEqual(Apple.objects.count(), 1)
+        self.assertEqual(len(self.received), 2)
+
+    def test_nothing_to_do(self):
+        self.assertEqual(Apple.trash.all().restore(), 0)
+        self.assertEqual(Apple.trash.all().purge(), 0)
+        self.assertEqual(self.received, [])
+
 class TrashablePositionTest(TestCase):
     def setUp(self):
         self.u1 = User.objects.create_user('user1', 'lol@lol.lol', 'password')